@@ -0,0 +1,34 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import gc
+import time
+
+
+class Stopwatch(object):
+    """
+    Times a block, and counts how many more objects the garbage collector is tracking at the end than at the start.
+    """
+    def __init__(self):
+        self.elapsed = None
+        self.objects = None
+        self._started = None
+        self._objects_before = None
+
+    def __enter__(self):
+        gc.collect()
+        self._objects_before = len(gc.get_objects())
+        self._started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = time.time() - self._started
+        gc.collect()
+        self.objects = len(gc.get_objects()) - self._objects_before
+
+
+def format_table(headings, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(headings, *rows)]
+    lines = ["  ".join(str(x).rjust(w) for x, w in zip(row, widths)) for row in [headings] + rows]
+    lines.insert(1, "  ".join("-" * w for w in widths))
+    return "\n".join(lines)
@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+"""
+Runs a benchmark's own JavaScript in a real JSRuntime, with stand-ins for the watch and the runner, so that benchmarks
+need neither a watch nor an emulator. Like the rest of pypkjs, this needs PyV8.
+"""
+__author__ = 'katharine'
+
+import collections
+import gevent
+import gevent.event
+import logging
+import uuid
+
+from pypkjs.javascript.runtime import JSRuntime
+from pypkjs.runner import Runner
+
+APP_UUID = uuid.UUID('5a1b2b6a-1b2c-4c6e-9d7f-0a1b2c3d4e5f')
+
+
+class FakeAppMessageService(object):
+    """
+    Stands in for libpebble2's AppMessageService. Outbound messages are acked (or nacked) after `ack_delay` seconds;
+    inbound messages are injected with deliver().
+    """
+    def __init__(self, ack_delay=0, nack=False):
+        self.ack_delay = ack_delay
+        self.nack = nack
+        self.handlers = collections.defaultdict(dict)
+        self._handler_id = 0
+        self._tid = 0
+
+    def register_handler(self, event, handler):
+        self._handler_id += 1
+        self.handlers[event][self._handler_id] = handler
+        return event, self._handler_id
+
+    def unregister_handler(self, handle):
+        event, handler_id = handle
+        self.handlers[event].pop(handler_id, None)
+
+    def _broadcast(self, event, *args):
+        for handler in self.handlers[event].values():
+            handler(*args)
+
+    def send_message(self, target_app, dictionary):
+        tid = self._tid
+        self._tid = (self._tid + 1) % 256
+        gevent.spawn_later(self.ack_delay, self._broadcast, "nack" if self.nack else "ack", tid, target_app)
+        return tid
+
+    def deliver(self, target_app, dictionary):
+        tid = self._tid
+        self._tid = (self._tid + 1) % 256
+        self._broadcast("appmessage", tid, target_app, dictionary)
+
+
+class FakeWatch(object):
+    # Stands in for the PebbleConnection.
+    watch_platform = 'basalt'
+
+    def _send_message(self, endpoint, data):
+        pass
+
+    def send_packet(self, packet):
+        pass
+
+
+class FakeManager(object):
+    def __init__(self):
+        self.pebble = FakeWatch()
+        self.blobdb = None
+
+
+class FakeRunner(object):
+    def __init__(self, appmessage):
+        self.appmessage = appmessage
+
+    def record_js_termination(self, uuid):
+        pass
+
+    def record_localstorage_usage(self, uuid, size):
+        pass
+
+
+class BenchmarkApp(object):
+    """
+    An app whose JavaScript is `source`. Any extra keyword arguments are passed on to the JSRuntime.
+    """
+    def __init__(self, source, app_keys=None, appmessage=None, **kwargs):
+        self.source = source
+        self.appmessage = appmessage if appmessage is not None else FakeAppMessageService()
+        manifest = {'appKeys': app_keys or {}, 'capabilities': []}
+        pbw = Runner.PBW(APP_UUID, source, manifest, None, None)
+        self.runtime = JSRuntime(FakeManager(), pbw, FakeRunner(self.appmessage), **kwargs)
+        self.runtime.log_output = lambda m: logging.info("JS: %s", m)
+
+    def start(self):
+        gevent.spawn(self.runtime.run, self.source, "benchmark.js")
+        while self.runtime.pjs is None or not self.runtime.pjs.pebble.is_ready:
+            gevent.sleep(0.01)
+
+    def stop(self):
+        self.runtime.stop()
+
+    def run_in_loop(self, fn, *args):
+        # Runs fn on the runtime's event loop, inside its JavaScript context, and waits for it to return.
+        result = gevent.event.AsyncResult()
+
+        def go():
+            try:
+                result.set(fn(*args))
+            except Exception as e:
+                result.set_exception(e)
+        self.runtime.enqueue(go)
+        return result.get()
+
+    def call(self, name, *args):
+        # Calls a global JavaScript function.
+        return self.run_in_loop(lambda: getattr(self.runtime.context.locals, name)(*args))
@@ -0,0 +1,157 @@
+from __future__ import absolute_import
+"""
+Measures how fast AppMessages move between JavaScript and a stand-in for the watch, without needing a watch or
+emulator. Run it with `python -m pypkjs.benchmarks.appmessage`.
+"""
+__author__ = 'katharine'
+
+import argparse
+import collections
+import gevent
+import gevent.event
+import json
+import logging
+
+from pypkjs.javascript.metrics import AppMessageMetrics
+from . import Stopwatch, format_table
+from .app import APP_UUID, BenchmarkApp, FakeAppMessageService
+
+APP_KEYS = {'key%d' % i: i for i in xrange(64)}
+
+# Outbound payloads are built in JavaScript, the way an app would build them.
+APP_SOURCE = """
+var bytes = [];
+for (var i = 0; i < 64; ++i) bytes.push(i);
+var many = {};
+for (var i = 0; i < 64; ++i) many['key' + i] = i;
+var shapes = {
+    ints: {key0: 1, key1: 2, key2: 3, key3: 4},
+    strings: {key0: 'The quick brown fox', key1: 'jumps over the lazy dog'},
+    bytes: {key0: bytes},
+    many: many
+};
+
+function benchSend(shape, n, done) {
+    var payload = shapes[shape];
+    var acked = 0, failed = 0;
+    var finish = function() {
+        if (acked + failed == n) done(acked, failed);
+    };
+    for (var i = 0; i < n; ++i) {
+        Pebble.sendAppMessage(payload, function() { ++acked; finish(); }, function() { ++failed; finish(); });
+    }
+}
+
+var received = 0, receiveTarget = 0, receiveDone = null;
+Pebble.addEventListener('appmessage', function(e) {
+    if (++received == receiveTarget) receiveDone();
+});
+function expectMessages(n, done) {
+    received = 0;
+    receiveTarget = n;
+    receiveDone = done;
+}
+"""
+
+# Inbound payloads are what libpebble2 would hand us from the watch.
+INBOUND_SHAPES = collections.OrderedDict([
+    ('ints', {0: 1, 1: 2, 2: 3, 3: 4}),
+    ('strings', {0: u'The quick brown fox', 1: u'jumps over the lazy dog'}),
+    ('bytes', {0: bytearray(xrange(64))}),
+    ('many', {i: i for i in xrange(64)}),
+])
+
+
+class AppMessageBenchmark(object):
+    def __init__(self, ack_delay=0, window=4, timeout=10.0):
+        self.service = FakeAppMessageService(ack_delay)
+        self.app = BenchmarkApp(APP_SOURCE, app_keys=APP_KEYS, appmessage=self.service, appmessage_window=window,
+                                appmessage_timeout=timeout)
+        self.runtime = self.app.runtime
+
+    def start(self):
+        self.app.start()
+
+    def stop(self):
+        self.app.stop()
+
+    def send(self, shape, count):
+        # Give the pipeline fresh metrics, so the round trips are just this run's.
+        metrics = AppMessageMetrics()
+        self.runtime.appmessage_metrics = metrics
+        self.runtime.pjs.pebble._pipeline.metrics = metrics
+        result = gevent.event.AsyncResult()
+        with Stopwatch() as stopwatch:
+            self.app.call('benchSend', shape, count, lambda *x: result.set(x))
+            acked, failed = result.get()
+        round_trips = metrics.round_trips
+        return {
+            'direction': 'send',
+            'shape': shape,
+            'messages': count,
+            'failed': failed,
+            'msgs_per_sec': count / stopwatch.elapsed,
+            'rtt_p50_us': round_trips.percentile(50),
+            'rtt_p99_us': round_trips.percentile(99),
+            'objects_per_msg': float(stopwatch.objects) / count,
+        }
+
+    def receive(self, shape, count):
+        dictionary = INBOUND_SHAPES[shape]
+        result = gevent.event.Event()
+        self.app.call('expectMessages', count, lambda: result.set())
+        with Stopwatch() as stopwatch:
+            for i in xrange(count):
+                self.service.deliver(APP_UUID, dictionary)
+                # Let the event loop keep up, as it would with a real transport.
+                if i % 64 == 0:
+                    gevent.sleep(0)
+            result.wait()
+        return {
+            'direction': 'receive',
+            'shape': shape,
+            'messages': count,
+            'failed': 0,
+            'msgs_per_sec': count / stopwatch.elapsed,
+            'rtt_p50_us': None,
+            'rtt_p99_us': None,
+            'objects_per_msg': float(stopwatch.objects) / count,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AppMessage throughput against a fake watch.")
+    parser.add_argument('-n', '--messages', default=2000, type=int, help="Messages per run.")
+    parser.add_argument('--ack-delay', default=0, type=float, help="Seconds before the fake watch acks a message.")
+    parser.add_argument('--window', default=4, type=int,
+                        help="AppMessages allowed in flight (0: as many as there are transaction ids).")
+    parser.add_argument('--shape', action='append', choices=INBOUND_SHAPES.keys(),
+                        help="Dictionary shape to test; may be repeated (default: all).")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    benchmark = AppMessageBenchmark(ack_delay=args.ack_delay, window=args.window)
+    benchmark.start()
+    results = []
+    try:
+        for shape in args.shape or INBOUND_SHAPES.keys():
+            results.append(benchmark.send(shape, args.messages))
+            results.append(benchmark.receive(shape, args.messages))
+    finally:
+        benchmark.stop()
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        headings = ['direction', 'shape', 'messages', 'failed', 'msgs/sec', 'rtt p50 (us)', 'rtt p99 (us)',
+                    'objects/msg']
+        rows = [[r['direction'], r['shape'], r['messages'], r['failed'], "%.0f" % r['msgs_per_sec'],
+                 r['rtt_p50_us'] if r['rtt_p50_us'] is not None else '-',
+                 r['rtt_p99_us'] if r['rtt_p99_us'] is not None else '-',
+                 "%.2f" % r['objects_per_msg']] for r in results]
+        print format_table(headings, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+"""
+Measures how fast binary data crosses between Python and JavaScript through the runtime/binary bridge, against the
+element-at-a-time conversions it replaced. Run it with `python -m pypkjs.benchmarks.binary`.
+"""
+__author__ = 'katharine'
+
+import argparse
+import json
+import logging
+import os
+
+import pypkjs.PyV8 as v8
+from pypkjs.javascript import binary
+from . import Stopwatch, format_table
+from .app import BenchmarkApp
+
+APP_SOURCE = """
+function makeBuffer(n) {
+    var array = new Uint8Array(n);
+    for (var i = 0; i < n; ++i) array[i] = i & 0xff;
+    return array.buffer;
+}
+"""
+
+SIZES = (64, 1024, 65536, 1048576, 10485760)
+
+
+def per_element_to_js(runtime, data):
+    # This is how XMLHttpRequest built arraybuffer responses before the bridge.
+    uint8_array = runtime.context.locals.Uint8Array
+    return uint8_array.create(uint8_array, (v8.JSArray(list(bytearray(data))),)).buffer
+
+
+def per_element_from_js(runtime, buffer):
+    # And this is how it read them back for send().
+    uint8_array = runtime.context.locals.Uint8Array
+    data_array = uint8_array.create(uint8_array, (buffer,))
+    return bytes(bytearray(data_array[str(x)] for x in xrange(data_array.length)))
+
+
+class BinaryBenchmark(object):
+    def __init__(self):
+        self.app = BenchmarkApp(APP_SOURCE)
+        self.runtime = self.app.runtime
+
+    def start(self):
+        self.app.start()
+
+    def stop(self):
+        self.app.stop()
+
+    def _time(self, fn, repeats):
+        def go():
+            with Stopwatch() as stopwatch:
+                for i in xrange(repeats):
+                    fn()
+            return stopwatch
+        # Conversions have to happen inside the runtime's context.
+        return self.app.run_in_loop(go)
+
+    def run(self, method, size, repeats):
+        data = os.urandom(size)
+        buffer = self.app.call('makeBuffer', size)
+        if method == 'bridge':
+            to_js = lambda: binary.bytes_to_buffer(self.runtime, data)
+            from_js = lambda: binary.buffer_to_bytes(self.runtime, buffer)
+        else:
+            to_js = lambda: per_element_to_js(self.runtime, data)
+            from_js = lambda: per_element_from_js(self.runtime, buffer)
+        results = []
+        for direction, fn in (('to js', to_js), ('from js', from_js)):
+            stopwatch = self._time(fn, repeats)
+            results.append({
+                'method': method,
+                'direction': direction,
+                'bytes': size,
+                'repeats': repeats,
+                'mb_per_sec': size * repeats / stopwatch.elapsed / 1048576,
+                'us_per_call': stopwatch.elapsed / repeats * 1000000,
+            })
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark moving binary data across the V8 boundary.")
+    parser.add_argument('--bytes', action='append', type=int,
+                        help="Size of each transfer; may be repeated (default: %s)." % ', '.join(map(str, SIZES)))
+    parser.add_argument('--total', default=1048576, type=int,
+                        help="Bytes to move per size and direction; smaller sizes are repeated to make this up, "
+                             "and larger ones are moved once.")
+    parser.add_argument('--skip-per-element', action='store_true',
+                        help="Only measure the bridge; the old conversions take a long time on the 10MB buffer.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    benchmark = BinaryBenchmark()
+    benchmark.start()
+    results = []
+    try:
+        for size in args.bytes or SIZES:
+            repeats = max(1, args.total // size)
+            results.extend(benchmark.run('bridge', size, repeats))
+            if not args.skip_per_element:
+                results.extend(benchmark.run('per-element', size, repeats))
+    finally:
+        benchmark.stop()
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        headings = ['method', 'direction', 'bytes', 'repeats', 'MB/sec', 'us/call']
+        rows = [[r['method'], r['direction'], r['bytes'], r['repeats'], "%.2f" % r['mb_per_sec'],
+                 "%.1f" % r['us_per_call']] for r in results]
+        print format_table(headings, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+"""
+Measures how long an app's script takes to compile with and without the code cache. Run it with
+`python -m pypkjs.benchmarks.code_cache [script.js]`; without a script, a large generated one is used.
+"""
+__author__ = 'katharine'
+
+import argparse
+import json
+import logging
+import shutil
+import tempfile
+
+from pypkjs.javascript.code_cache import CodeCache
+from . import Stopwatch, format_table
+from .app import APP_UUID, BenchmarkApp
+
+
+def generated_script(functions):
+    # Lots of small functions with bodies worth parsing, which is roughly the shape of a bundled app.
+    return '\n'.join("""
+function f%d(a, b) {
+    var result = [];
+    for (var i = 0; i < a.length; ++i) {
+        if (typeof a[i] === 'string') result.push(a[i] + b);
+        else result.push({index: i, value: a[i] * %d});
+    }
+    return result;
+}""" % (i, i) for i in xrange(functions))
+
+
+def run(src, repeats):
+    directory = tempfile.mkdtemp()
+    try:
+        app = BenchmarkApp('', code_cache=CodeCache(directory))
+        app.start()
+        runtime = app.runtime
+        try:
+            results = []
+
+            def compile_uncached():
+                runtime.code_cache, cache = None, runtime.code_cache
+                try:
+                    runtime.compile(src, 'benchmark.js')
+                finally:
+                    runtime.code_cache = cache
+
+            def compile_first():
+                runtime.code_cache.invalidate(APP_UUID)
+                runtime.compile(src, 'benchmark.js')
+
+            def compile_cached():
+                runtime.compile(src, 'benchmark.js')
+
+            for mode, fn in (('no cache', compile_uncached), ('cache miss', compile_first),
+                             ('cache hit', compile_cached)):
+                def go():
+                    with Stopwatch() as stopwatch:
+                        for i in xrange(repeats):
+                            fn()
+                    return stopwatch
+                stopwatch = app.run_in_loop(go)
+                results.append({
+                    'mode': mode,
+                    'bytes': len(src),
+                    'compiles': repeats,
+                    'ms_per_compile': stopwatch.elapsed / repeats * 1000,
+                })
+            return results
+        finally:
+            app.stop()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compiling app scripts with and without the code cache.")
+    parser.add_argument('script', nargs='?', help="JavaScript to compile (default: a generated script).")
+    parser.add_argument('--functions', default=2000, type=int, help="Functions in the generated script.")
+    parser.add_argument('-n', '--compiles', default=20, type=int, help="Compiles per mode.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.script is not None:
+        with open(args.script) as f:
+            src = f.read()
+    else:
+        src = generated_script(args.functions)
+    results = run(src, args.compiles)
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        headings = ['mode', 'bytes', 'compiles', 'ms/compile']
+        rows = [[r['mode'], r['bytes'], r['compiles'], "%.2f" % r['ms_per_compile']] for r in results]
+        print format_table(headings, rows)
+
+
+if __name__ == '__main__':
+    main()
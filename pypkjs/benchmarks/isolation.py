@@ -0,0 +1,213 @@
+from __future__ import absolute_import
+"""
+Measures how much a CPU-heavy app delays the packets pypkjs relays between the phone and the watch, with the app's
+JavaScript running in pypkjs's own process and in a worker process (--js-worker). Run it with
+`python -m pypkjs.benchmarks.isolation`.
+"""
+__author__ = 'katharine'
+
+import argparse
+import gevent
+import gevent.event
+import gevent.socket
+import json
+import logging
+import time
+
+from pypkjs.javascript.metrics import Histogram
+from pypkjs.runner import Runner
+from pypkjs.runner.worker import WorkerRuntime
+from . import format_table
+from .app import APP_UUID, BenchmarkApp, FakeAppMessageService, FakeRunner, FakeWatch
+
+# Every `period` ms, spin for `busy` ms; then tell the benchmark it's running.
+APP_SOURCE = """
+var BUSY = %(busy)d, PERIOD = %(period)d;
+function spin() {
+    var end = Date.now() + BUSY;
+    while (Date.now() < end);
+}
+Pebble.addEventListener('ready', function() {
+    if (BUSY > 0) setInterval(spin, PERIOD);
+    Pebble.sendAppMessage({0: 1});
+});
+"""
+
+
+class ReadyAppMessageService(FakeAppMessageService):
+    # Notes when the app sends its first message, which it does once it's up and running.
+    def __init__(self):
+        super(ReadyAppMessageService, self).__init__()
+        self.ready = gevent.event.Event()
+
+    def send_message(self, target_app, dictionary):
+        self.ready.set()
+        return super(ReadyAppMessageService, self).send_message(target_app, dictionary)
+
+
+class _Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class WorkerWatch(FakeWatch):
+    watch_info = _Namespace(running=_Namespace(hardware_platform='snowy_dvt'), language='en_US')
+    firmware_version = _Namespace(major=3, minor=8, patch=0, suffix='')
+
+    def send_raw(self, message):
+        pass
+
+
+class WorkerManager(object):
+    def __init__(self):
+        self.pebble = WorkerWatch()
+        self.blobdb = None
+        self.watch_model = None
+
+    def is_glance_current(self, app_uuid, digest, now):
+        return False
+
+    def record_glance(self, app_uuid, digest, expires):
+        pass
+
+
+class WorkerRunner(FakeRunner):
+    # The settings WorkerRuntime passes on to its worker, at the Runner's defaults.
+    persist_dir = None
+    block_private_addresses = False
+    js_callback_budget = None
+    js_script_budget = None
+    oauth_token = None
+    account_token = None
+    watch_token = None
+    layout_file = None
+    appmessage_window = 4
+    appmessage_timeout = 10.0
+    api = _Namespace(pool_size=10, connect_timeout=5.0, read_timeout=30.0)
+    notification_rate = 2.0
+    notification_dedupe_window = 5.0
+    localstorage_durability = 'batched'
+    localstorage_flush_interval = 1.0
+    localstorage_quota = 5242880
+    xhr_max_response_size = 16777216
+    http_cache_size = 0
+    virtual_time = False
+
+    def __init__(self, appmessage):
+        super(WorkerRunner, self).__init__(appmessage)
+        self.pebble = WorkerManager()
+
+
+class InProcessApp(object):
+    def __init__(self, source):
+        self.appmessage = ReadyAppMessageService()
+        self.app = BenchmarkApp(source, appmessage=self.appmessage)
+
+    def start(self):
+        self.app.start()
+        self.appmessage.ready.wait()
+
+    def stop(self):
+        self.app.stop()
+
+
+class WorkerApp(object):
+    def __init__(self, source):
+        self.source = source
+        self.appmessage = ReadyAppMessageService()
+        pbw = Runner.PBW(APP_UUID, source, {'appKeys': {}, 'capabilities': []}, {}, None)
+        self.runtime = WorkerRuntime(WorkerRunner(self.appmessage), pbw)
+        self.runtime.log_output = lambda m: logging.info("JS: %s", m)
+        self._greenlet = None
+
+    def start(self):
+        self._greenlet = gevent.spawn(self.runtime.run, self.source, "benchmark.js")
+        self.appmessage.ready.wait()
+
+    def stop(self):
+        self.runtime.stop()
+        self._greenlet.join()
+
+
+class RelayProbe(object):
+    """
+    Stands in for the packets pypkjs relays between the phone websocket and the watch connection. Every `interval`
+    seconds a packet is due, and its latency is how long after that it comes out of the far side of a relay greenlet.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.latency = Histogram()  # in microseconds
+
+    def run(self, duration):
+        phone, relay_in = gevent.socket.socketpair()
+        relay_out, watch = gevent.socket.socketpair()
+
+        def relay():
+            while True:
+                data = relay_in.recv(4096)
+                if not data:
+                    break
+                relay_out.sendall(data)
+        relay_greenlet = gevent.spawn(relay)
+        try:
+            started = time.time()
+            due = started
+            while due < started + duration:
+                gevent.sleep(max(0, due - time.time()))
+                phone.sendall('x')
+                watch.recv(1)
+                self.latency.record((time.time() - due) * 1000000)
+                due += self.interval
+        finally:
+            relay_greenlet.kill()
+            for sock in (phone, relay_in, relay_out, watch):
+                sock.close()
+
+
+def run(isolation, busy_ms, period_ms, duration, interval):
+    source = APP_SOURCE % {'busy': busy_ms, 'period': period_ms}
+    app = WorkerApp(source) if isolation == 'worker' else InProcessApp(source)
+    app.start()
+    try:
+        probe = RelayProbe(interval)
+        probe.run(duration)
+    finally:
+        app.stop()
+    return {
+        'isolation': isolation,
+        'busy_ms': busy_ms,
+        'period_ms': period_ms,
+        'packets': probe.latency.count,
+        'latency_p50_us': probe.latency.percentile(50),
+        'latency_p99_us': probe.latency.percentile(99),
+        'latency_max_us': probe.latency.max,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark relay latency under a CPU-heavy app, with and without "
+                                                 "running its JavaScript in a worker process.")
+    parser.add_argument('--busy', default=50, type=int, help="Milliseconds of CPU the app burns each period.")
+    parser.add_argument('--period', default=100, type=int, help="How often the app burns CPU, in milliseconds.")
+    parser.add_argument('--duration', default=5.0, type=float, help="Seconds to measure for in each mode.")
+    parser.add_argument('--interval', default=0.01, type=float, help="Seconds between relayed packets.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = []
+    for isolation in ('none', 'worker'):
+        for busy_ms in (0, args.busy):
+            results.append(run(isolation, busy_ms, args.period, args.duration, args.interval))
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        headings = ['isolation', 'busy ms', 'period ms', 'packets', 'p50 (us)', 'p99 (us)', 'max (us)']
+        rows = [[r['isolation'], r['busy_ms'], r['period_ms'], r['packets'], r['latency_p50_us'],
+                 r['latency_p99_us'], r['latency_max_us']] for r in results]
+        print format_table(headings, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+"""
+Compares localStorage backends: the log store, written per change and in batches, against the dumbdbm files it
+replaced. Run it with
+`python -m pypkjs.benchmarks.localstorage`.
+"""
+__author__ = 'katharine'
+
+import argparse
+import dumbdbm
+import json
+import os.path
+import shutil
+import tempfile
+
+from pypkjs.javascript.logstore import LogStore
+from . import Stopwatch, format_table
+
+
+class DumbDBMBackend(object):
+    name = 'dumbdbm'
+
+    def __init__(self, directory):
+        self.store = dumbdbm.open(os.path.join(directory, 'dumbdbm'), 'c')
+
+    def key(self, index):
+        # This is what LocalStorage.key used to do.
+        return self.store.keys()[index]
+
+
+class LogStoreBackend(object):
+    name = 'logstore'
+    durability = LogStore.PER_WRITE
+
+    def __init__(self, directory):
+        self.store = LogStore(os.path.join(directory, 'logstore.log'), durability=self.durability)
+
+    def key(self, index):
+        return self.store.key_at(index)
+
+
+class BatchedLogStoreBackend(LogStoreBackend):
+    name = 'logstore (batched)'
+    durability = LogStore.BATCHED
+
+
+def run(backend_class, count):
+    directory = tempfile.mkdtemp()
+    try:
+        backend = backend_class(directory)
+        store = backend.store
+        results = []
+        with Stopwatch() as stopwatch:
+            for i in xrange(count):
+                store['key%d' % i] = 'value %d' % i
+            # Batched changes don't count until they're on disk.
+            if hasattr(store, 'flush'):
+                store.flush()
+        results.append(('set', stopwatch))
+        with Stopwatch() as stopwatch:
+            for i in xrange(count):
+                store.get('key%d' % i)
+        results.append(('get', stopwatch))
+        with Stopwatch() as stopwatch:
+            for i in xrange(count):
+                backend.key(i)
+        results.append(('key', stopwatch))
+        store.close()
+        return [{
+            'backend': backend.name,
+            'operation': operation,
+            'operations': count,
+            'ops_per_sec': count / stopwatch.elapsed,
+            'total_ms': stopwatch.elapsed * 1000,
+        } for operation, stopwatch in results]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark localStorage backends.")
+    parser.add_argument('-n', '--operations', default=10000, type=int, help="Operations of each kind per backend.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    args = parser.parse_args()
+
+    results = []
+    for backend in (DumbDBMBackend, LogStoreBackend, BatchedLogStoreBackend):
+        results.extend(run(backend, args.operations))
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        headings = ['backend', 'operation', 'operations', 'ops/sec', 'total (ms)']
+        rows = [[r['backend'], r['operation'], r['operations'], "%.0f" % r['ops_per_sec'], "%.1f" % r['total_ms']]
+                for r in results]
+        print format_table(headings, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+"""
+Compares the two ways pypkjs wraps native objects for JavaScript: wrappers built on every instance, as XMLHttpRequest
+and WebSocket used to be, and wrappers built once on the prototype, as they are now. Run it with
+`python -m pypkjs.benchmarks.proxy`.
+"""
+__author__ = 'katharine'
+
+import argparse
+import json
+import logging
+
+from . import Stopwatch, format_table
+from .app import BenchmarkApp
+
+# The same methods and properties that XMLHttpRequest exposes.
+APP_SOURCE = """
+var METHODS = ['open', 'setRequestHeader', 'overrideMimeType', 'send', 'getResponseHeader', 'getAllResponseHeaders',
+               'abort', 'addEventListener', 'removeEventListener'];
+var PROPERTIES = ['readyState', 'response', 'responseText', 'responseType', 'status', 'statusText', 'timeout',
+                  'onreadystatechange', 'ontimeout', 'onload', 'onloadstart', 'onloadend', 'onprogress', 'onerror',
+                  'onabort'];
+var makeOrigin = null;
+
+function PerInstance() {
+    var origin = makeOrigin();
+    _make_proxies(this, origin, METHODS);
+    _make_properties(this, origin, PROPERTIES);
+}
+
+function Prototype() {
+    _set_origin(this, makeOrigin());
+}
+_make_prototype_proxies(Prototype.prototype, METHODS);
+_make_prototype_properties(Prototype.prototype, PROPERTIES);
+
+var classes = {'per-instance': PerInstance, 'prototype': Prototype, 'XMLHttpRequest': XMLHttpRequest};
+
+function construct(name, n) {
+    var cls = classes[name];
+    for (var i = 0; i < n; ++i) new cls();
+}
+function callMethod(name, n) {
+    var x = new classes[name]();
+    for (var i = 0; i < n; ++i) x.getResponseHeader('Content-Type');
+}
+function readProperty(name, n) {
+    var x = new classes[name]();
+    for (var i = 0; i < n; ++i) x.readyState;
+}
+"""
+
+CLASSES = ('per-instance', 'prototype', 'XMLHttpRequest')
+OPERATIONS = (('construct', 'construct'), ('call', 'callMethod'), ('property', 'readProperty'))
+
+
+class FakeNative(object):
+    # Stands in for the native XMLHttpRequest, so the wrappers are all that's being measured.
+    readyState = 0
+    response = None
+    responseText = ''
+    responseType = ''
+    status = 0
+    statusText = ''
+    timeout = 0
+    onreadystatechange = ontimeout = onload = onloadstart = onloadend = onprogress = onerror = onabort = None
+
+    def open(self, *args):
+        pass
+
+    def setRequestHeader(self, *args):
+        pass
+
+    def overrideMimeType(self, *args):
+        pass
+
+    def send(self, *args):
+        pass
+
+    def getResponseHeader(self, *args):
+        return None
+
+    def getAllResponseHeaders(self, *args):
+        return ''
+
+    def abort(self, *args):
+        pass
+
+    def addEventListener(self, *args):
+        pass
+
+    def removeEventListener(self, *args):
+        pass
+
+
+class ProxyBenchmark(object):
+    def __init__(self):
+        self.app = BenchmarkApp(APP_SOURCE)
+
+    def start(self):
+        self.app.start()
+        self.app.run_in_loop(lambda: setattr(self.app.runtime.context.locals, 'makeOrigin', FakeNative))
+
+    def stop(self):
+        self.app.stop()
+
+    def run(self, cls, operation, count):
+        function = dict(OPERATIONS)[operation]
+        with Stopwatch() as stopwatch:
+            self.app.call(function, cls, count)
+        return {
+            'class': cls,
+            'operation': operation,
+            'operations': count,
+            'ops_per_sec': count / stopwatch.elapsed,
+            'objects_per_op': float(stopwatch.objects) / count,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-instance and prototype wrappers for native objects.")
+    parser.add_argument('-n', '--operations', default=10000, type=int, help="Operations of each kind per class.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    benchmark = ProxyBenchmark()
+    benchmark.start()
+    results = []
+    try:
+        for operation, function in OPERATIONS:
+            for cls in CLASSES:
+                results.append(benchmark.run(cls, operation, args.operations))
+    finally:
+        benchmark.stop()
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        headings = ['class', 'operation', 'operations', 'ops/sec', 'objects/op']
+        rows = [[r['class'], r['operation'], r['operations'], "%.0f" % r['ops_per_sec'], "%.2f" % r['objects_per_op']]
+                for r in results]
+        print format_table(headings, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+"""
+Measures the cost of JavaScript timers: how fast they can be armed, how many greenlets they hold while pending, and how
+late they fire. Run it with `python -m pypkjs.benchmarks.timers`.
+"""
+__author__ = 'katharine'
+
+import argparse
+import gc
+import gevent.event
+import greenlet
+import json
+import logging
+
+from pypkjs.javascript.metrics import Histogram
+from . import Stopwatch, format_table
+from .app import BenchmarkApp
+
+# Delays are spread evenly over the range, so the scheduler has to keep them in order.
+APP_SOURCE = """
+var pending = 0, intervals = [];
+function armTimeouts(n, maxDelay, report, done) {
+    pending = n;
+    for (var i = 0; i < n; ++i) {
+        (function(delay) {
+            var due = performance.now() + Math.max(delay, 4);
+            setTimeout(function() {
+                report(performance.now() - due);
+                if (--pending == 0) done();
+            }, delay);
+        })((i * 7919) % maxDelay);
+    }
+}
+function armIntervals(n, period, ticks, report, done) {
+    pending = n * ticks;
+    for (var i = 0; i < n; ++i) {
+        (function() {
+            var due = performance.now() + period, count = 0;
+            var id = setInterval(function() {
+                report(performance.now() - due);
+                due += period;
+                if (++count == ticks) clearInterval(id);
+                if (--pending == 0) done();
+            }, period);
+        })();
+    }
+}
+function armAndClear(n) {
+    for (var i = 0; i < n; ++i) {
+        clearTimeout(setTimeout(function() {}, 60000));
+    }
+}
+"""
+
+
+def count_greenlets():
+    return sum(1 for x in gc.get_objects() if isinstance(x, greenlet.greenlet))
+
+
+class TimerBenchmark(object):
+    def __init__(self):
+        self.app = BenchmarkApp(APP_SOURCE)
+
+    def start(self):
+        self.app.start()
+
+    def stop(self):
+        self.app.stop()
+
+    def _run(self, kind, count, arm):
+        # Lateness is reported in microseconds.
+        lateness = Histogram()
+        done = gevent.event.Event()
+        greenlets_before = count_greenlets()
+        with Stopwatch() as stopwatch:
+            arm(lambda ms: lateness.record(ms * 1000), lambda: done.set())
+        pending_greenlets = count_greenlets() - greenlets_before
+        done.wait()
+        return {
+            'kind': kind,
+            'timers': count,
+            'arm_per_sec': count / stopwatch.elapsed,
+            'pending_greenlets': pending_greenlets,
+            'late_p50_us': lateness.percentile(50),
+            'late_p99_us': lateness.percentile(99),
+            'late_max_us': lateness.max,
+        }
+
+    def timeouts(self, count, max_delay_ms):
+        return self._run('setTimeout', count,
+                         lambda report, done: self.app.call('armTimeouts', count, max_delay_ms, report, done))
+
+    def intervals(self, count, period_ms, ticks):
+        return self._run('setInterval', count,
+                         lambda report, done: self.app.call('armIntervals', count, period_ms, ticks, report, done))
+
+    def arm_and_clear(self, count):
+        with Stopwatch() as stopwatch:
+            self.app.call('armAndClear', count)
+        return {
+            'kind': 'set+clearTimeout',
+            'timers': count,
+            'arm_per_sec': count / stopwatch.elapsed,
+            'pending_greenlets': None,
+            'late_p50_us': None,
+            'late_p99_us': None,
+            'late_max_us': None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JavaScript timers.")
+    parser.add_argument('-n', '--timers', default=10000, type=int, help="Timers per run.")
+    parser.add_argument('--max-delay', default=2000, type=int, help="Longest setTimeout delay, in milliseconds.")
+    parser.add_argument('--interval', default=100, type=int, help="setInterval period, in milliseconds.")
+    parser.add_argument('--ticks', default=5, type=int, help="Times each interval fires before it's cleared.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    benchmark = TimerBenchmark()
+    benchmark.start()
+    try:
+        results = [
+            benchmark.timeouts(args.timers, args.max_delay),
+            benchmark.intervals(args.timers, args.interval, args.ticks),
+            benchmark.arm_and_clear(args.timers),
+        ]
+    finally:
+        benchmark.stop()
+
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        headings = ['kind', 'timers', 'armed/sec', 'greenlets', 'late p50 (us)', 'late p99 (us)', 'late max (us)']
+        rows = [[r['kind'], r['timers'], "%.0f" % r['arm_per_sec']] +
+                [r[k] if r[k] is not None else '-'
+                 for k in ('pending_greenlets', 'late_p50_us', 'late_p99_us', 'late_max_us')] for r in results]
+        print format_table(headings, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import contextlib
+import gevent
+import gevent.event
+import heapq
+import itertools
+import time
+
+
+class Clock(object):
+    is_virtual = False
+
+    def time(self):
+        return time.time()
+
+    def wait(self, event, timeout=None):
+        event.wait(timeout)
+
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    @contextlib.contextmanager
+    def busy(self):
+        # Marks real work (such as a network request) that a virtual clock must not skip past.
+        yield
+
+
+class VirtualClock(Clock):
+    """
+    A clock for one runtime that skips the time its JS spends idle. When `idle_check` says the runtime has nothing to do,
+    nothing is marked busy and the gevent loop is idle, time jumps straight to the earliest pending deadline and wakes
+    whoever was waiting for it, so hours of timers run in moments. Otherwise it keeps pace with real time.
+    """
+    is_virtual = True
+    # How often to look again, in real seconds, while the clock can't jump.
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, start=None, idle_check=None):
+        self._now = time.time() if start is None else start
+        self.idle_check = idle_check
+        self._busy = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._has_waiters = gevent.event.Event()
+        self._advancer = None
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+    @contextlib.contextmanager
+    def busy(self):
+        self._busy += 1
+        try:
+            yield
+        finally:
+            self._busy -= 1
+
+    def _can_jump(self):
+        return not self._busy and (self.idle_check is None or self.idle_check())
+
+    def _advance(self):
+        while True:
+            gevent.idle()
+            while self._waiters and self._waiters[0][3]:
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                self._has_waiters.clear()
+                self._has_waiters.wait()
+                continue
+            deadline = self._waiters[0][0]
+            if not self._can_jump():
+                started = time.time()
+                gevent.sleep(max(0, min(self.POLL_INTERVAL, deadline - self._now)))
+                self._now += time.time() - started
+                if self._now < deadline:
+                    continue
+            deadline, _, wakeup, _ = heapq.heappop(self._waiters)
+            self._now = max(self._now, deadline)
+            wakeup.set()
+
+    def wait(self, event, timeout=None):
+        if timeout is None:
+            event.wait()
+            return
+        # [deadline, tiebreaker, wakeup, cancelled]
+        entry = [self._now + timeout, next(self._counter), gevent.event.Event(), False]
+        heapq.heappush(self._waiters, entry)
+        self._has_waiters.set()
+        if self._advancer is None:
+            self._advancer = gevent.spawn(self._advance)
+        try:
+            gevent.wait([event, entry[2]], count=1)
+        finally:
+            entry[3] = True
+
+    def sleep(self, seconds):
+        self.wait(gevent.event.Event(), seconds)
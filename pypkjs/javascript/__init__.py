@@ -9,6 +9,7 @@ from .pebble import Pebble
 from .xhr import prepare_xhr
 from .navigator import Navigator
 from .ws import prepare_ws
+from .date import prepare_date
 
 
 class PebbleKitJS(object):
@@ -29,11 +30,20 @@ class PebbleKitJS(object):
     def get_extension_names(self):
         return [x.extension.name for x in self.extensions] + ["runtime/events/progress", "runtime/xhr", "runtime/ws",
                                                               "runtime/geolocation/position",
-                                                              "runtime/geolocation/coordinates"]
+                                                              "runtime/geolocation/coordinates",
+                                                              "runtime/date"]
+
+    def bind(self):
+        # Called once the runtime has been given an app; nothing before this point may depend on which app it is.
+        self.local_storage._bind()
+        self.pebble._bind()
 
     def do_post_setup(self):
+        for extension in self.extensions:
+            extension._prepare()
         prepare_xhr(self.runtime)
         prepare_ws(self.runtime)
+        prepare_date(self.runtime)
 
     def shutdown(self):
         self.local_storage._shutdown()
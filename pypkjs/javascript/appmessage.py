@@ -0,0 +1,252 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import collections
+import gevent.event
+import logging
+
+import pypkjs.PyV8 as v8
+from libpebble2.services.appmessage import CString, Int32, ByteArray
+
+from . import binary
+from .exceptions import JSRuntimeException
+
+logger = logging.getLogger('pypkjs.javascript.appmessage')
+
+# Builds an AppMessage payload object from parallel arrays of names and values.
+extension = v8.JSExtension("runtime/appmessage", """
+    function _make_appmessage_payload(names, values) {
+        var payload = {};
+        for (var i = 0, l = names.length; i < l; ++i) {
+            payload[names[i]] = values[i];
+        }
+        return payload;
+    }
+""", dependencies=["runtime/binary"])
+
+
+class AppMessageCodec(object):
+    """
+    Converts AppMessage dictionaries between JavaScript and the watch for one app. The key maps are worked out once,
+    when the codec is built, rather than on every message.
+    """
+    def __init__(self, runtime, app_keys):
+        self.runtime = runtime
+        self.app_keys = dict(app_keys)
+        self.key_names = {v: str(k) for k, v in self.app_keys.iteritems()}
+        # JS property name -> numeric key; numeric names are added as they're seen.
+        self._keys = {str(k): v for k, v in self.app_keys.iteritems()}
+        self._encoders = {
+            str: self._encode_str,
+            unicode: self._encode_unicode,
+            int: self._encode_int,
+            long: self._encode_int,
+            bool: self._encode_int,
+            float: self._encode_float,
+            v8.JSArray: self._encode_js_array,
+            list: self._encode_bytes,
+            type(None): self._encode_none,
+        }
+
+    def key_for(self, name):
+        try:
+            return self._keys[name]
+        except KeyError:
+            pass
+        try:
+            key = int(name)
+        except ValueError:
+            raise JSRuntimeException("Unknown message key '%s'" % name)
+        self._keys[name] = key
+        return key
+
+    def encode(self, message):
+        encoders = self._encoders
+        result = {}
+        for name in message.keys():
+            name = str(name)
+            key = self.key_for(name)
+            value = message[name]
+            encoder = encoders.get(type(value))
+            if encoder is None:
+                encoder = self._encode_other
+            value = encoder(key, value)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def _encode_str(self, key, value):
+        return CString(value.decode('utf-8'))
+
+    def _encode_unicode(self, key, value):
+        return CString(value)
+
+    def _encode_int(self, key, value):
+        return Int32(value)
+
+    def _encode_float(self, key, value):  # thanks, javascript
+        try:
+            return Int32(int(round(value)))
+        except ValueError:
+            self.runtime.log_output("WARNING: illegal float value %s for appmessage key %s" % (value, key))
+            return Int32(0)
+
+    def _encode_none(self, key, value):
+        return None
+
+    def _encode_js_array(self, key, value):
+        data = binary.array_to_bytes(self.runtime, value)
+        if data is not None:
+            return ByteArray(data)
+        return self._encode_bytes(key, value)
+
+    def _encode_bytes(self, key, value):
+        b = bytearray()
+        for byte in value:
+            if isinstance(byte, int):
+                if 0 <= byte <= 255:
+                    b.append(byte)
+                else:
+                    raise JSRuntimeException("Bytes must be between 0 and 255 inclusive.")
+            elif isinstance(byte, str):  # This is intentionally not basestring; unicode won't work.
+                b.extend(bytearray(byte))
+            else:
+                raise JSRuntimeException("Unexpected value in byte array.")
+        return ByteArray(bytes(b))
+
+    def _encode_other(self, key, value):
+        if isinstance(value, basestring):
+            return self._encode_unicode(key, value if isinstance(value, unicode) else value.decode('utf-8'))
+        elif isinstance(value, (int, long)):
+            return self._encode_int(key, value)
+        elif isinstance(value, float):
+            return self._encode_float(key, value)
+        elif isinstance(value, v8.JSArray):
+            return self._encode_js_array(key, value)
+        elif isinstance(value, collections.Sequence):
+            return self._encode_bytes(key, value)
+        elif binary.is_binary(value):
+            return ByteArray(binary.buffer_to_bytes(self.runtime, value))
+        raise JSRuntimeException("Invalid value data type for key %s: %s" % (key, type(value)))
+
+    def decode(self, dictionary):
+        names = []
+        values = []
+        key_names = self.key_names
+        for k, v in dictionary.iteritems():
+            if isinstance(v, bytearray):
+                v = binary.bytes_to_array(self.runtime, v)
+            elif not isinstance(v, (int, long, basestring)):
+                raise JSRuntimeException("Unexpected AppMessage value for key %s: %s" % (k, type(v)))
+            names.append(str(k))
+            values.append(v)
+            if k in key_names:
+                names.append(key_names[k])
+                values.append(v)
+        return self.runtime.context.locals._make_appmessage_payload(v8.JSArray(names), v8.JSArray(values))
+
+
+class _Transaction(object):
+    __slots__ = ('tid', 'dictionary', 'success', 'failure', 'sent')
+
+    def __init__(self, dictionary, success, failure):
+        self.tid = None
+        self.dictionary = dictionary
+        self.success = success
+        self.failure = failure
+        self.sent = None
+
+
+class AppMessagePipeline(object):
+    """
+    Sends one app's AppMessages to the watch. At most `window` messages await a response at once (as many as there are
+    transaction ids if it's zero); the rest wait their turn in order. A message that is neither acked nor nacked within
+    `timeout` seconds (if set) is failed and forgotten.
+    """
+    # Transaction ids are a single byte; any more in flight than this and a reused id would clobber a live one.
+    MAX_WINDOW = 255
+
+    def __init__(self, runtime, service, uuid, window=4, timeout=10.0, metrics=None):
+        self.runtime = runtime
+        self.service = service
+        self.uuid = uuid
+        self.window = min(window, self.MAX_WINDOW) if window > 0 else self.MAX_WINDOW
+        self.timeout = timeout
+        self.metrics = metrics
+        self.in_flight = collections.OrderedDict()  # tid -> _Transaction, oldest first.
+        self.backlog = collections.deque()
+        self._wakeup = gevent.event.Event()
+        self._reaper = None
+
+    @property
+    def depth(self):
+        return len(self.in_flight) + len(self.backlog)
+
+    def send(self, dictionary, success=None, failure=None):
+        self.backlog.append(_Transaction(dictionary, success, failure))
+        if self.metrics is not None:
+            self.metrics.record_depth(self.depth)
+        self._pump()
+
+    def _pump(self):
+        while self.backlog and len(self.in_flight) < self.window:
+            transaction = self.backlog.popleft()
+            transaction.sent = self.runtime.clock.time()
+            transaction.tid = self.service.send_message(self.uuid, transaction.dictionary)
+            self.in_flight[transaction.tid] = transaction
+            if self.metrics is not None:
+                self.metrics.sent += 1
+            if not self.timeout:
+                continue
+            if self._reaper is None:
+                self._reaper = self.runtime.group.spawn(self._reap)
+            elif len(self.in_flight) == 1:
+                self._wakeup.set()
+
+    def handle_response(self, tid, did_succeed):
+        transaction = self.in_flight.pop(tid, None)
+        if transaction is None:
+            return
+        if self.metrics is not None:
+            self.metrics.record_response(transaction.sent, self.runtime.clock.time(), did_succeed)
+        self._respond(transaction, transaction.success if did_succeed else transaction.failure)
+        self._pump()
+
+    def _respond(self, transaction, callback, error=None):
+        if callable(callback):
+            callback_param = {"data": {"transactionId": transaction.tid}}
+            if error is not None:
+                callback_param["error"] = {"message": error}
+            self.runtime.enqueue_from('pebble', callback, callback_param)
+
+    def _reap(self):
+        # Every message has the same timeout, so the oldest one in flight is always the next to expire.
+        clock = self.runtime.clock
+        while True:
+            self._wakeup.clear()
+            if not self.in_flight:
+                self._wakeup.wait()
+                continue
+            now = clock.time()
+            expired = False
+            while self.in_flight:
+                tid, transaction = next(self.in_flight.iteritems())
+                if transaction.sent + self.timeout > now:
+                    break
+                del self.in_flight[tid]
+                expired = True
+                logger.warning("AppMessage %d to %s timed out after %ss.", tid, self.uuid, self.timeout)
+                if self.metrics is not None:
+                    self.metrics.timed_out += 1
+                self._respond(transaction, transaction.failure, "Timed out")
+            if expired:
+                self._pump()
+            elif self.in_flight:
+                clock.wait(self._wakeup, transaction.sent + self.timeout - now)
+
+    def close(self):
+        if self._reaper is not None:
+            self._reaper.kill(block=False)
+            self._reaper = None
+        self.in_flight.clear()
+        self.backlog.clear()
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import pypkjs.PyV8 as v8
+
+# PyV8 can't share memory with an ArrayBuffer, and converting a list crosses the V8 boundary once per element.
+# Instead, bytes travel as a single string with one character per byte (i.e. latin-1), and are unpacked into or out
+# of a Uint8Array on the JavaScript side in one call.
+extension = v8.JSExtension("runtime/binary", """
+    function _bytes_view(data) {
+        if (data instanceof ArrayBuffer) {
+            return new Uint8Array(data);
+        }
+        if (data && data.buffer instanceof ArrayBuffer) {
+            return new Uint8Array(data.buffer, data.byteOffset, data.byteLength);
+        }
+        return null;
+    }
+    function _bytes_to_buffer(s) {
+        var l = s.length;
+        var array = new Uint8Array(l);
+        for (var i = 0; i < l; ++i) {
+            array[i] = s.charCodeAt(i);
+        }
+        return array.buffer;
+    }
+    function _bytes_to_array(s) {
+        var l = s.length;
+        var array = new Array(l);
+        for (var i = 0; i < l; ++i) {
+            array[i] = s.charCodeAt(i);
+        }
+        return array;
+    }
+    function _view_to_bytes(array) {
+        // fromCharCode.apply is much faster than a loop, but has to be chunked to keep within the argument limit.
+        var chunks = [];
+        for (var i = 0, l = array.length; i < l; i += 8192) {
+            chunks.push(String.fromCharCode.apply(null, array.subarray ? array.subarray(i, i + 8192)
+                                                                       : array.slice(i, i + 8192)));
+        }
+        return chunks.join('');
+    }
+    function _buffer_to_bytes(data) {
+        var array = _bytes_view(data);
+        return array === null ? null : _view_to_bytes(array);
+    }
+    function _array_to_bytes(array) {
+        // Only plain arrays of integers in [0, 255] take the fast path; anything else returns null.
+        for (var i = 0, l = array.length; i < l; ++i) {
+            var b = array[i];
+            if (typeof b !== 'number' || b < 0 || b > 255 || b % 1 !== 0) {
+                return null;
+            }
+        }
+        return _view_to_bytes(array);
+    }
+""")
+
+TYPED_ARRAY_NAMES = frozenset(['[object %s]' % x for x in (
+    'ArrayBuffer', 'Float32Array', 'Float64Array', 'Int16Array', 'Int32Array', 'Int8Array', 'Uint16Array',
+    'Uint32Array', 'Uint8Array', 'Uint8ClampedArray')])
+
+
+def _from_js_string(s):
+    # PyV8 hands strings back UTF-8 encoded; each character is really a byte.
+    if not isinstance(s, unicode):
+        s = s.decode('utf-8')
+    return s.encode('latin-1')
+
+
+def is_binary(value):
+    return not isinstance(value, basestring) and str(value) in TYPED_ARRAY_NAMES
+
+
+def bytes_to_buffer(runtime, data):
+    return runtime.context.locals._bytes_to_buffer(bytes(data).decode('latin-1'))
+
+
+def bytes_to_array(runtime, data):
+    return runtime.context.locals._bytes_to_array(bytes(data).decode('latin-1'))
+
+
+def buffer_to_bytes(runtime, data):
+    """
+    Returns the contents of an ArrayBuffer or typed array (respecting its offset and length) as a str.
+    """
+    result = runtime.context.locals._buffer_to_bytes(data)
+    if result is None:
+        raise TypeError("Expected an ArrayBuffer or typed array.")
+    return _from_js_string(result)
+
+
+def array_to_bytes(runtime, array):
+    """
+    Returns a JavaScript array of byte values as a str, or None if it contains anything else.
+    """
+    result = runtime.context.locals._array_to_bytes(array)
+    if result is None:
+        return None
+    return _from_js_string(result)
@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+
+logger = logging.getLogger("pypkjs.javascript.code_cache")
+
+
+class CodeCache(object):
+    # Stores V8 precompilation data for app scripts, keyed by app UUID and a hash of the source.
+    # Without a persist directory, entries are kept in memory for the life of the process.
+    def __init__(self, persist_dir=None):
+        if persist_dir is not None:
+            self.path = os.path.join(persist_dir, 'code_cache')
+        else:
+            self.path = None
+        self._memory = {}
+
+    @staticmethod
+    def _source_hash(src):
+        if isinstance(src, unicode):
+            src = src.encode('utf-8')
+        return hashlib.sha1(src).hexdigest()
+
+    def _entry_path(self, uuid, src):
+        return os.path.join(self.path, str(uuid), self._source_hash(src))
+
+    def load(self, uuid, src):
+        if self.path is None:
+            return self._memory.get((str(uuid), self._source_hash(src)))
+        try:
+            with open(self._entry_path(uuid, src), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Couldn't read code cache for %s: %s", uuid, e)
+            return None
+
+    def store(self, uuid, src, data):
+        data = bytes(data)
+        if self.path is None:
+            self._memory[(str(uuid), self._source_hash(src))] = data
+            return
+        path = self._entry_path(uuid, src)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logger.warning("Couldn't write code cache for %s: %s", uuid, e)
+
+    def invalidate(self, uuid):
+        if self.path is None:
+            for key in [k for k in self._memory if k[0] == str(uuid)]:
+                del self._memory[key]
+            return
+        shutil.rmtree(os.path.join(self.path, str(uuid)), ignore_errors=True)
@@ -5,14 +5,19 @@ import pypkjs.PyV8 as v8
 
 
 class Console(object):
+    extension = v8.JSExtension("runtime/console", """
+    _init_console = function(origin) {
+        this.console = new (function () {
+            _make_proxies(this, origin, ['log', 'warn', 'info', 'error']);
+        })();
+    };
+    """, dependencies=["runtime/internal/proxy"])
+
     def __init__(self, runtime):
         self.runtime = runtime
-        self.extension = v8.JSExtension(self.runtime.ext_name("console"), """
-        console = new (function () {
-            native function _internal_console();
-            _make_proxies(this, _internal_console(), ['log', 'warn', 'info', 'error']);
-        })();
-        """, lambda f: lambda: self, dependencies=["runtime/internal/proxy"])
+
+    def _prepare(self):
+        self.runtime.context.locals._init_console(self)
 
     def log(self, *params):
         # kOverview == kLineNumber | kColumnOffset | kScriptName | kFunctionName
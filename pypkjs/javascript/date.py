@@ -0,0 +1,34 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import pypkjs.PyV8 as v8
+
+# Replaces Date with one that reads the runtime's clock; only installed when that clock is virtual.
+virtual_date = v8.JSExtension("runtime/date", """
+_init_virtual_date = function(_time) {
+    var RealDate = Date;
+    var now = function() {
+        return Math.floor(_time() * 1000);
+    };
+    var VirtualDate = function() {
+        if (!(this instanceof VirtualDate)) {
+            return new RealDate(now()).toString();
+        }
+        if (arguments.length == 0) {
+            return new RealDate(now());
+        }
+        var args = [null].concat(Array.prototype.slice.call(arguments));
+        return new (Function.prototype.bind.apply(RealDate, args))();
+    };
+    VirtualDate.prototype = RealDate.prototype;
+    VirtualDate.now = now;
+    VirtualDate.parse = RealDate.parse;
+    VirtualDate.UTC = RealDate.UTC;
+    this.Date = VirtualDate;
+};
+""")
+
+
+def prepare_date(runtime):
+    if runtime.clock.is_virtual:
+        runtime.context.locals._init_virtual_date(runtime.clock.time)
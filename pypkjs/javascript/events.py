@@ -37,6 +37,9 @@ Event = lambda runtime, *args: v8.JSObject.create(runtime.context.locals.Event,
 
 
 class EventSourceMixin(object):
+    # Identifies where this object's events come from, for scheduling on the runtime's event loop.
+    event_source = 'events'
+
     def __init__(self, runtime):
         self.__listeners = {}
         self.__runtime = runtime
@@ -57,6 +60,10 @@ class EventSourceMixin(object):
                     break
 
     def triggerEvent(self, event_name, event=None, *params):
+        self.__runtime.enqueue_from(self.event_source, self._event_dispatcher(event_name, event, params))
+
+    def _event_dispatcher(self, event_name, event=None, params=()):
+        # Returns a function that runs the listeners for the event when called on the event loop.
         if event is None:
             event = Event(self.__runtime, event_name)
 
@@ -86,6 +93,7 @@ class EventSourceMixin(object):
                 except Exception as e:
                     self.__runtime.log_output(e.message)
                     raise
-
-        self.__runtime.enqueue(go)
+        # Named for the event, so that anything reporting on the callback (such as the watchdog) can say which it was.
+        go.__name__ = str(event_name)
+        return go
 
@@ -9,3 +9,9 @@ class JSRuntimeException(Exception):
         trace = v8.JSStackTrace.GetCurrentStackTrace(20, v8.JSStackTrace.Options.Detailed)
         self.stackTrace = "Error: %s\n%s" % (message, str(trace))
         Exception.__init__(self, message)
+
+
+class QuotaExceededError(JSRuntimeException):
+    def __init__(self, message):
+        # The prefix lets the JS side give the error the name browsers use.
+        JSRuntimeException.__init__(self, "QuotaExceededError: %s" % message)
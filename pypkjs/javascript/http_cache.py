@@ -0,0 +1,406 @@
+from __future__ import absolute_import
+"""
+An HTTP cache (the parts of RFC 7234 a phone's browser would need) for apps' XMLHttpRequests. Every app shares it, so
+it follows the rules for a shared cache: requests with credentials bypass it, and responses marked private are never
+stored. Only GET responses are stored. Fresh responses are served without touching the network, and stale ones with a
+validator are revalidated with If-None-Match/If-Modified-Since. Entries live under the persist directory, and the least
+recently used are evicted once the cache grows past its size limit.
+"""
+
+__author__ = 'katharine'
+
+import collections
+import email.utils
+import errno
+import hashlib
+import io
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+import requests
+import requests.adapters
+import requests.packages.urllib3.response
+import requests.structures
+import requests.utils
+
+logger = logging.getLogger("pypkjs.javascript.http_cache")
+
+# Statuses that may be stored without explicit freshness information (RFC 7231 section 6.1).
+CACHEABLE_BY_DEFAULT = {200, 203, 204, 300, 301, 404, 405, 410, 414, 501}
+UNSAFE_METHODS = {'POST', 'PUT', 'DELETE', 'PATCH'}
+# Heuristic freshness is capped at a day (RFC 7234 section 4.2.2 suggests warning beyond that).
+MAX_HEURISTIC_LIFETIME = 86400
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def _parse_date(value):
+    parsed = email.utils.parsedate_tz(value) if value else None
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers):
+    cc = parse_cache_control(headers.get('cache-control'))
+    if 'no-cache' in cc:
+        return 0
+    max_age = _seconds(cc.get('max-age'))
+    if max_age is not None:
+        return max_age
+    date = _parse_date(headers.get('date'))
+    if 'expires' in headers:
+        expires = _parse_date(headers['expires'])
+        if expires is None or date is None:
+            return 0
+        return max(0, expires - date)
+    last_modified = _parse_date(headers.get('last-modified'))
+    if last_modified is not None and date is not None:
+        return min(MAX_HEURISTIC_LIFETIME, max(0, (date - last_modified) // 10))
+    return 0
+
+
+class HTTPCache(object):
+    """
+    The store behind CachingHTTPAdapter, shared by every runtime in the process. Each entry is one file: a line of JSON
+    metadata followed by the body. Without a persist directory, entries are kept in memory.
+    """
+    def __init__(self, persist_dir=None, max_size=10485760, max_entry_size=None):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size if max_entry_size is not None else max_size // 4
+        if persist_dir is not None:
+            self.path = os.path.join(persist_dir, 'http_cache')
+        else:
+            self.path = None
+        self._memory = {}
+        self._sizes = collections.OrderedDict()  # key -> bytes on disk, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.evicted = 0
+        self._load_index()
+
+    @staticmethod
+    def key(url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return hashlib.sha1(url).hexdigest()
+
+    def _load_index(self):
+        if self.path is None:
+            return
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Couldn't read the HTTP cache: %s", e)
+            return
+        entries = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self._sizes[name] = size
+            self.size += size
+        self._evict()
+
+    def _touch(self, key):
+        self._sizes[key] = self._sizes.pop(key)
+        if self.path is not None:
+            try:
+                os.utime(os.path.join(self.path, key), None)
+            except OSError:
+                pass
+
+    def get(self, url):
+        """
+        Returns (metadata, body) for `url`, or None.
+        """
+        key = self.key(url)
+        if key not in self._sizes:
+            return None
+        if self.path is None:
+            data = self._memory[key]
+        else:
+            try:
+                with open(os.path.join(self.path, key), 'rb') as f:
+                    data = f.read()
+            except IOError as e:
+                logger.warning("Couldn't read cached response for %s: %s", url, e)
+                self._forget(key)
+                return None
+        meta, _, body = data.partition('\n')
+        try:
+            meta = json.loads(meta)
+        except ValueError:
+            self._forget(key)
+            return None
+        if meta.get('url') != url:
+            return None
+        self._touch(key)
+        return meta, body
+
+    def put(self, url, meta, body):
+        if len(body) > self.max_entry_size:
+            self.remove(url)
+            return
+        key = self.key(url)
+        try:
+            data = json.dumps(dict(meta, url=url)) + '\n' + body
+        except ValueError:
+            # Header values that aren't valid UTF-8, most likely.
+            return
+        if self.path is None:
+            self._memory[key] = data
+        else:
+            try:
+                try:
+                    os.makedirs(self.path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp_path, os.path.join(self.path, key))
+            except (IOError, OSError) as e:
+                logger.warning("Couldn't cache response for %s: %s", url, e)
+                return
+        self.size -= self._sizes.pop(key, 0)
+        self._sizes[key] = len(data)
+        self.size += len(data)
+        self.stored += 1
+        self._evict()
+
+    def remove(self, url):
+        key = self.key(url)
+        if key in self._sizes:
+            self._forget(key)
+
+    def _forget(self, key):
+        self.size -= self._sizes.pop(key, 0)
+        self._memory.pop(key, None)
+        if self.path is not None:
+            try:
+                os.unlink(os.path.join(self.path, key))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self.size > self.max_size and self._sizes:
+            key = next(iter(self._sizes))
+            self._forget(key)
+            self.evicted += 1
+
+    def stats(self):
+        return {
+            'entries': len(self._sizes),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'stored': self.stored,
+            'evicted': self.evicted,
+        }
+
+
+class _TeeStream(object):
+    # Wraps a urllib3 response so that the body is captured as the caller streams it. Once the body has been read to
+    # the end, `on_complete` is called with it, unless it grew too large to keep.
+    def __init__(self, raw, limit, on_complete):
+        self._raw = raw
+        self._limit = limit
+        self._on_complete = on_complete
+        self._chunks = []
+        self._size = 0
+
+    def _capture(self, chunk):
+        if self._chunks is None:
+            return
+        self._size += len(chunk)
+        if self._size > self._limit:
+            self._chunks = None
+        else:
+            self._chunks.append(chunk)
+
+    def _finish(self):
+        if self._chunks is not None:
+            chunks, self._chunks = self._chunks, None
+            self._on_complete(''.join(chunks))
+
+    def stream(self, amt=2**16, decode_content=None):
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            self._capture(chunk)
+            yield chunk
+        self._finish()
+
+    def read(self, amt=None, *args, **kwargs):
+        chunk = self._raw.read(amt, *args, **kwargs)
+        self._capture(chunk)
+        if not chunk or amt is None:
+            self._finish()
+        return chunk
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class CachingHTTPAdapter(requests.adapters.BaseAdapter):
+    """
+    Answers GET requests from an HTTPCache where it can, passing everything else to `adapter`.
+    """
+    def __init__(self, cache, adapter):
+        super(CachingHTTPAdapter, self).__init__()
+        self.cache = cache
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        if request.method in UNSAFE_METHODS:
+            response = self.adapter.send(request, **kwargs)
+            if 200 <= response.status_code < 400:
+                self.cache.remove(request.url)
+            return response
+        if request.method != 'GET':
+            return self.adapter.send(request, **kwargs)
+
+        request_cc = parse_cache_control(request.headers.get('cache-control'))
+        # The response could be meant for this user alone, and the cache is shared between apps (RFC 7234 section 3.2).
+        if 'no-store' in request_cc or 'authorization' in request.headers:
+            return self.adapter.send(request, **kwargs)
+        if 'no-cache' in parse_cache_control(request.headers.get('pragma')):
+            request_cc.setdefault('no-cache', None)
+
+        entry = self.cache.get(request.url)
+        if entry is not None and not self._vary_matches(entry[0], request):
+            entry = None
+        if entry is not None:
+            meta, body = entry
+            age = meta['initial_age'] + max(0, time.time() - meta['stored'])
+            max_age = _seconds(request_cc.get('max-age'))
+            if ('no-cache' not in request_cc and age < meta['lifetime'] and
+                    (max_age is None or age <= max_age)):
+                self.cache.hits += 1
+                return self._build_response(request, meta, body, age)
+            validators = self._validators(meta)
+            if validators:
+                conditional = request.copy()
+                conditional.headers.update(validators)
+                requested = time.time()
+                response = self.adapter.send(conditional, **kwargs)
+                if response.status_code == 304:
+                    response.close()
+                    self.cache.revalidated += 1
+                    meta = self._refresh(request, meta, response, requested)
+                    self.cache.put(request.url, meta, body)
+                    return self._build_response(request, meta, body, meta['initial_age'])
+                self.cache.misses += 1
+                return self._maybe_store(request, response, requested)
+        self.cache.misses += 1
+        requested = time.time()
+        return self._maybe_store(request, self.adapter.send(request, **kwargs), requested)
+
+    @staticmethod
+    def _vary_matches(meta, request):
+        return all(request.headers.get(name) == value for name, value in meta['vary'].iteritems())
+
+    @staticmethod
+    def _validators(meta):
+        headers = requests.structures.CaseInsensitiveDict(meta['headers'])
+        validators = {}
+        if 'etag' in headers:
+            validators['If-None-Match'] = headers['etag']
+        if 'last-modified' in headers:
+            validators['If-Modified-Since'] = headers['last-modified']
+        return validators
+
+    @staticmethod
+    def _metadata(request, status, reason, headers, requested):
+        received = time.time()
+        date = _parse_date(headers.get('date'))
+        apparent_age = max(0, received - date) if date is not None else 0
+        # The time the request spent in flight counts towards the response's age (RFC 7234 section 4.2.3).
+        initial_age = max(apparent_age, _seconds(headers.get('age')) or 0) + (received - requested)
+        vary = [name.strip() for name in headers.get('vary', '').split(',') if name.strip()]
+        return {
+            'status': status,
+            'reason': reason,
+            'headers': headers.items(),
+            'vary': {name: request.headers.get(name) for name in vary},
+            'stored': received,
+            'initial_age': initial_age,
+            'lifetime': freshness_lifetime(headers),
+        }
+
+    def _refresh(self, request, meta, response, requested):
+        # A 304 updates the stored headers (RFC 7234 section 4.3.4), other than those describing the body.
+        headers = requests.structures.CaseInsensitiveDict(meta['headers'])
+        for name, value in response.headers.iteritems():
+            if name.lower() not in ('content-length', 'content-encoding', 'transfer-encoding'):
+                headers[name] = value
+        return self._metadata(request, meta['status'], meta['reason'], headers, requested)
+
+    def _maybe_store(self, request, response, requested):
+        headers = response.headers
+        cc = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in cc or 'private' in cc or headers.get('vary', '').strip() == '*':
+            return response
+        has_freshness = 'max-age' in cc or 'expires' in headers
+        has_validator = 'etag' in headers or 'last-modified' in headers
+        if not (has_freshness or (has_validator and response.status_code in CACHEABLE_BY_DEFAULT)):
+            return response
+        # The body is stored as the app sees it, after any Content-Encoding has been removed.
+        stored_headers = requests.structures.CaseInsensitiveDict(headers)
+        for name in ('content-encoding', 'transfer-encoding', 'content-length'):
+            stored_headers.pop(name, None)
+        meta = self._metadata(request, response.status_code, response.reason, stored_headers, requested)
+
+        def store(body):
+            meta['headers'] = dict(meta['headers'], **{'Content-Length': str(len(body))}).items()
+            self.cache.put(request.url, meta, body)
+        response.raw = _TeeStream(response.raw, self.cache.max_entry_size, store)
+        return response
+
+    def _build_response(self, request, meta, body, age):
+        response = requests.Response()
+        response.status_code = meta['status']
+        response.reason = meta['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(meta['headers'])
+        response.headers['Age'] = str(int(age))
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        # A real urllib3 response, so that streaming and Response.close() (which releases the connection) behave as they
+        # do for a network response.
+        response.raw = requests.packages.urllib3.response.HTTPResponse(
+            body=io.BytesIO(body), headers=response.headers, status=response.status_code, preload_content=False,
+            decode_content=False)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        self.adapter.close()
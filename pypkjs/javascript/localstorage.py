@@ -6,47 +6,97 @@ import errno
 import logging
 import os
 import os.path
-import dumbdbm  # This is the only one that actually syncs data if the process dies before I can close().
+
+from .exceptions import QuotaExceededError
+from .logstore import LogStore, open_store
+
 logger = logging.getLogger("pypkjs.javascript.localstorage")
 
 _storage_cache = {}  # This is used when filesystem-based storage is unavailable.
 
 
+def open_app_store(persist_dir, uuid, **kwargs):
+    """
+    Returns the store holding localStorage for the app `uuid`, falling back to a transient one if there's no persist
+    directory or it can't be used. Transient stores are shared and should not be closed.
+    """
+    if persist_dir is not None:
+        try:
+            try:
+                os.makedirs(os.path.join(persist_dir, 'localstorage'))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            return open_store(os.path.join(persist_dir, 'localstorage', str(uuid)), **kwargs)
+        except (IOError, OSError):
+            logger.exception("Couldn't open localStorage for %s", uuid)
+    logger.warning("Using transient store.")
+    if str(uuid) not in _storage_cache:
+        _storage_cache[str(uuid)] = LogStore()
+    return _storage_cache[str(uuid)]
+
+
 class LocalStorage(object):
+    extension = v8.JSExtension("runtime/localstorage", """
+    _init_localstorage = function(origin) {
+        var proxy = _make_proxies({}, origin, ['set', 'has', 'delete_', 'keys', 'enumerate']);
+        var methods = _make_proxies({}, origin, ['clear', 'getItem', 'setItem', 'removeItem', 'key']);
+        var name_quota_errors = function(fn) {
+            return function() {
+                try {
+                    return fn.apply(this, arguments);
+                } catch (e) {
+                    if (String(e.message).indexOf('QuotaExceededError') === 0) {
+                        e.name = 'QuotaExceededError';
+                        e.code = 22;
+                    }
+                    throw e;
+                }
+            };
+        };
+        proxy.set = name_quota_errors(proxy.set);
+        methods.setItem = name_quota_errors(methods.setItem);
+        proxy.get = function get(p, name) { return methods[name] || origin.get(p, name); }
+
+        this.localStorage = Proxy.create(proxy);
+    };
+    """, dependencies=["runtime/internal/proxy"])
+
     def __init__(self, runtime, persist_dir=None):
+        self.runtime = runtime
+        self.persist_dir = persist_dir
         self.storage = None
-        if persist_dir is not None:
-            try:
-                try:
-                    os.makedirs(os.path.join(persist_dir, 'localstorage'))
-                except OSError as e:
-                    if e.errno != errno.EEXIST:
-                        raise
-
-                self.storage = dumbdbm.open(os.path.join(persist_dir, 'localstorage', str(runtime.pbw.uuid)), 'c')
-            except IOError:
-                pass
-        if self.storage is None:
-            logger.warning("Using transient store.")
-            self.storage = _storage_cache.setdefault(str(runtime.pbw.uuid), {})
 
-        self.extension = v8.JSExtension(runtime.ext_name("localstorage"), """
-        (function() {
-            native function _internal();
+    def _prepare(self):
+        self.runtime.context.locals._init_localstorage(self)
+        self.runtime.idle_callbacks.append(self._flush)
 
-            var proxy = _make_proxies({}, _internal(), ['set', 'has', 'delete_', 'keys', 'enumerate']);
-            var methods = _make_proxies({}, _internal(), ['clear', 'getItem', 'setItem', 'removeItem', 'key']);
-            proxy.get = function get(p, name) { return methods[name] || _internal().get(p, name); }
+    def _bind(self):
+        self.storage = open_app_store(self.persist_dir, self.runtime.pbw.uuid,
+                                      durability=self.runtime.localstorage_durability,
+                                      flush_interval=self.runtime.localstorage_flush_interval)
+        self._report_usage()
 
-            this.localStorage = Proxy.create(proxy);
-        })();
-        """, lambda f: lambda: self, dependencies=["runtime/internal/proxy"])
+    def _report_usage(self):
+        self.runtime.runner.record_localstorage_usage(self.runtime.pbw.uuid, self.storage.size)
 
     def get(self, p, name):
         return self.storage.get(str(name), v8.JSNull())
 
     def set(self, p, name, value):
-        self.storage[str(name)] = str(value)
+        name = str(name)
+        value = str(value)
+        quota = self.runtime.localstorage_quota
+        if quota:
+            old = self.storage.get(name)
+            if old is None:
+                growth = len(name) + len(value)
+            else:
+                growth = len(value) - len(old)
+            if growth > 0 and self.storage.size + growth > quota:
+                raise QuotaExceededError("Setting '%s' would exceed this app's localStorage quota of %d bytes."
+                                         % (name, quota))
+        self.storage[name] = value
         return True
 
     def has(self, p, name):
@@ -78,11 +128,23 @@ class LocalStorage(object):
         return self.delete_(None, name)
 
     def key(self, index, *args):
-        if len(self.storage) > index:
-            return self.storage.keys()[index]
+        if 0 <= index < len(self.storage):
+            return self.storage.key_at(index)
         else:
             return v8.JSNull()
 
+    def _flush(self):
+        # Batched writes go out as soon as JS has nothing else to do, rather than waiting for the timer.
+        if self.storage is not None and self.storage.durability == LogStore.BATCHED:
+            self.storage.flush()
+
     def _shutdown(self):
-        if hasattr(self.storage, 'close'):
-            self.storage.close()
+        if self.storage is None:
+            return
+        self._report_usage()
+        # Transient stores outlive the runtime, so they stay open.
+        if self.storage.path is not None:
+            try:
+                self.storage.close()
+            except (IOError, OSError):
+                logger.exception("Lost localStorage changes for %s", self.runtime.pbw.uuid)
@@ -0,0 +1,402 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import collections
+import dumbdbm
+import errno
+import gevent
+import logging
+import os
+import os.path
+import struct
+import time
+import zlib
+
+from .metrics import Histogram
+
+logger = logging.getLogger("pypkjs.javascript.logstore")
+
+
+class LogStore(object):
+    """
+    A string-to-string store kept entirely in memory, backed by an append-only log of changes. Each record carries a
+    CRC, so a record torn by a crash is detected (and discarded, along with anything after it) the next time the log is
+    opened. Once enough of the log is superseded, it's rewritten in the background. Without a path, nothing touches the
+    disk.
+
+    Keys are also kept in a list, so that key(i) is O(1). Removing a key moves the last key into its slot, so key order
+    is arbitrary (as the localStorage spec allows).
+
+    `durability` decides when changes reach the log:
+      * per-write: every change is written out as it happens.
+      * batched: changes collect in memory (only the latest for each key is kept) and are written and fsynced together
+        when flush() is called, or `flush_interval` seconds after the first unwritten change.
+      * on-exit: changes are only written by an explicit flush() or close().
+    """
+    HEADER = struct.Struct('<IBII')  # crc32, op, key length, value length
+    OP_SET = 1
+    OP_DELETE = 2
+    OP_CLEAR = 3
+    # Compact once the log is this much bigger than the live data, and at least twice its size.
+    COMPACT_SLACK = 65536
+
+    PER_WRITE = 'per-write'
+    BATCHED = 'batched'
+    ON_EXIT = 'on-exit'
+    DURABILITY_MODES = (PER_WRITE, BATCHED, ON_EXIT)
+
+    def __init__(self, path=None, durability=PER_WRITE, flush_interval=1.0):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError("Unknown durability mode '%s'" % durability)
+        self.path = path
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self._dirty = collections.OrderedDict()  # key -> latest value, or None if deleted
+        self._dirty_clear = False
+        self._flush_timer = None
+        # Flush sizes are in records; times are in microseconds.
+        self.flush_sizes = Histogram()
+        self.flush_times = Histogram()
+        self._values = {}  # key -> (value, index into _keys)
+        self._keys = []
+        self._live_bytes = 0
+        self._log_bytes = 0
+        self._log = None
+        self._compacting = False
+        # Set when a failed write may have left part of a record on the end of the log, and we couldn't cut it off.
+        # The next write replaces the log rather than appending after it.
+        self._needs_rewrite = False
+        if path is not None:
+            self._load()
+            self._log = open(path, 'ab')
+
+    @classmethod
+    def _record(cls, op, key='', value=''):
+        body = struct.pack('<BII', op, len(key), len(value)) + key + value
+        return struct.pack('<I', zlib.crc32(body) & 0xffffffff) + body
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        offset = 0
+        for op, key, value, end in self._parse(data):
+            if op == self.OP_SET:
+                self._apply_set(key, value)
+            elif op == self.OP_DELETE:
+                if key in self._values:
+                    self._apply_delete(key)
+            elif op == self.OP_CLEAR:
+                self._apply_clear()
+            offset = end
+        if offset != len(data):
+            logger.warning("Discarding %d bytes of damaged log at the end of %s", len(data) - offset, self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        self._log_bytes = offset
+
+    @classmethod
+    def _parse(cls, data):
+        # Yields (op, key, value, end offset) for each intact record, stopping at the first damaged or unknown one.
+        offset = 0
+        header_size = cls.HEADER.size
+        while offset + header_size <= len(data):
+            crc, op, key_length, value_length = cls.HEADER.unpack_from(data, offset)
+            end = offset + header_size + key_length + value_length
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) & 0xffffffff != crc:
+                return
+            if op not in (cls.OP_SET, cls.OP_DELETE, cls.OP_CLEAR):
+                return
+            key_start = offset + header_size
+            yield op, data[key_start:key_start + key_length], data[key_start + key_length:end], end
+            offset = end
+
+    def _apply_set(self, key, value):
+        try:
+            old, index = self._values[key]
+        except KeyError:
+            index = len(self._keys)
+            self._keys.append(key)
+            self._live_bytes += len(key)
+        else:
+            self._live_bytes -= len(old)
+        self._values[key] = (value, index)
+        self._live_bytes += len(value)
+
+    def _apply_delete(self, key):
+        value, index = self._values.pop(key)
+        last = self._keys.pop()
+        if last != key:
+            self._keys[index] = last
+            self._values[last] = (self._values[last][0], index)
+        self._live_bytes -= len(key) + len(value)
+
+    def _apply_clear(self):
+        self._values.clear()
+        del self._keys[:]
+        self._live_bytes = 0
+
+    def _changed(self, key, value):
+        if self._log is None:
+            return
+        if self.durability == self.PER_WRITE:
+            try:
+                self._write([self._record(self.OP_SET, key, value) if value is not None
+                             else self._record(self.OP_DELETE, key)])
+            except (IOError, OSError):
+                # Keep the change so a later flush() or close() can try again.
+                self._dirty[key] = value
+                raise
+            return
+        self._dirty[key] = value
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.durability == self.BATCHED and self._flush_timer is None:
+            self._flush_timer = gevent.spawn_later(self.flush_interval, self.flush)
+
+    def _write(self, records, sync=False):
+        if self._needs_rewrite:
+            # A rewrite includes every change, these records' among them.
+            self._rewrite()
+            return
+        data = ''.join(records)
+        try:
+            self._log.write(data)
+            self._log.flush()
+            if sync:
+                os.fsync(self._log.fileno())
+        except (IOError, OSError):
+            self._discard_tail()
+            raise
+        self._log_bytes += len(data)
+        if (not self._compacting and self._log_bytes > 2 * self._live_bytes and
+                self._log_bytes - self._live_bytes > self.COMPACT_SLACK):
+            self._compacting = True
+            gevent.spawn(self.compact)
+
+    def _discard_tail(self):
+        # Cut the log back to the end of its last good record, so nothing we append later ends up after a torn one.
+        self._needs_rewrite = True
+        try:
+            self._log.close()
+        except (IOError, OSError):
+            pass
+        try:
+            with open(self.path, 'r+b') as f:
+                f.truncate(self._log_bytes)
+            self._log = open(self.path, 'ab')
+        except (IOError, OSError) as e:
+            logger.warning("Couldn't truncate %s after a failed write; it will be rewritten: %s", self.path, e)
+        else:
+            self._needs_rewrite = False
+
+    def __getitem__(self, key):
+        return self._values[key][0]
+
+    def get(self, key, default=None):
+        try:
+            return self._values[key][0]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._apply_set(key, value)
+        self._changed(key, value)
+
+    def __delitem__(self, key):
+        self._apply_delete(key)
+        self._changed(key, None)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def key_at(self, index):
+        return self._keys[index]
+
+    def items(self):
+        return [(k, self._values[k][0]) for k in self._keys]
+
+    def clear(self):
+        self._apply_clear()
+        if self._log is None:
+            return
+        if self.durability == self.PER_WRITE:
+            self._write([self._record(self.OP_CLEAR)])
+        else:
+            self._dirty.clear()
+            self._dirty_clear = True
+            self._schedule_flush()
+
+    @property
+    def size(self):
+        # Bytes of keys and values currently stored; kept up to date as they change.
+        return self._live_bytes
+
+    @property
+    def dirty(self):
+        return self._dirty_clear or bool(self._dirty)
+
+    def flush(self):
+        """
+        Writes out any outstanding changes. Returns False if they couldn't be written, in which case they're kept for
+        the next attempt.
+        """
+        timer, self._flush_timer = self._flush_timer, None
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+        if self._log is None or not self.dirty:
+            return True
+        started = time.time()
+        records = [self._record(self.OP_CLEAR)] if self._dirty_clear else []
+        for key, value in self._dirty.iteritems():
+            if value is None:
+                records.append(self._record(self.OP_DELETE, key))
+            else:
+                records.append(self._record(self.OP_SET, key, value))
+        try:
+            self._write(records, sync=True)
+        except (IOError, OSError) as e:
+            logger.error("Couldn't write %d localStorage changes to %s: %s", len(records), self.path, e)
+            self._schedule_flush()
+            return False
+        self._dirty.clear()
+        self._dirty_clear = False
+        self.flush_sizes.record(len(records))
+        self.flush_times.record((time.time() - started) * 1000000)
+        return True
+
+    def update(self, items):
+        """
+        Replaces the whole contents of the store with `items` in one step: either all of them land, or (if we crash
+        part way) none do.
+        """
+        self._apply_clear()
+        for key, value in items:
+            self._apply_set(key, value)
+        self._rewrite()
+
+    def dump(self):
+        """
+        Returns the whole store as a string of set records: the same format as a freshly compacted log.
+        """
+        return ''.join(self._record(self.OP_SET, key, self._values[key][0]) for key in self._keys)
+
+    @classmethod
+    def parse_dump(cls, data):
+        """
+        Returns the (key, value) pairs in a string produced by dump(). Raises ValueError if it's damaged.
+        """
+        items = []
+        offset = 0
+        for op, key, value, end in cls._parse(data):
+            if op != cls.OP_SET:
+                break
+            items.append((key, value))
+            offset = end
+        if offset != len(data):
+            raise ValueError("Damaged localStorage dump at byte %d." % offset)
+        return items
+
+    def _rewrite(self):
+        # Write out just the live data, then atomically swap it in for the log.
+        if self.path is None:
+            return
+        size = _replace_file(self.path, self.dump())
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.path, 'ab')
+        self._log_bytes = size
+        self._needs_rewrite = False
+        # The rewrite included any changes we hadn't written yet.
+        self._dirty.clear()
+        self._dirty_clear = False
+
+    def compact(self):
+        try:
+            if self._log is not None:
+                self._rewrite()
+        except (IOError, OSError) as e:
+            logger.warning("Couldn't compact %s: %s", self.path, e)
+        finally:
+            self._compacting = False
+
+    def sync(self):
+        if self._log is not None:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def close(self):
+        """
+        Writes out any outstanding changes and closes the log. Raises IOError or OSError if the changes couldn't be
+        written.
+        """
+        if self._log is None:
+            return
+        try:
+            if not self.flush() or self._needs_rewrite:
+                # Last chance: a rewrite doesn't depend on the state of the old log.
+                self._rewrite()
+            self.sync()
+        finally:
+            timer, self._flush_timer = self._flush_timer, None
+            if timer is not None:
+                timer.kill(block=False)
+            self._log.close()
+            self._log = None
+
+    def stats(self):
+        return {
+            'keys': len(self._keys),
+            'bytes': self._live_bytes,
+            'durability': self.durability,
+            'pending_changes': len(self._dirty),
+            'flush_records': self.flush_sizes.snapshot(),
+            'flush_us': self.flush_times.snapshot(),
+        }
+
+
+def _replace_file(path, data):
+    # Writes `data` alongside `path` and atomically swaps it in, so `path` is never seen half written. Returns the size.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    os.rename(tmp_path, path)
+    return size
+
+
+def open_store(path, **kwargs):
+    """
+    Opens the LogStore at `path`.log, first migrating any dumbdbm database that was previously kept at `path`.
+    """
+    log_path = path + '.log'
+    # The old database is only removed once its log is in place, so finding one means a migration hasn't finished.
+    if os.path.exists(path + '.dat'):
+        if not os.path.exists(log_path):
+            logger.info("Migrating %s to a log store.", path)
+            old = dumbdbm.open(path, 'r')
+            try:
+                migrated = LogStore()
+                migrated.update(old.items())
+            finally:
+                old.close()
+            _replace_file(log_path, migrated.dump())
+        for suffix in ('.dat', '.dir', '.bak'):
+            try:
+                os.unlink(path + suffix)
+            except OSError:
+                pass
+    return LogStore(log_path, **kwargs)
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import collections
+
+
+class Histogram(object):
+    """
+    A log-linear histogram in the style of HdrHistogram: values are bucketed by power of two, and each power of two
+    is split into 2 ** SUB_BUCKET_BITS linear sub-buckets, giving about 3% precision at any magnitude with a small,
+    fixed amount of work per recorded value.
+    """
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def _index(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return (shift + 1) * cls.SUB_BUCKETS + (value >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def _value_at(cls, index):
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        return (index % cls.SUB_BUCKETS + cls.SUB_BUCKETS) << shift
+
+    def record(self, value):
+        value = max(0, int(value))
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        target = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._value_at(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': (float(self.total) / self.count) if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+
+class EventLoopMetrics(object):
+    # Times are recorded in microseconds.
+    def __init__(self):
+        self.wait_times = collections.defaultdict(Histogram)
+        self.run_times = collections.defaultdict(Histogram)
+        self.depths = Histogram()
+        self.max_lane_depths = collections.defaultdict(int)
+
+    def record_callback(self, source, enqueued, started, finished):
+        self.wait_times[source].record((started - enqueued) * 1000000)
+        self.run_times[source].record((finished - started) * 1000000)
+
+    def record_depth(self, scheduler):
+        self.depths.record(scheduler.depth())
+        for lane in scheduler.lanes:
+            depth = scheduler.depth(lane)
+            if depth > self.max_lane_depths[lane]:
+                self.max_lane_depths[lane] = depth
+
+    def snapshot(self):
+        return {
+            'callbacks': {source: {'wait_us': self.wait_times[source].snapshot(),
+                                   'run_us': self.run_times[source].snapshot()}
+                          for source in self.run_times},
+            'queue_depth': self.depths.snapshot(),
+            'max_lane_depth': dict(self.max_lane_depths),
+        }
+
+
+class AppMessageMetrics(object):
+    # Round trips are recorded in microseconds.
+    def __init__(self):
+        self.sent = 0
+        self.acked = 0
+        self.nacked = 0
+        self.timed_out = 0
+        self.round_trips = Histogram()
+        self.depths = Histogram()
+        self.max_depth = 0
+
+    def record_depth(self, depth):
+        self.depths.record(depth)
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def record_response(self, sent, received, did_succeed):
+        self.round_trips.record((received - sent) * 1000000)
+        if did_succeed:
+            self.acked += 1
+        else:
+            self.nacked += 1
+
+    def snapshot(self):
+        return {
+            'sent': self.sent,
+            'acked': self.acked,
+            'nacked': self.nacked,
+            'timed_out': self.timed_out,
+            'round_trip_us': self.round_trips.snapshot(),
+            'queue_depth': self.depths.snapshot(),
+            'max_queue_depth': self.max_depth,
+        }
@@ -6,22 +6,23 @@ from .geolocation import Geolocation
 
 
 class Navigator(object):
-    def __init__(self, runtime):
-
-        self._runtime = runtime
-        self._runtime = runtime
-
-        self.extension = v8.JSExtension(runtime.ext_name("navigator"), """
-        navigator = new (function() {
-            native function _internal_location();
+    extension = v8.JSExtension("runtime/navigator", """
+    _init_navigator = function(location) {
+        this.navigator = new (function() {
             this.language = 'en-GB';
 
-            var location = _internal_location();
             if(true) { // TODO: this should be a check on geolocation being enabled.
                 this.geolocation = new (function() {
                     _make_proxies(this, location, ['getCurrentPosition', 'watchPosition', 'clearWatch']);
                 })();
             }
         })();
-        """, lambda f: lambda: Geolocation(runtime), dependencies=["runtime/internal/proxy"])
+    };
+    """, dependencies=["runtime/internal/proxy"])
+
+    def __init__(self, runtime):
+        self._runtime = runtime
+
+    def _prepare(self):
+        self._runtime.context.locals._init_navigator(Geolocation(self._runtime))
 
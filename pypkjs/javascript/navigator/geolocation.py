@@ -2,7 +2,6 @@ from __future__ import absolute_import
 __author__ = 'katharine'
 
 import pypkjs.PyV8 as v8
-import time
 import requests
 import pygeoip
 import os.path
@@ -28,24 +27,29 @@ Coordinates = lambda runtime, *args: v8.JSObject.create(runtime.context.locals.C
 
 
 class Geolocation(object):
+    TIMEOUT = 30.0
+
     def __init__(self, runtime):
         self.runtime = runtime
+        # The lookup is on the app's behalf, so it doesn't share the runner's API pool.
+        self._session = requests.Session()
 
     def _get_position(self, success, failure):
         try:
-            resp = requests.get('http://ip.42.pl/raw')
+            with self.runtime.clock.busy():
+                resp = self._session.get('http://ip.42.pl/raw', timeout=self.TIMEOUT)
             resp.raise_for_status()
             ip = resp.text
             gi = pygeoip.GeoIP('%s/GeoLiteCity.dat' % os.path.dirname(__file__))
             record = gi.record_by_addr(ip)
             if record is None:
                 if callable(failure):
-                    self.runtime.enqueue(failure)
+                    self.runtime.enqueue_from('geolocation', failure)
         except (requests.RequestException, pygeoip.GeoIPError):
             if callable(failure):
-                self.runtime.enqueue(failure)
+                self.runtime.enqueue_from('geolocation', failure)
         else:
-            self.runtime.enqueue(success, Position(self.runtime, Coordinates(self.runtime, record['longitude'], record['latitude'], 1000), round(time.time() * 1000)))
+            self.runtime.enqueue_from('geolocation', success, Position(self.runtime, Coordinates(self.runtime, record['longitude'], record['latitude'], 1000), round(self.runtime.clock.time() * 1000)))
 
     def _enabled(self):
         return True
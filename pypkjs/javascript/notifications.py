@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import collections
+import gevent.event
+import logging
+
+from libpebble2.services.notifications import Notifications
+
+logger = logging.getLogger('pypkjs.javascript.notifications')
+
+
+class NotificationQueue(object):
+    """
+    Sends an app's simple notifications to the watch in the background, at most `rate` per second (unlimited if zero).
+    A notification identical to one accepted in the last `dedupe_window` seconds is dropped, and once `max_depth` are
+    waiting the oldest is dropped to make room.
+    """
+    def __init__(self, runtime, pebble, blobdb, rate=2.0, dedupe_window=5.0, max_depth=32):
+        self.runtime = runtime
+        self.pebble = pebble
+        self.blobdb = blobdb
+        self.rate = rate
+        self.dedupe_window = dedupe_window
+        self.max_depth = max_depth
+        self.sent = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self._service = None
+        self._queue = collections.deque()
+        self._recent = {}  # (title, body) -> when it was last accepted
+        self._wakeup = gevent.event.Event()
+        self._sender = None
+
+    def push(self, title, body):
+        now = self.runtime.clock.time()
+        key = (title, body)
+        last = self._recent.get(key)
+        if last is not None and now - last < self.dedupe_window:
+            self.collapsed += 1
+            return
+        if len(self._recent) > 4 * self.max_depth:
+            self._recent = {k: v for k, v in self._recent.iteritems() if now - v < self.dedupe_window}
+        self._recent[key] = now
+        if len(self._queue) >= self.max_depth:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(key)
+        if self._sender is None:
+            self._sender = self.runtime.group.spawn(self._run)
+        self._wakeup.set()
+
+    def _send(self, title, body):
+        if self._service is None:
+            self._service = Notifications(self.pebble, self.blobdb)
+        try:
+            self._service.send_notification(title, body)
+        except Exception:
+            logger.exception("Failed to send notification.")
+        else:
+            self.sent += 1
+
+    def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+            self._send(*self._queue.popleft())
+            if self.rate:
+                self.runtime.clock.sleep(1.0 / self.rate)
+
+    def flush(self):
+        # Send whatever is left straight away; used when the app is shutting down.
+        if self._sender is not None:
+            self._sender.kill(block=False)
+            self._sender = None
+        while self._queue:
+            self._send(*self._queue.popleft())
+
+    def stats(self):
+        return {
+            'depth': len(self._queue),
+            'sent': self.sent,
+            'collapsed': self.collapsed,
+            'dropped': self.dropped,
+        }
@@ -2,65 +2,107 @@ from __future__ import absolute_import
 __author__ = 'katharine'
 
 import calendar
-import collections
 import datetime
 import dateutil.parser
+import hashlib
 from dateutil.tz import tzlocal
 import logging
 import requests
 import struct
-import time
 import traceback
 from uuid import UUID
 import urllib
 
 import pypkjs.PyV8 as v8
 from libpebble2.protocol.appglance import AppGlance, AppGlanceSlice, AppGlanceSliceType
-from libpebble2.protocol.appmessage import AppMessage
 from libpebble2.protocol.blobdb import BlobDatabaseID, BlobStatus
 from libpebble2.protocol.system import Model
 from libpebble2.services.blobdb import SyncWrapper
-from libpebble2.services.notifications import Notifications
 from libpebble2.services.appmessage import *
 from libpebble2.util.hardware import PebbleHardware
 from libpebble2.util.bundle import PebbleBundle
 
 from . import events
+from .appmessage import AppMessageCodec, AppMessagePipeline
+from .notifications import NotificationQueue
 from ..timeline.attributes import TimelineAttributeSet
+from ..timeline.tokens import TokenException
 from .exceptions import JSRuntimeException
 
 logger = logging.getLogger('pypkjs.javascript.pebble')
 
-
-class TokenException(Exception):
-    pass
+MODEL_NAMES = {
+    Model.TintinBlack: "pebble_black",
+    Model.TintinRed: "pebble_red",
+    Model.TintinWhite: "pebble_white",
+    Model.TintinGrey: "pebble_gray",
+    Model.TintinOrange: "pebble_orange",
+    Model.TintinGreen: "pebble_green",
+    Model.TintinPink: "pebble_pink",
+    Model.TintinBlue: "pebble_blue",
+    Model.BiancaBlack: "pebble_steel_black",
+    Model.BiancaSilver: "pebble_steel_silver",
+    Model.SnowyWhite: "pebble_time_white",
+    Model.SnowyRed: "pebble_time_red",
+    Model.SnowyBlack: "pebble_time_black",
+}
 
 
 class Pebble(events.EventSourceMixin, v8.JSClass):
-    def __init__(self, runtime, pebble):
-        self.extension = v8.JSExtension(runtime.ext_name("pebble"), """
-        Pebble = new (function() {
-            native function _internal_pebble();
-            _make_proxies(this, _internal_pebble(),
+    event_source = 'pebble'
+
+    extension = v8.JSExtension("runtime/pebble", """
+    _init_pebble = function(origin) {
+        this.Pebble = new (function() {
+            _make_proxies(this, origin,
                 ['sendAppMessage', 'showSimpleNotificationOnPebble', 'getAccountToken', 'getWatchToken',
                 'addEventListener', 'removeEventListener', 'openURL', 'getTimelineToken', 'timelineSubscribe',
                 'timelineUnsubscribe', 'timelineSubscriptions', 'getActiveWatchInfo', 'appGlanceReload']);
             this.platform = 'pypkjs';
         })();
-        """, lambda f: lambda: self, dependencies=["runtime/internal/proxy"])
+    };
+    _make_watch_info = function(platform, model, language, major, minor, patch, suffix) {
+        return Object.freeze({
+            platform: platform,
+            model: model,
+            language: language,
+            firmware: Object.freeze({major: major, minor: minor, patch: patch, suffix: suffix}),
+        });
+    };
+    """, dependencies=["runtime/internal/proxy", "runtime/appmessage"])
+
+    def __init__(self, runtime, pebble):
         self.blobdb = pebble.blobdb
         self.pebble = pebble.pebble
+        self._manager = pebble
+        self._watch_info = None
+        self._watch_info_generation = None
+        self.notifications = NotificationQueue(runtime, self.pebble, self.blobdb, rate=runtime.notification_rate,
+                                               dedupe_window=runtime.notification_dedupe_window)
         self.runtime = runtime
         self.tid = 0
-        self.uuid = runtime.pbw.uuid
-        self.app_keys = runtime.pbw.manifest['appKeys']
-        self.pending_acks = {}
+        self.uuid = None
+        self.app_keys = {}
+        self._codec = None
+        self._pipeline = None
         self.is_ready = False
-        self._timeline_token = None
         self._appmessage = self.runtime.runner.appmessage
         self._appmessage_handlers = []
         super(Pebble, self).__init__(runtime)
 
+    def _prepare(self):
+        self.runtime.context.locals._init_pebble(self)
+
+    def _bind(self):
+        self.uuid = self.runtime.pbw.uuid
+        self.app_keys = self.runtime.pbw.manifest['appKeys']
+        self._codec = AppMessageCodec(self.runtime, self.app_keys)
+        self._watch_info = None
+        self._pipeline = AppMessagePipeline(self.runtime, self._appmessage, self.uuid,
+                                            window=self.runtime.appmessage_window,
+                                            timeout=self.runtime.appmessage_timeout,
+                                            metrics=self.runtime.appmessage_metrics)
+
     def _connect(self):
         self._ready()
 
@@ -73,9 +115,16 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
         ]
         self.triggerEvent("ready")
 
+    @property
+    def appmessages_in_flight(self):
+        return self._pipeline.depth if self._pipeline is not None else 0
+
     def _shutdown(self):
         for handle in self._appmessage_handlers:
             self._appmessage.unregister_handler(handle)
+        if self._pipeline is not None:
+            self._pipeline.close()
+        self.notifications.flush()
 
     def _configure(self):
         self.triggerEvent("showConfiguration")
@@ -87,18 +136,7 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
         self._handle_response(tid, False)
 
     def _handle_response(self, tid, did_succeed):
-        try:
-            success, failure = self.pending_acks[tid]
-        except KeyError:
-            return
-        callback_param = {"data": {"transactionId": tid}}
-        if did_succeed:
-            if callable(success):
-                self.runtime.enqueue(success, callback_param)
-        else:
-            if callable(failure):
-                self.runtime.enqueue(failure, callback_param)
-        del self.pending_acks[tid]
+        self._pipeline.handle_response(tid, did_succeed)
 
     def _handle_message(self, tid, uuid, dictionary):
         if uuid != self.uuid:
@@ -106,20 +144,7 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
             self.pebble._send_message("APPLICATION_MESSAGE", struct.pack('<BB', 0x7F, tid))  # ACK
             return
 
-        app_keys = dict(zip(self.app_keys.values(), self.app_keys.keys()))
-        d = self.runtime.context.eval("({})")  # This is kinda absurd.
-        for k, v in dictionary.iteritems():
-            if isinstance(v, int):
-                value = v
-            elif isinstance(v, basestring):
-                value = v
-            elif isinstance(v, bytearray):
-                value = v8.JSArray(list(v))
-            else:
-                raise JSRuntimeException("?????")
-            d[str(k)] = value
-            if k in app_keys:
-                d[str(app_keys[k])] = value
+        d = self._codec.decode(dictionary)
         e = events.Event(self.runtime, "AppMessage")
         e.payload = d
         self.triggerEvent("appmessage", e)
@@ -130,59 +155,11 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
 
     def sendAppMessage(self, message, success=None, failure=None):
         self._check_ready()
-        to_send = {}
-        message = {k: message[str(k)] for k in message.keys()}
-        for k, v in message.iteritems():
-            if k in self.app_keys:
-                k = self.app_keys[k]
-            try:
-                to_send[int(k)] = v
-            except ValueError:
-                raise JSRuntimeException("Unknown message key '%s'" % k)
-
-        d = {}
-        appmessage = AppMessage()
-        for k, v in to_send.iteritems():
-            if isinstance(v, v8.JSArray):
-                v = list(v)
-            if isinstance(v, basestring):
-                if not isinstance(v, unicode):
-                    v = v.decode('utf-8')
-                v = CString(v)
-            elif isinstance(v, int):
-                v = Int32(v)
-            elif isinstance(v, float):  # thanks, javascript
-                try:
-                    intv = int(round(v))
-                except ValueError:
-                    self.runtime.log_output("WARNING: illegal float value %s for appmessage key %s" % (v, k))
-                    intv = 0
-                v = Int32(intv)
-            elif isinstance(v, collections.Sequence):
-                b = bytearray()
-                for byte in v:
-                    if isinstance(byte, int):
-                        if 0 <= byte <= 255:
-                            b.append(byte)
-                        else:
-                            raise JSRuntimeException("Bytes must be between 0 and 255 inclusive.")
-                    elif isinstance(byte, str):  # This is intentionally not basestring; unicode won't work.
-                        b.extend(bytearray(byte))
-                    else:
-                        raise JSRuntimeException("Unexpected value in byte array.")
-                v = ByteArray(bytes(b))
-            elif v is None:
-                continue
-            else:
-                raise JSRuntimeException("Invalid value data type for key %s: %s" % (k, type(v)))
-            d[k] = v
-
-        tid = self._appmessage.send_message(self.uuid, d)
-        self.pending_acks[tid] = (success, failure)
+        self._pipeline.send(self._codec.encode(message), success, failure)
 
     def showSimpleNotificationOnPebble(self, title, message):
         self._check_ready()
-        Notifications(self.pebble, self.blobdb).send_notification(title, message)
+        self.notifications.push(title, message)
 
     def showNotificationOnPebble(self, opts):
         pass
@@ -199,19 +176,18 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
         self.runtime.open_config_page(url, self._handle_config_response)
 
     def _get_timeline_token(self):
-        if self._timeline_token is not None:
-            return self._timeline_token
-        result = requests.get(self.runtime.runner.urls.sandbox_token % self.uuid,
-                              headers={'Authorization': 'Bearer %s' % self.runtime.runner.oauth_token})
-        if result.status_code == 404:
-            raise TokenException("No token available; make sure the app is timeline enabled "
-                                 "and this user authorised in the developer portal.")
-        elif result.status_code == 401:
-            raise TokenException("User login rejected; make sure you are logged in to the SDK.")
+        return self.runtime.runner.timeline_tokens.get(self.runtime.runner.oauth_token, self.uuid)
+
+    def _timeline_request(self, method, url):
+        token = self._get_timeline_token()
+        result = self.runtime.runner.api.request(method, url, headers={'X-User-Token': token})
+        if result.status_code == 401:
+            # The token we had cached has probably been revoked; get a new one and try again.
+            self.runtime.runner.timeline_tokens.invalidate(self.runtime.runner.oauth_token, self.uuid)
+            token = self._get_timeline_token()
+            result = self.runtime.runner.api.request(method, url, headers={'X-User-Token': token})
         result.raise_for_status()
-        logger.debug("get_timeline_token result: %s", result.json())
-        self._timeline_token = result.json()['token']
-        return self._timeline_token
+        return result
 
     def getTimelineToken(self, success=None, failure=None):
         def go():
@@ -231,10 +207,7 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
 
     def _do_timeline_thing(self, method, topic, success, failure):
         try:
-            token = self._get_timeline_token()
-            result = requests.request(method, self.runtime.runner.urls.manage_subscription % urllib.quote(topic, safe=''),
-                                      headers={'X-User-Token': token})
-            result.raise_for_status()
+            self._timeline_request(method, self.runtime.runner.urls.manage_subscription % urllib.quote(topic, safe=''))
         except (requests.RequestException, TokenException) as e:
             if callable(failure):
                 self.runtime.enqueue(failure, str(e))
@@ -255,9 +228,7 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
     def timelineSubscriptions(self, success=None, failure=None):
         def go():
             try:
-                token = self._get_timeline_token()
-                result = requests.get(self.runtime.runner.urls.app_subscription_list, headers={'X-User-Token': token})
-                result.raise_for_status()
+                result = self._timeline_request("GET", self.runtime.runner.urls.app_subscription_list)
                 subs = v8.JSArray(result.json()['topics'])
             except (requests.RequestException, TokenException) as e:
                 if callable(failure):
@@ -284,39 +255,21 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
                                  "prefixes (%s) do not intersect!" % (available_prefixes, valid_prefixes))
 
 
-    def getActiveWatchInfo(self):
-        watch_info = self.pebble.watch_info
-
-        js_object = self.runtime.context.eval("({})")
+    def _build_watch_info(self):
         platform = self._infer_installed_platform()
-        js_object['platform'] = platform
-        model = self.pebble.watch_model  # Note: this could take a while.
-        model_map = {
-            Model.TintinBlack: "pebble_black",
-            Model.TintinRed: "pebble_red",
-            Model.TintinWhite: "pebble_white",
-            Model.TintinGrey: "pebble_gray",
-            Model.TintinOrange: "pebble_orange",
-            Model.TintinGreen: "pebble_green",
-            Model.TintinPink: "pebble_pink",
-            Model.TintinBlue: "pebble_blue",
-            Model.BiancaBlack: "pebble_steel_black",
-            Model.BiancaSilver: "pebble_steel_silver",
-            Model.SnowyWhite: "pebble_time_white",
-            Model.SnowyRed: "pebble_time_red",
-            Model.SnowyBlack: "pebble_time_black",
-        }
-        model = model_map.get(platform, 'qemu_platform_%s' % platform)
-        js_object['model'] = model
-        js_object['language'] = watch_info.language
-        firmware_obj = self.runtime.context.eval("({})")
         fw_version = self.pebble.firmware_version
-        firmware_obj['major'] = fw_version.major
-        firmware_obj['minor'] = fw_version.minor
-        firmware_obj['patch'] = fw_version.patch
-        firmware_obj['suffix'] = fw_version.suffix
-        js_object['firmware'] = firmware_obj
-        return js_object
+        return self.runtime.context.locals._make_watch_info(
+            platform, MODEL_NAMES.get(self._manager.watch_model, 'qemu_platform_%s' % platform),
+            self.pebble.watch_info.language, fw_version.major, fw_version.minor, fw_version.patch, fw_version.suffix)
+
+    def getActiveWatchInfo(self):
+        # Built once and reused until the app changes or the PebbleManager learns something new about the watch. It's
+        # frozen, so one caller can't change what the next one sees.
+        generation = self._manager.watch_info_generation
+        if self._watch_info is None or self._watch_info_generation != generation:
+            self._watch_info = self._build_watch_info()
+            self._watch_info_generation = generation
+        return self._watch_info
 
     def _handle_config_response(self, response):
         def go():
@@ -326,17 +279,29 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
         self.runtime.enqueue(go)
 
     def appGlanceReload(self, slices, success, failure):
+        expiry_times = [self._time_from_js(dict(x).get('expirationTime', None)) for x in slices]
         slices = [AppGlanceSlice(
-                    self._time_from_js(dict(x).get('expirationTime', None)),
+                    expiry_time,
                     AppGlanceSliceType.IconAndSubtitle,
                     TimelineAttributeSet(dict(x['layout']), self.runtime.runner.timeline, self.uuid).serialise())
-                  for x in slices]
+                  for x, expiry_time in zip(slices, expiry_times)]
+        now = self.runtime.clock.time()
         glance = AppGlance(
             version=1,
-            creation_time=int(time.time()),
+            creation_time=int(now),
             slices=(slices or [])
         )
         logger.debug("Constructed AppGlance: %s", glance)
+        # creation_time changes every time, so only the slices count towards whether anything changed.
+        digest = hashlib.sha1(''.join(x.serialise() for x in slices)).hexdigest()
+        # The glance only lapses once its last slice has expired; a slice with no expiry time never does.
+        expires = 0 if not expiry_times or 0 in expiry_times else max(expiry_times)
+
+        if self._manager.is_glance_current(self.uuid, digest, now):
+            logger.debug("Glance unchanged; not sending it again.")
+            if callable(success):
+                self.runtime.enqueue_from('pebble', success, slices, self.runtime.context.eval("({success: true})"))
+            return
 
         def handle_result(result):
             if result != BlobStatus.Success:
@@ -344,6 +309,7 @@ class Pebble(events.EventSourceMixin, v8.JSClass):
                 if callable(failure):
                     failure(slices, self.runtime.context.eval("({success: false})"))
             else:
+                self._manager.record_glance(self.uuid, digest, expires)
                 if callable(success):
                     success(slices, self.runtime.context.eval("({success: true})"))
 
@@ -2,19 +2,24 @@ from __future__ import absolute_import
 __author__ = 'katharine'
 
 import pypkjs.PyV8 as v8
-import time
 
 
 class Performance(object):
     # This is an approximation for now
-    def __init__(self, runtime):
-        self.extension = v8.JSExtension(runtime.ext_name("performance"), """
-            performance = new (function() {
-                native function _time();
+    extension = v8.JSExtension("runtime/performance", """
+        _init_performance = function(_time) {
+            this.performance = new (function() {
                 var start = _time();
 
                 this.now = function() {
                     return (_time() - start) * 1000;
                 };
             })();
-        """, lambda f: lambda: time.time())
+        };
+    """)
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def _prepare(self):
+        self.runtime.context.locals._init_performance(self.runtime.clock.time)
@@ -4,12 +4,17 @@ __author__ = 'katharine'
 import pypkjs.PyV8 as v8
 import gevent
 import gevent.pool
-import gevent.queue
 import gevent.hub
 import logging
+import time
+
+from pypkjs.clock import Clock
 
 from . import PebbleKitJS
 from .exceptions import JSRuntimeException
+from .metrics import EventLoopMetrics, AppMessageMetrics
+from .scheduler import EventScheduler
+from .watchdog import watchdog
 
 logger = logging.getLogger('pypkjs.javascript.pebble')
 
@@ -35,19 +40,71 @@ make_proxy_extension = v8.JSExtension("runtime/internal/proxy", """
         });
         return proxy;
     }
+    // The prototype variants are for classes with many instances: the wrappers are built once, on the
+    // prototype, and forward to the native object each instance keeps in its (non-enumerable) _origin.
+    function _make_prototype_proxies(proto, names) {
+        names.forEach(function(name) {
+            proto[name] = eval("(function " + name + "() { return this._origin[name].apply(this._origin, arguments); })");
+        });
+        return proto;
+    }
+    function _make_prototype_properties(proto, names) {
+        names.forEach(function(name) {
+            Object.defineProperty(proto, name, {
+                configurable: false,
+                enumerable: true,
+                get: function() {
+                    return this._origin[name];
+                },
+                set: function(value) {
+                    this._origin[name] = value;
+                }
+            });
+        });
+        return proto;
+    }
+    function _set_origin(proxy, origin) {
+        Object.defineProperty(proxy, '_origin', {value: origin});
+        return proxy;
+    }
 """)
 
 
 class JSRuntime(object):
-    def __init__(self, qemu, pbw, runner, persist_dir=None, block_private_addresses=False):
+    def __init__(self, qemu, pbw, runner, persist_dir=None, block_private_addresses=False, scheduler=None,
+                 code_cache=None, callback_cpu_budget=None, script_cpu_budget=None, clock=None, appmessage_window=4,
+                 appmessage_timeout=10.0, notification_rate=2.0, notification_dedupe_window=5.0,
+                 localstorage_durability='batched', localstorage_flush_interval=1.0, localstorage_quota=5242880,
+                 xhr_max_response_size=16777216, http_cache=None):
         self.group = gevent.pool.Group()
-        self.queue = gevent.queue.Queue()
+        self.queue = scheduler if scheduler is not None else EventScheduler()
+        self.metrics = EventLoopMetrics()
+        self.appmessage_metrics = AppMessageMetrics()
+        self.clock = clock if clock is not None else Clock()
+        if self.clock.is_virtual and self.clock.idle_check is None:
+            self.clock.idle_check = self._is_idle
         self.qemu = qemu
         self.pbw = pbw
         self.runner = runner
         self.runtime_id = JSRuntime.runtimeCount
         self.persist_dir = persist_dir
         self.block_private_addresses = block_private_addresses
+        self.code_cache = code_cache
+        self.callback_cpu_budget = callback_cpu_budget
+        self.script_cpu_budget = script_cpu_budget
+        self.appmessage_window = appmessage_window
+        self.appmessage_timeout = appmessage_timeout
+        self.notification_rate = notification_rate
+        self.notification_dedupe_window = notification_dedupe_window
+        self.localstorage_durability = localstorage_durability
+        self.localstorage_flush_interval = localstorage_flush_interval
+        self.localstorage_quota = localstorage_quota
+        self.xhr_max_response_size = xhr_max_response_size
+        self.http_cache = http_cache
+        self.idle_callbacks = []  # run whenever the event loop has nothing left to do
+        self.terminations = 0
+        self.pjs = None
+        self.context = None
         JSRuntime.runtimeCount += 1
 
     def setup(self):
@@ -59,19 +116,38 @@ class JSRuntime(object):
             self.context.eval("window = this;")
             self.pjs.do_post_setup()
 
+    def compile(self, src, filename):
+        engine = v8.JSEngine()
+        if self.code_cache is None:
+            return engine.compile(src, filename)
+        precompiled = self.code_cache.load(self.pbw.uuid, src)
+        if precompiled is None:
+            logger.debug("No code cache for %s; precompiling.", self.pbw.uuid)
+            precompiled = engine.precompile(src)
+            self.code_cache.store(self.pbw.uuid, src, precompiled)
+        return engine.compile(src, filename, precompiled=precompiled)
+
     def run(self, src, filename="pebble-js-app.js"):
-        self.setup()
+        # setup() doesn't depend on the app, so it may already have been done ahead of time.
+        if self.context is None:
+            self.setup()
+        self.pjs.bind()
 
         with self.context:
             # go!
             logger.info("JS starting")
+            budget = watchdog.budget(self.script_cpu_budget, ('script', filename))
             try:
-                self.context.eval(src, filename)
+                with budget:
+                    self.compile(src, filename).run()
             except (v8.JSSyntaxError) as e:
                 self.log_output(e.hint(src))
                 self.log_output("JS failed.")
             except (v8.JSError, JSRuntimeException) as e:
-                self.log_output(e.stackTrace)
+                if budget.terminated:
+                    self._report_termination(budget)
+                else:
+                    self.log_output(e.stackTrace)
                 self.log_output("JS failed.")
             except Exception as e:
                 self.log_output(e.message)
@@ -85,28 +161,84 @@ class JSRuntime(object):
                 logger.info("JS finished")
 
     def stop(self):
-        self.queue.put(StopIteration)
+        self.queue.put('runtime', StopIteration)
 
     def enqueue(self, fn, *args, **kwargs):
-        self.queue.put((fn, args, kwargs))
+        self.enqueue_from('runtime', fn, *args, **kwargs)
+
+    def enqueue_from(self, source, fn, *args, **kwargs):
+        self.queue.put(source, (fn, args, kwargs, source, time.time()))
+
+    def join(self, greenlet):
+        # For JS that has to block on a greenlet (e.g. a synchronous XHR), which may need to queue events to finish.
+        # Other runtimes can run in the meantime, so the CPU budget is paused too.
+        with self.queue.waiting_on(greenlet), watchdog.paused():
+            greenlet.join()
 
     def event_loop(self):
+        self.queue.consumer = gevent.getcurrent()
         try:
-            for fn, args, kwargs in self.queue:
-                try:
-                    fn(*args, **kwargs)
-                except (v8.JSError, JSRuntimeException) as e:
-                    self.log_output("Error running asynchronous JavaScript:")
-                    self.log_output(e.stackTrace)
+            while True:
+                self.metrics.record_depth(self.queue)
+                if self.queue.depth() == 0:
+                    self._run_idle_callbacks()
+                for item in self.queue.get_batch():
+                    if item is StopIteration:
+                        return
+                    fn, args, kwargs, source, enqueued = item
+                    started = time.time()
+                    budget = watchdog.budget(self.callback_cpu_budget, (source, fn))
+                    try:
+                        with budget:
+                            fn(*args, **kwargs)
+                    except (v8.JSError, JSRuntimeException) as e:
+                        if not budget.terminated:
+                            self.log_output("Error running asynchronous JavaScript:")
+                            self.log_output(e.stackTrace)
+                    finally:
+                        if budget.terminated:
+                            self._report_termination(budget)
+                        self.metrics.record_callback(source, enqueued, started, time.time())
         except gevent.hub.LoopExit:
             logger.warning("Runtime ran out of events; terminating.")
 
+    def _is_idle(self):
+        # Nothing for JS to run, and no AppMessage waiting on the watch.
+        if self.queue.depth():
+            return False
+        return self.pjs is None or self.pjs.pebble.appmessages_in_flight == 0
+
+    def _run_idle_callbacks(self):
+        for callback in self.idle_callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Idle callback %s failed.", callback)
+
+    def _report_termination(self, budget):
+        source, fn = budget.label
+        name = getattr(fn, 'name', None) or getattr(fn, '__name__', None) or repr(fn)
+        logger.warning("Terminated %s '%s' in %s after %ss of CPU time.", source, name, self.pbw.uuid, budget.seconds)
+        self.log_output("JS terminated: %s '%s' exceeded its CPU budget of %ss." % (source, name, budget.seconds))
+        self.terminations += 1
+        self.runner.record_js_termination(self.pbw.uuid)
+
+    def stats(self):
+        stats = {
+            'event_loop': self.metrics.snapshot(),
+            'appmessage': self.appmessage_metrics.snapshot(),
+        }
+        if self.http_cache is not None:
+            stats['http_cache'] = self.http_cache.stats()
+        if self.pjs is not None:
+            stats['notifications'] = self.pjs.pebble.notifications.stats()
+            if self.pjs.local_storage.storage is not None:
+                stats['localstorage'] = self.pjs.local_storage.storage.stats()
+        return stats
+
     def log_output(self, message):
         raise NotImplemented
 
-    def ext_name(self, name):
-        return "instance/%d/runtime/%s" % (self.runtime_id, name)
-
     def is_configurable(self):
         return 'configurable' in self.pbw.manifest['capabilities']
 
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import collections
+import contextlib
+import gevent
+import gevent.event
+
+LANE_WATCH = 'watch'
+LANE_TIMERS = 'timers'
+LANE_NETWORK = 'network'
+LANE_LIFECYCLE = 'lifecycle'
+
+# Where each source of callbacks gets queued. Anything unlisted is treated as lifecycle.
+SOURCE_LANES = {
+    'pebble': LANE_WATCH,
+    'timers': LANE_TIMERS,
+    'xhr': LANE_NETWORK,
+    'ws': LANE_NETWORK,
+    'geolocation': LANE_NETWORK,
+    'events': LANE_LIFECYCLE,
+    'runtime': LANE_LIFECYCLE,
+}
+
+Lane = collections.namedtuple('Lane', ('name', 'weight', 'max_depth'))
+
+DEFAULT_LANES = (
+    Lane(LANE_WATCH, 4, None),
+    Lane(LANE_LIFECYCLE, 2, None),
+    Lane(LANE_TIMERS, 2, None),
+    Lane(LANE_NETWORK, 1, 256),
+)
+
+
+class EventScheduler(object):
+    """
+    Holds callbacks waiting to run on a JSRuntime's event loop, split into lanes that are drained by weighted
+    round-robin. Lanes with a depth limit apply backpressure by blocking producers until there's room; the
+    consumer itself is never blocked, since it's the only thing that can make room, and nor is any greenlet the
+    consumer is waiting on (see waiting_on()).
+    """
+    def __init__(self, lanes=DEFAULT_LANES):
+        self.lanes = collections.OrderedDict((lane.name, lane) for lane in lanes)
+        self._queues = {name: collections.deque() for name in self.lanes}
+        self._has_room = {name: gevent.event.Event() for name in self.lanes}
+        self._not_empty = gevent.event.Event()
+        self._waited_on = set()
+        self.consumer = None
+
+    def lane_for(self, source):
+        lane = SOURCE_LANES.get(source, LANE_LIFECYCLE)
+        if lane not in self.lanes:
+            lane = next(iter(self.lanes))
+        return lane
+
+    def is_full(self, lane):
+        max_depth = self.lanes[lane].max_depth
+        return max_depth is not None and len(self._queues[lane]) >= max_depth
+
+    def depth(self, lane=None):
+        if lane is None:
+            return sum(len(q) for q in self._queues.itervalues())
+        return len(self._queues[lane])
+
+    def _may_overfill(self):
+        current = gevent.getcurrent()
+        return current is self.consumer or current in self._waited_on
+
+    @contextlib.contextmanager
+    def waiting_on(self, greenlet):
+        """
+        For the consumer to wrap a blocking wait on `greenlet`: until it's done, that greenlet can queue past a lane's
+        depth limit, since the consumer couldn't make room for it anyway.
+        """
+        self._waited_on.add(greenlet)
+        try:
+            yield
+        finally:
+            self._waited_on.discard(greenlet)
+
+    def put(self, source, item):
+        lane = self.lane_for(source)
+        while self.is_full(lane) and not self._may_overfill():
+            self._has_room[lane].clear()
+            self._has_room[lane].wait()
+        self._queues[lane].append(item)
+        self._not_empty.set()
+
+    def get_batch(self):
+        """
+        Blocks until something is queued, then returns up to one round's worth of work: each lane contributes at
+        most its weight in items.
+        """
+        while self.depth() == 0:
+            self._not_empty.clear()
+            self._not_empty.wait()
+        batch = []
+        for name, lane in self.lanes.iteritems():
+            queue = self._queues[name]
+            for i in xrange(min(lane.weight, len(queue))):
+                batch.append(queue.popleft())
+            if not self.is_full(name):
+                self._has_room[name].set()
+        return batch
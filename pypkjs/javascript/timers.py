@@ -2,31 +2,81 @@ from __future__ import absolute_import
 __author__ = 'katharine'
 
 import gevent
+import gevent.event
+import heapq
 import pypkjs.PyV8 as v8
 
+
+class _Timer(object):
+    __slots__ = ('key', 'fn', 'interval', 'deadline')
+
+    def __init__(self, key, fn, interval, deadline):
+        self.key = key
+        self.fn = fn
+        self.interval = interval
+        self.deadline = deadline
+
+
 class Timers(object):
+    # Once the heap holds this many more cancelled entries than live timers, we rebuild it.
+    COMPACT_SLACK = 64
+
+    extension = v8.JSExtension("runtime/timers", """
+    _init_timers = function(origin) {
+        _make_proxies(this, origin, ['setTimeout', 'clearTimeout', 'setInterval', 'clearInterval']);
+    };
+    """, dependencies=["runtime/internal/proxy"])
+
     def __init__(self, runtime):
         self.runtime = runtime
         self.timers = {}
         self.counter = 1
-        self.extension = v8.JSExtension(self.runtime.ext_name('timers'), """
-        (function() {
-            native function _timers();
-            _make_proxies(this, _timers(), ['setTimeout', 'clearTimeout', 'setInterval', 'clearInterval']);
-        })();
-        """, lambda f: lambda: self, dependencies=["runtime/internal/proxy"])
-
-    def _exec_timer(self, timer_key, timeout_s, repeat, fn):
+        self._heap = []
+        self._wakeup = gevent.event.Event()
+        self._scheduler = None
+
+    def _prepare(self):
+        self.runtime.context.locals._init_timers(self)
+
+    def _fire(self, timer):
+        if callable(timer.fn):
+            self.runtime.enqueue_from('timers', timer.fn)
+        else:
+            self.runtime.enqueue_from('timers', self.runtime.context.eval, timer.fn)
+
+    def _run_scheduler(self):
+        # A single greenlet services every timer in the runtime: it sleeps until the earliest deadline
+        # (or until a new, earlier timer is armed), then fires everything that has come due.
         while True:
-            gevent.sleep(timeout_s)
-            if timer_key in self.timers:
-                if callable(fn):
-                    self.runtime.enqueue(fn)
-                else:
-                    self.runtime.enqueue(self.runtime.context.eval, fn)
-                if not repeat:
+            self._wakeup.clear()
+            now = self.runtime.clock.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, timer_key = heapq.heappop(self._heap)
+                timer = self.timers.get(timer_key)
+                # Entries for cleared or rescheduled timers are left in the heap and skipped here.
+                if timer is None or timer.deadline != deadline:
+                    continue
+                self._fire(timer)
+                if timer.interval is None:
                     del self.timers[timer_key]
-                    break
+                else:
+                    # Schedule from the previous deadline rather than now, so intervals don't drift.
+                    # If we fell more than a whole interval behind, skip the missed ticks.
+                    timer.deadline = deadline + timer.interval
+                    if timer.deadline <= now:
+                        timer.deadline = now + timer.interval
+                    heapq.heappush(self._heap, (timer.deadline, timer_key))
+            if self._heap:
+                self.runtime.clock.wait(self._wakeup, self._heap[0][0] - now)
+            else:
+                self._wakeup.wait()
+
+    def _schedule(self, timer):
+        heapq.heappush(self._heap, (timer.deadline, timer.key))
+        if self._scheduler is None:
+            self._scheduler = self.runtime.group.spawn(self._run_scheduler)
+        elif self._heap[0][1] == timer.key:
+            self._wakeup.set()
 
     def _run_timer(self, fn, timeout_ms, repeat):
         if timeout_ms < 4:
@@ -37,18 +87,21 @@ class Timers(object):
         self.counter += 1
 
         timeout_s = timeout_ms / 1000.0
-        timer = self.runtime.group.spawn(self._exec_timer, timer_key, timeout_s, repeat, fn)
-
+        timer = _Timer(timer_key, fn, timeout_s if repeat else None,
+                       self.runtime.clock.time() + timeout_s)
         self.timers[timer_key] = timer
-        timer.start()
+        self._schedule(timer)
 
         return timer_id
 
     def _clear_timer(self, timer_id, repeat):
         timer_key = (timer_id, repeat)
         if timer_key in self.timers:
-            self.timers[timer_key].kill()
             del self.timers[timer_key]
+            if len(self._heap) > 2 * len(self.timers) + self.COMPACT_SLACK:
+                self._heap = [(deadline, key) for deadline, key in self._heap
+                              if key in self.timers and self.timers[key].deadline == deadline]
+                heapq.heapify(self._heap)
 
     def setTimeout(self, fn, timeout):
         return self._run_timer(fn, timeout, False)
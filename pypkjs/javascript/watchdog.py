@@ -0,0 +1,149 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import contextlib
+import ctypes
+from gevent import monkey
+import time
+
+import pypkjs.PyV8 as v8
+
+# Runaway JavaScript blocks the gevent hub, so the watchdog has to be a real OS thread. PyV8 releases the GIL while
+# it runs JavaScript, which lets this thread get in to terminate it.
+_start_new_thread = monkey.get_original('thread', 'start_new_thread')
+_allocate_lock = monkey.get_original('thread', 'allocate_lock')
+_sleep = monkey.get_original('time', 'sleep')
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+# The budget is for the JavaScript's thread alone, which the watchdog thread can only read through that thread's CPU
+# clock. Where there's no such thing, we fall back on the CPU time of the whole process.
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _pthread_self = _libc.pthread_self
+    _pthread_getcpuclockid = _libc.pthread_getcpuclockid
+    _clock_gettime = _libc.clock_gettime
+except (OSError, AttributeError):
+    _clock_gettime = None
+else:
+    _pthread_self.restype = ctypes.c_ulong
+    _pthread_getcpuclockid.argtypes = [ctypes.c_ulong, ctypes.POINTER(ctypes.c_int)]
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+
+def _current_thread_clock():
+    # Returns an id for the calling thread's CPU clock, or None to use the process's.
+    if _clock_gettime is None:
+        return None
+    clock_id = ctypes.c_int()
+    if _pthread_getcpuclockid(_pthread_self(), ctypes.byref(clock_id)) != 0:
+        return None
+    return clock_id.value
+
+
+def _cpu_time(clock_id):
+    if clock_id is None:
+        return time.clock()
+    ts = _Timespec()
+    if _clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+        return time.clock()
+    return ts.tv_sec + ts.tv_nsec / 1e9
+
+
+class CPUBudget(object):
+    def __init__(self, watchdog, seconds, label):
+        self.watchdog = watchdog
+        self.seconds = seconds
+        self.label = label
+        self.clock_id = None
+        self.started = None
+        self.terminated = False
+
+    def __enter__(self):
+        if self.seconds:
+            self.watchdog._arm(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.seconds:
+            self.watchdog._disarm(self)
+            if self.terminated:
+                self.watchdog._cancel_termination()
+                if exc_type is None:
+                    # The watchdog fired just as the JavaScript finished, so it wasn't actually cut short.
+                    self.terminated = False
+
+
+class Watchdog(object):
+    """
+    Terminates JavaScript execution that runs past its CPU budget. There's only one V8 engine per process and only one
+    piece of JavaScript can run at a time, so a single watchdog serves every runtime. JavaScript that blocks on gevent
+    must do so inside paused(), since other runtimes' JavaScript can run in the meantime.
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        self._lock = _allocate_lock()
+        self._budget = None
+        self._running = False
+
+    def budget(self, seconds, label):
+        return CPUBudget(self, seconds, label)
+
+    def _arm(self, budget):
+        if not self._running:
+            self._running = True
+            _start_new_thread(self._run, ())
+        clock_id = _current_thread_clock()
+        with self._lock:
+            budget.clock_id = clock_id
+            budget.started = _cpu_time(clock_id)
+            self._budget = budget
+
+    def _disarm(self, budget):
+        with self._lock:
+            if self._budget is budget:
+                self._budget = None
+
+    @contextlib.contextmanager
+    def paused(self):
+        # Sets the running budget aside, keeping count of the CPU time it has used so far, and picks it up again after.
+        with self._lock:
+            budget, self._budget = self._budget, None
+            if budget is not None:
+                used = _cpu_time(budget.clock_id) - budget.started
+        try:
+            yield
+        finally:
+            if budget is not None:
+                with self._lock:
+                    budget.started = _cpu_time(budget.clock_id) - used
+                    self._budget = budget
+
+    def _cancel_termination(self):
+        # If the termination landed after the JavaScript had already returned, V8 is still holding it for whatever
+        # runs next. Running something trivial here soaks it up; if it was already delivered, this is harmless.
+        try:
+            context = v8.JSContext.entered
+            if context is not None:
+                context.eval("undefined")
+        except v8.JSError:
+            pass
+
+    def _run(self):
+        # Nothing in here may touch gevent, or anything monkeypatched to use it (including logging).
+        while True:
+            _sleep(self.POLL_INTERVAL)
+            with self._lock:
+                budget = self._budget
+                if budget is None or _cpu_time(budget.clock_id) - budget.started < budget.seconds:
+                    continue
+                self._budget = None
+                budget.terminated = True
+                v8.JSEngine.terminateAllThreads()
+
+
+watchdog = Watchdog()
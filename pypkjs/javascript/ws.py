@@ -8,6 +8,7 @@ import websocket
 
 import pypkjs.PyV8 as v8
 from .exceptions import JSRuntimeException
+from . import binary
 from . import events
 
 close_event = v8.JSExtension("runtime/events/ws", """
@@ -49,20 +50,23 @@ ws = v8.JSExtension("runtime/ws", """
 _init_websocket = function(runtime, session) {
     native function _ws();
     this.WebSocket = function(url, protocols) {
-        var origin = new _ws(runtime, url, protocols);
-        _make_proxies(this, origin, ['close', 'send']);
-        _make_properties(this, origin, ['readyState', 'bufferedAmount', 'onopen', 'onerror', 'onclose', 'onmessage',
-                                        'extensions', 'protocol', 'binaryType']);
+        _set_origin(this, new _ws(runtime, url, protocols));
     };
+    _make_prototype_proxies(this.WebSocket.prototype, ['close', 'send']);
+    _make_prototype_properties(this.WebSocket.prototype, ['readyState', 'bufferedAmount', 'onopen', 'onerror',
+                                                          'onclose', 'onmessage', 'extensions', 'protocol',
+                                                          'binaryType']);
     this.WebSocket.CONNECTING = 0;
     this.WebSocket.OPEN = 1;
     this.WebSocket.CLOSING = 2;
     this.WebSocket.CLOSED = 3;
 }
-""", lambda f: WebSocket, dependencies=[close_event.name])
+""", lambda f: WebSocket, dependencies=[close_event.name, "runtime/internal/proxy", "runtime/binary"])
 
 
 class WebSocket(events.EventSourceMixin):
+    event_source = 'ws'
+
     CONNECTING = 0
     OPEN = 1
     CLOSING = 2
@@ -104,13 +108,8 @@ class WebSocket(events.EventSourceMixin):
             self.ws.send(data)
             return
         # yay, JavaScript
-        if str(data) in ['[object %sArray]' % x for x in ('Float32', 'Float64', 'Int16', 'Int32', 'Int8', 'Uint16',
-                                                            'Uint32', 'Uint8', 'Uint8Clamped')]:
-            data = data.buffer
-        if str(data) == '[object ArrayBuffer]':
-            uint8_array = self.runtime.context.locals.Uint8Array
-            data_array = uint8_array.create(uint8_array, (data,))
-            self.ws.send_binary(str(bytearray(data_array[str(x)] for x in xrange(data_array.length))))
+        if binary.is_binary(data):
+            self.ws.send_binary(binary.buffer_to_bytes(self.runtime, data))
 
     def handle_ws(self):
         try:
@@ -148,30 +147,29 @@ class WebSocket(events.EventSourceMixin):
             if self.readyState != self.OPEN:
                 return
             self.triggerEvent("message", MessageEvent(self.runtime, self.url, data))
-        self.runtime.enqueue(go)
+        self.runtime.enqueue_from('ws', go)
 
     def handle_binary(self, data):
         def go():
             if self.readyState != self.OPEN:
                 return
             if self.binaryType == "arraybuffer":
-                uint8_array = self.runtime.context.locals.Uint8Array
-                buffer = uint8_array.create(uint8_array, (v8.JSArray(list(bytearray(data))),)).buffer
+                buffer = binary.bytes_to_buffer(self.runtime, data)
                 self.triggerEvent("message", MessageEvent(self.runtime, self.url, buffer))
-        self.runtime.enqueue(go)
+        self.runtime.enqueue_from('ws', go)
 
     def handle_error(self, code, reason):
         def go():
             self.readyState = self.CLOSED
             self.triggerEvent("error")
             self.triggerEvent("close", CloseEvent(self.runtime, {'wasClean': False, code: code, reason: reason}))
-        self.runtime.enqueue(go)
+        self.runtime.enqueue_from('ws', go)
 
     def handle_closed(self, code=1000, reason=""):
         def go():
             self.readyState = self.CLOSED
             self.triggerEvent("close", CloseEvent(self.runtime, {'wasClean': True, code: code, reason: reason}))
-        self.runtime.enqueue(go)
+        self.runtime.enqueue_from('ws', go)
 
 
 def prepare_ws(runtime):
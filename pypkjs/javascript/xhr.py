@@ -3,11 +3,17 @@ __author__ = 'katharine'
 
 from gevent import monkey; monkey.patch_all()
 
+import codecs
+import json
 import requests
+import requests.adapters
 import requests.exceptions
+import time
 
 import pypkjs.PyV8 as v8
+from . import binary
 from . import events
+from .http_cache import CachingHTTPAdapter
 from .safe_requests import NonlocalHTTPAdapter
 from .exceptions import JSRuntimeException
 
@@ -42,13 +48,16 @@ xml_http_request = v8.JSExtension("runtime/xhr", """
 _init_xhr = function(runtime, session) {
     native function _xhr();
     this.XMLHttpRequest = function() {
-        var origin = new _xhr(runtime, session);
-        _make_proxies(this, origin, ['open', 'setRequestHeader', 'overrideMimeType', 'send', 'getResponseHeader',
-                                        'getAllResponseHeaders', 'abort', 'addEventListener', 'removeEventListener']);
-        _make_properties(this, origin, ['readyState', 'response', 'responseText', 'responseType', 'status',
-                                        'statusText', 'timeout', 'onreadystatechange', 'ontimeout', 'onload',
-                                        'onloadstart', 'onloadend', 'onprogress', 'onerror', 'onabort']);
-    }
+        _set_origin(this, new _xhr(runtime, session));
+    };
+    _make_prototype_proxies(this.XMLHttpRequest.prototype, ['open', 'setRequestHeader', 'overrideMimeType', 'send',
+                                                            'getResponseHeader', 'getAllResponseHeaders', 'abort',
+                                                            'addEventListener', 'removeEventListener']);
+    _make_prototype_properties(this.XMLHttpRequest.prototype, ['readyState', 'response', 'responseText',
+                                                               'responseType', 'status', 'statusText', 'timeout',
+                                                               'onreadystatechange', 'ontimeout', 'onload',
+                                                               'onloadstart', 'onloadend', 'onprogress', 'onerror',
+                                                               'onabort']);
     this.XMLHttpRequest.UNSENT = 0;
     this.XMLHttpRequest.OPENED = 1;
     this.XMLHttpRequest.HEADERS_RECEIVED = 2;
@@ -56,21 +65,27 @@ _init_xhr = function(runtime, session) {
     this.XMLHttpRequest.DONE = 4;
 
 }
-""", lambda f: XMLHttpRequest, dependencies=[progress_event.name])
+""", lambda f: XMLHttpRequest, dependencies=[progress_event.name, "runtime/internal/proxy",
+                                                                 "runtime/binary"])
 
 
 class XMLHttpRequest(events.EventSourceMixin):
+    event_source = 'xhr'
+
     UNSENT = 0
     OPENED = 1
     HEADERS_RECEIVED = 2
     LOADING = 3
     DONE = 4
 
+    CHUNK_SIZE = 8192
+    # Progress events are sent at most this often (in seconds), as the spec suggests.
+    PROGRESS_INTERVAL = 0.05
+
     def __init__(self, runtime, session):
         # properties
         self.readyState = self.UNSENT
         self.response = None
-        self.responseText = None
         self.responseType = ""
         self.status = None
         self.statusText = None
@@ -87,6 +102,7 @@ class XMLHttpRequest(events.EventSourceMixin):
         self.onabort = None
 
         # internal
+        self._state = self.UNSENT  # where the request really is; readyState follows as its events are dispatched
         self._request = None
         self._response = None
         self._async = False
@@ -95,16 +111,30 @@ class XMLHttpRequest(events.EventSourceMixin):
         self._session = session
         self._thread = None
         self._sent = False
+        self._text_parts = None  # the response text so far, if it's being decoded
+        self._loaded = 0
+        self._total = 0
 
         super(XMLHttpRequest, self).__init__(runtime)
 
+    @property
+    def responseText(self):
+        if self._text_parts is None:
+            return None
+        if len(self._text_parts) != 1:
+            self._text_parts[:] = [u''.join(self._text_parts)]
+        return self._text_parts[0]
+
 
     def open(self, method, url, async=True, user=None, password=None):
         self._request = requests.Request(method, url)
         if user is not None:
             self._request.auth = (user, password or "")
         self._async = async
-        self.readyState = self.OPENED
+        self._text_parts = None
+        self._loaded = 0
+        self._total = 0
+        self._state = self.readyState = self.OPENED
         self._trigger_async_event("readystatechange")
 
     def setRequestHeader(self, header, value):
@@ -115,16 +145,24 @@ class XMLHttpRequest(events.EventSourceMixin):
         self._request.headers[header] = value
 
     def overrideMimeType(self, mimetype):
-        if self.readyState >= self.LOADING:
+        if self._state >= self.LOADING:
             raise JSRuntimeException("The mime type cannot be overridden after the request starts loading.")
         self._mime_override = mimetype
 
     def _do_request_error(self, exception, event):
-        self.readyState = self.DONE
+        self._state = self.readyState = self.DONE
         if not self._async:
             raise Exception(exception)
         self._trigger_async_event("readystatechange")
 
+    def _progress(self):
+        return ProgressEvent, (self._runtime, self._total > 0, self._loaded, self._total)
+
+    def _do_send_busy(self):
+        # A virtual clock mustn't skip ahead while we wait on the network.
+        with self._runtime.clock.busy():
+            self._do_send()
+
     def _do_send(self):
         self._sent = True
         req = self._session.prepare_request(self._request)
@@ -133,53 +171,126 @@ class XMLHttpRequest(events.EventSourceMixin):
                 timeout = self.timeout / 1000.0
             else:
                 timeout = None
-            self._response = self._session.send(req, timeout=timeout, verify=True)
-            self.readyState = self.DONE
+            self._response = self._session.send(req, timeout=timeout, verify=True, stream=True)
             self.status = self._response.status_code
             self.statusText = self._response.reason
-            self.responseText = self._response.text
-
-            if self.responseType == "json":
-                self.response = self._response.json()
-            elif self.responseType == "arraybuffer":
-                self.response = v8.JSObject.create(self._runtime.context.locals.Uint8Array, (v8.JSArray(list(bytearray(self._response.content))),)).buffer
-            else:
-                self.response = self.responseText
-
-            self._trigger_async_event("load", ProgressEvent, (self._runtime,))
+            self._set_state(self.HEADERS_RECEIVED)
+            self._read_body()
+            self._set_state(self.DONE)
+            self._trigger_async_event("load", *self._progress())
+        except ResponseTooLarge as e:
+            self._text_parts = None
+            self.status = 0
+            self.statusText = str(e)
+            self._set_state(self.DONE)
+            self._trigger_async_event("error", *self._progress())
         except requests.exceptions.Timeout:
+            self._set_state(self.DONE)
             self._trigger_async_event("timeout", ProgressEvent, (self._runtime,))
-            self.readyState = self.DONE
         except requests.exceptions.RequestException as e:
             self.status = 0
             self.statusText = str(e)
-            self.readyState = self.DONE
+            self._set_state(self.DONE)
         finally:
-            self._trigger_async_event("loadend", ProgressEvent, (self._runtime,))
+            if self._response is not None:
+                self._response.close()
+            if self._state != self.DONE:
+                self._set_state(self.DONE)
+            self._trigger_async_event("loadend", *self._progress())
+
+    def _set_state(self, state):
+        # The send greenlet runs ahead of the event loop, so readyState only changes as the readystatechange event for
+        # the new state is dispatched. Handlers then see the state their event is about. A synchronous send() blocks
+        # the event loop until the request is done, so there readyState has to be current as soon as send() returns.
+        self._state = state
+        if not self._async:
+            self.readyState = state
             self._trigger_async_event("readystatechange")
+        else:
+            self._trigger_async_event("readystatechange", ready_state=state)
 
-    def _trigger_async_event(self, event_name, event=None, event_params=(), params=()):
-        def go():
-            if event is not None:
-                self.triggerEvent(event_name, event(*event_params), *params)
+    def _read_body(self):
+        # Reads the body a chunk at a time, keeping only what responseType needs: raw bytes for an arraybuffer,
+        # otherwise just the decoded text.
+        limit = self._runtime.xhr_max_response_size
+        headers = self._response.headers
+        try:
+            # With a Content-Encoding, the length is of the encoded body, which isn't what we count.
+            if 'content-encoding' not in headers:
+                self._total = int(headers.get('content-length', 0))
+        except ValueError:
+            pass
+        if limit and self._total > limit:
+            raise ResponseTooLarge(limit)
+
+        chunks = None
+        decoder = None
+        if self.responseType == "arraybuffer":
+            chunks = []
+        else:
+            self._text_parts = []
+            try:
+                decoder_class = codecs.getincrementaldecoder(self._response.encoding or 'utf-8')
+            except LookupError:
+                # A charset Python doesn't know; .text would have fallen back too.
+                decoder_class = codecs.getincrementaldecoder('utf-8')
+            decoder = decoder_class(errors='replace')
+
+        last_progress = 0
+        reported = 0
+        for chunk in self._response.iter_content(self.CHUNK_SIZE):
+            self._loaded += len(chunk)
+            if limit and self._loaded > limit:
+                raise ResponseTooLarge(limit)
+            if decoder is not None:
+                self._text_parts.append(decoder.decode(chunk))
             else:
-                self.triggerEvent(event_name, *params)
+                chunks.append(chunk)
+            if self._state == self.LOADING and time.time() - last_progress < self.PROGRESS_INTERVAL:
+                continue
+            last_progress = time.time()
+            reported = self._loaded
+            self._set_state(self.LOADING)
+            self._trigger_async_event("progress", *self._progress())
+        if reported != self._loaded:
+            self._trigger_async_event("progress", *self._progress())
+        if decoder is not None:
+            self._text_parts.append(decoder.decode('', final=True))
+
+        if self.responseType == "json":
+            try:
+                self.response = json.loads(self.responseText)
+            except ValueError:
+                self.response = None
+        elif self.responseType == "arraybuffer":
+            self.response = binary.bytes_to_buffer(self._runtime, ''.join(chunks))
+        else:
+            self.response = self.responseText
+
+    def _trigger_async_event(self, event_name, event=None, event_params=(), params=(), ready_state=None):
+        def go():
+            dispatch = self._event_dispatcher(event_name, event(*event_params) if event is not None else None, params)
+
+            def dispatch_in_state():
+                if ready_state is not None:
+                    self.readyState = ready_state
+                dispatch()
+            dispatch_in_state.__name__ = dispatch.__name__
+            self._runtime.enqueue_from(self.event_source, dispatch_in_state)
         if self._async:
             go()
         else:
-            self._runtime.enqueue(go)
+            self._runtime.enqueue_from('xhr', go)
 
     def send(self, data=None):
         if data is not None:
-            if not isinstance(data, basestring) and str(data) == '[object ArrayBuffer]':
-                uint8_array = self._runtime.context.locals.Uint8Array
-                data_array = uint8_array.create(uint8_array, (data,))
-                self._request.data = bytes(bytearray(data_array[str(x)] for x in xrange(data_array.length)))
+            if binary.is_binary(data):
+                self._request.data = binary.buffer_to_bytes(self._runtime, data)
             else:
                 self._request.data = str(data)
-        self._thread = self._runtime.group.spawn(self._do_send)
+        self._thread = self._runtime.group.spawn(self._do_send_busy)
         if not self._async:
-            self._thread.join()
+            self._runtime.join(self._thread)
 
     def getResponseHeader(self, header):
         if self._response is not None:
@@ -198,10 +309,19 @@ class XMLHttpRequest(events.EventSourceMixin):
             self._thread.kill(block=False)
 
 
+class ResponseTooLarge(Exception):
+    def __init__(self, limit):
+        Exception.__init__(self, "Response exceeded the maximum size of %d bytes." % limit)
+
+
 def prepare_xhr(runtime):
     session = requests.Session()
+    adapter = None
     if runtime.block_private_addresses:
         adapter = NonlocalHTTPAdapter()
+    if runtime.http_cache is not None:
+        adapter = CachingHTTPAdapter(runtime.http_cache, adapter or requests.adapters.HTTPAdapter())
+    if adapter is not None:
         session.mount('http://', adapter)
         session.mount('https://', adapter)
     return runtime.context.locals._init_xhr(runtime, session)
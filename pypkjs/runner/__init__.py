@@ -20,19 +20,34 @@ from libpebble2.util.bundle import PebbleBundle
 from libpebble2.services.appmessage import AppMessageService
 import pypkjs.javascript as javascript
 import pypkjs.javascript.runtime
+from pypkjs.clock import Clock, VirtualClock
+from pypkjs.javascript.code_cache import CodeCache
+from pypkjs.javascript.http_cache import HTTPCache
+from pypkjs.javascript.localstorage import open_app_store
+from pypkjs.javascript.logstore import LogStore
 from .pebble_manager import PebbleManager
+from .pool import RuntimePool
+from .worker import WorkerRuntime
 from pypkjs.timeline import PebbleTimeline
+from pypkjs.timeline.http import APISession
+from pypkjs.timeline.tokens import TimelineTokenCache
 from pypkjs.timeline.urls import URLManager
 
 
 class Runner(object):
     PBW = collections.namedtuple('PBW', ('uuid', 'src', 'manifest', 'layouts', 'prefixes'))
 
-    def __init__(self, qemu, pbws, persist_dir=None, oauth_token=None, layout_file=None, block_private_addresses=False):
+    def __init__(self, qemu, pbws, persist_dir=None, oauth_token=None, layout_file=None, block_private_addresses=False,
+                 js_pool_size=0, js_pool_refill_delay=1.0, js_callback_budget=None, js_script_budget=None,
+                 js_worker=False, virtual_time=False, appmessage_window=4, appmessage_timeout=10.0,
+                 api_pool_size=10, api_connect_timeout=5.0, api_read_timeout=30.0, notification_rate=2.0,
+                 notification_dedupe_window=5.0, localstorage_durability='batched', localstorage_flush_interval=1.0,
+                 localstorage_quota=5242880, xhr_max_response_size=16777216, http_cache_size=0):
         self.qemu = qemu
         self.pebble = PebbleManager(qemu)
         self.persist_dir = persist_dir
         self.oauth_token = oauth_token
+        self.layout_file = layout_file
         self.pebble.handle_start = self.handle_start
         self.pebble.handle_stop = self.handle_stop
         # PBL-26034: Due to PBL-24009 we must be sure to respond to appmessages received with no JS running.
@@ -43,9 +58,31 @@ class Runner(object):
         self.logger = logging.getLogger("pypkjs")
         self.running_uuid = None
         self.js = None
+        self._real_clock = Clock()
+        self.code_cache = CodeCache(persist_dir)
+        self.http_cache_size = http_cache_size
+        self.http_cache = HTTPCache(persist_dir, max_size=http_cache_size) if http_cache_size else None
         self.urls = URLManager()
+        self.api = APISession(pool_size=api_pool_size, connect_timeout=api_connect_timeout,
+                              read_timeout=api_read_timeout)
+        self.timeline_tokens = TimelineTokenCache(self.urls, self.api, persist_dir)
         self.timeline = PebbleTimeline(self, persist=persist_dir, oauth=oauth_token, layout_file=layout_file)
         self.block_private_addresses = block_private_addresses
+        self.js_callback_budget = js_callback_budget
+        self.js_script_budget = js_script_budget
+        self.js_terminations = collections.Counter()
+        self.js_worker = js_worker
+        self.virtual_time = virtual_time
+        self.appmessage_window = appmessage_window
+        self.appmessage_timeout = appmessage_timeout
+        self.notification_rate = notification_rate
+        self.notification_dedupe_window = notification_dedupe_window
+        self.localstorage_durability = localstorage_durability
+        self.localstorage_flush_interval = localstorage_flush_interval
+        self.localstorage_quota = localstorage_quota
+        self.xhr_max_response_size = xhr_max_response_size
+        self.localstorage_usage = {}  # app uuid -> bytes of localStorage, as of its last launch
+        self.runtime_pool = RuntimePool(self._create_runtime, size=js_pool_size, refill_delay=js_pool_refill_delay)
         self.load_cached_pbws()
         self.load_pbws(pbws)
 
@@ -70,8 +107,12 @@ class Runner(object):
                         layouts[platform] = {}
             manifest = json.loads(appinfo)
             uuid = UUID(manifest['uuid'])
-            if cache and self._pbw_cache_dir is not None:
-                shutil.copy(pbw_path, os.path.join(self._pbw_cache_dir, '%s.pbw' % uuid))
+            if cache:
+                # This is a (re)install, so anything we compiled for a previous version is stale.
+                self.code_cache.invalidate(uuid)
+                self.pebble.forget_glance(uuid)
+                if self._pbw_cache_dir is not None:
+                    shutil.copy(pbw_path, os.path.join(self._pbw_cache_dir, '%s.pbw' % uuid))
             self.pbws[uuid] = self.PBW(uuid, src, manifest, layouts, prefixes)
             if start:
                 self.start_js(self.pbws[uuid])
@@ -98,12 +139,69 @@ class Runner(object):
         if pbw.src is None:
             return
         self.running_uuid = pbw.uuid
-        self.js = javascript.runtime.JSRuntime(self.pebble, pbw, self, persist_dir=self.persist_dir,
-                                               block_private_addresses=self.block_private_addresses)
-        self.js.log_output = lambda m: self.log_output(m)
-        self.js.open_config_page = lambda url, callback: self.open_config_page(url, callback)
+        if self.js_worker:
+            self.js = self._attach_runtime(WorkerRuntime(self, pbw))
+        else:
+            self.js = self.runtime_pool.take()
+            self.js.pbw = pbw
         gevent.spawn(self.js.run, pbw.src)
 
+    def _create_runtime(self):
+        return self._attach_runtime(javascript.runtime.JSRuntime(
+            self.pebble, None, self, persist_dir=self.persist_dir, block_private_addresses=self.block_private_addresses,
+            code_cache=self.code_cache, callback_cpu_budget=self.js_callback_budget,
+            script_cpu_budget=self.js_script_budget,
+            clock=VirtualClock() if self.virtual_time else None, appmessage_window=self.appmessage_window,
+            appmessage_timeout=self.appmessage_timeout, notification_rate=self.notification_rate,
+            notification_dedupe_window=self.notification_dedupe_window,
+            localstorage_durability=self.localstorage_durability,
+            localstorage_flush_interval=self.localstorage_flush_interval,
+            localstorage_quota=self.localstorage_quota, xhr_max_response_size=self.xhr_max_response_size,
+            http_cache=self.http_cache))
+
+    def _attach_runtime(self, js):
+        js.log_output = lambda m: self.log_output(m)
+        js.open_config_page = lambda url, callback: self.open_config_page(url, callback)
+        return js
+
+    def record_js_termination(self, uuid):
+        self.js_terminations[str(uuid)] += 1
+
+    def record_localstorage_usage(self, uuid, size):
+        self.localstorage_usage[str(uuid)] = size
+
+    def dump_localstorage(self, uuid):
+        # Returns None if the app's JS is running somewhere we can't reach its store.
+        if uuid == self.running_uuid:
+            # The running app has its store open, possibly with changes that haven't reached the disk yet.
+            if isinstance(self.js, WorkerRuntime) or self.js.pjs is None:
+                return None
+            storage = self.js.pjs.local_storage.storage
+            if storage is None:
+                return None
+            storage.flush()
+            return storage.dump()
+        store = open_app_store(self.persist_dir, uuid)
+        try:
+            return store.dump()
+        finally:
+            if store.path is not None:
+                store.close()
+
+    def load_localstorage(self, uuid, data):
+        # Replaces all of an app's localStorage at once. Raises ValueError if the data is damaged or over quota.
+        items = LogStore.parse_dump(data)
+        size = sum(len(key) + len(value) for key, value in items)
+        if self.localstorage_quota and size > self.localstorage_quota:
+            raise ValueError("%d bytes of localStorage exceeds the quota of %d bytes." % (size, self.localstorage_quota))
+        store = open_app_store(self.persist_dir, uuid)
+        try:
+            store.update(items)
+        finally:
+            if store.path is not None:
+                store.close()
+        self.record_localstorage_usage(uuid, size)
+
     def timeline_mapping_for_app(self, app_uuid):
         try:
             pbw = self.pbws[app_uuid]
@@ -111,6 +209,12 @@ class Runner(object):
             return None
         return pbw.layouts.get(self.pebble.pebble.watch_platform, {})
 
+    @property
+    def clock(self):
+        # The running app's clock. A worker's lives in its own process, so with a worker this is real time.
+        clock = getattr(self.js, 'clock', None)
+        return clock if clock is not None else self._real_clock
+
     def stop_js(self):
         if self.js is not None:
             self.js.stop()
@@ -120,6 +224,8 @@ class Runner(object):
     def run(self):
         self.logger.info('Connecting to pebble')
         greenlet = self.pebble.connect()
+        if not self.js_worker:
+            self.runtime_pool.fill()
         if self.pebble.timeline_is_supported:
             self.timeline.continuous_sync()
             self.timeline.do_maintenance()
@@ -133,6 +239,22 @@ class Runner(object):
     def watch_token(self):
         return "0123456789abcdef0123456789abcdef"
 
+    def get_stats(self):
+        stats = {
+            'running_uuid': str(self.running_uuid) if self.running_uuid is not None else None,
+            'runtime_pool': self.runtime_pool.stats(),
+            'js_terminations': dict(self.js_terminations),
+            'timeline_tokens': self.timeline_tokens.stats(),
+            'api_connections': self.api.stats(),
+            'skipped_glance_writes': self.pebble.skipped_glance_writes,
+        }
+        if self.js is not None:
+            stats.update(self.js.stats())
+        usage = stats['localstorage_usage'] = dict(self.localstorage_usage)
+        if self.running_uuid is not None and 'localstorage' in stats:
+            usage[str(self.running_uuid)] = stats['localstorage']['bytes']
+        return stats
+
     def do_config(self):
         if self.js is None:
             self.log_output("No JS found, can't show configuration.")
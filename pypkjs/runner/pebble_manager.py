@@ -10,6 +10,7 @@ from libpebble2.communication.transports.qemu import QemuTransport, MessageTarge
 from libpebble2.communication.transports.qemu.protocol import QemuBluetoothConnection
 from libpebble2.protocol.apps import *
 from libpebble2.protocol.legacy2 import LegacyAppLaunchMessage
+from libpebble2.protocol.system import WatchVersion, WatchVersionResponse
 from libpebble2.services.appmessage import AppMessageService, Uint8
 from libpebble2.services.blobdb import BlobDBClient
 
@@ -25,11 +26,17 @@ class PebbleManager(object):
         self.handle_stop = None
         self.blobdb = None
         self.launcher = None
+        # Bumped whenever what we know about the watch may have changed, so anything derived from it can be rebuilt.
+        self.watch_info_generation = 0
+        # uuid -> (hash of the slices, when they expire) for the last AppGlance the watch accepted for each app.
+        self._app_glances = {}
+        self.skipped_glance_writes = 0
 
     def connect(self):
         self.pebble.connect()
         greenlet = gevent.spawn(self.pebble.run_sync)
         self.pebble.fetch_watch_info()
+        self.invalidate_watch_info()
         self.register_endpoints()
         self.pebble.transport.send_packet(QemuBluetoothConnection(connected=True), target=MessageTargetQemu())
         self.blobdb = BlobDBClient(self.pebble)
@@ -43,6 +50,7 @@ class PebbleManager(object):
 
     def register_endpoints(self):
         self.pebble.register_endpoint(AppRunState, self.handle_lifecycle)
+        self.pebble.register_endpoint(WatchVersion, self.handle_watch_version)
         self.launcher = AppMessageService(self.pebble, message_type=LegacyAppLaunchMessage)
         self.launcher.register_handler("appmessage", self.handle_launcher)
     
@@ -60,6 +68,39 @@ class PebbleManager(object):
             if callable(self.handle_stop):
                 self.handle_stop(packet.data.uuid)
 
+    def handle_watch_version(self, packet):
+        # Someone asked the watch for its version again; that happens after a firmware change.
+        if isinstance(packet.data, WatchVersionResponse):
+            self.invalidate_watch_info()
+
+    def invalidate_watch_info(self):
+        self._app_glances.clear()
+        self.watch_info_generation += 1
+
+    def is_glance_current(self, app_uuid, digest, now):
+        # Rewriting a glance identical to the one the watch already has is a waste of a slow link, unless it's expired
+        # (in which case the watch may have thrown it away).
+        try:
+            current, expires = self._app_glances[app_uuid]
+        except KeyError:
+            return False
+        if current != digest or (expires and expires <= now):
+            return False
+        self.skipped_glance_writes += 1
+        return True
+
+    def record_glance(self, app_uuid, digest, expires):
+        self._app_glances[app_uuid] = (digest, expires)
+
+    def forget_glance(self, app_uuid):
+        # Installing an app replaces whatever glance the watch had for it.
+        self._app_glances.pop(app_uuid, None)
+
+    @property
+    def watch_model(self):
+        # libpebble2 only asks the watch once; the hardware model can't change under us.
+        return self.pebble.watch_model
+
     def handle_launcher(self, txid, uuid, message):
         state = message[LegacyAppLaunchMessage.Keys.RunState]
         if state == LegacyAppLaunchMessage.States.Running:
@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import collections
+import gevent
+import logging
+
+logger = logging.getLogger("pypkjs.runner.pool")
+
+
+class RuntimePool(object):
+    """
+    Keeps up to `size` JSRuntimes with their contexts already set up, so launching an app only has to run the app's
+    own script. After a warm runtime is handed out, a replacement is prepared once `refill_delay` seconds have passed
+    (so the work stays off the launch's critical path); a negative delay disables refilling.
+    """
+    def __init__(self, factory, size=0, refill_delay=1.0):
+        self.factory = factory
+        self.size = size
+        self.refill_delay = refill_delay
+        self.warm_launches = 0
+        self.cold_launches = 0
+        self._ready = collections.deque()
+        self._filling = False
+
+    def _fill(self):
+        try:
+            while len(self._ready) < self.size:
+                runtime = self.factory()
+                runtime.setup()
+                self._ready.append(runtime)
+                logger.debug("Warmed runtime %d (%d/%d ready)", runtime.runtime_id, len(self._ready), self.size)
+                gevent.sleep(0)
+        except Exception:
+            logger.exception("Failed to warm a JS runtime.")
+        finally:
+            self._filling = False
+
+    def fill(self, delay=0):
+        if self.size <= 0 or self._filling or len(self._ready) >= self.size:
+            return
+        self._filling = True
+        gevent.spawn_later(delay, self._fill)
+
+    def take(self):
+        if self._ready:
+            runtime = self._ready.popleft()
+            self.warm_launches += 1
+            logger.info("Using warm runtime %d.", runtime.runtime_id)
+        else:
+            runtime = self.factory()
+            self.cold_launches += 1
+        if self.refill_delay >= 0:
+            self.fill(self.refill_delay)
+        return runtime
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'ready': len(self._ready),
+            'warm_launches': self.warm_launches,
+            'cold_launches': self.cold_launches,
+        }
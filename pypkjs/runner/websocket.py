@@ -16,11 +16,13 @@ import struct
 import sys
 import tempfile
 import traceback
+import uuid
 
 from libpebble2.communication.transports.qemu import MessageTargetQemu
 from libpebble2.services.install import AppInstaller
 
 from . import Runner
+from ..javascript.logstore import LogStore
 from ..version import __version__
 
 
@@ -47,8 +49,7 @@ class Websocket(object):
 
 
 class WebsocketRunner(Runner):
-    def __init__(self, qemu, pbws, port, token=None, ssl_root=None, persist_dir=None, oauth_token=None,
-                 layout_file=None, block_private_addresses=False):
+    def __init__(self, qemu, pbws, port, token=None, ssl_root=None, **kwargs):
         self.port = port
         self.token = token
         self.requires_auth = (token is not None)
@@ -57,11 +58,12 @@ class WebsocketRunner(Runner):
         self.websockets = []
         self.ssl_root = ssl_root
         self.config_callback = None
-        super(WebsocketRunner, self).__init__(qemu, pbws, persist_dir=persist_dir, oauth_token=oauth_token,
-                                              layout_file=layout_file, block_private_addresses=block_private_addresses)
+        super(WebsocketRunner, self).__init__(qemu, pbws, **kwargs)
 
     def run(self):
         pebble_greenlet = self.pebble.connect()
+        if not self.js_worker:
+            self.runtime_pool.fill()
         self.pebble.pebble.register_raw_inbound_handler(self._handle_inbound)
         self.pebble.pebble.register_raw_outbound_handler(self._handle_outbound)
         if self.pebble.timeline_is_supported:
@@ -141,6 +143,8 @@ class WebsocketRunner(Runner):
             0x0a: self.do_config_ws,
             0x0b: self.do_qemu_command,
             0x0c: self.do_timeline_command,
+            0x0d: self.do_stats,
+            0x0e: self.do_localstorage,
         }
 
         if opcode in opcode_handlers:
@@ -231,6 +235,48 @@ class WebsocketRunner(Runner):
             self.log_output("Pin insert failed: %s: %s" % (type(e).__name__, e.message))
             ws.send(bytearray([0x0c, 0x01]))
 
+    @must_auth
+    def do_stats(self, ws, message):
+        try:
+            ws.send(bytearray('\x0d' + json.dumps(self.get_stats())))
+        except WebSocketError:
+            pass
+
+    @must_auth
+    def do_localstorage(self, ws, message):
+        # Request: command (0x01 dump, 0x02 load), 16-byte app UUID, then for loads the data from a dump.
+        # Response: command, status (0x00 ok, 0x01 failed, 0x02 app running), then for dumps the data.
+        command = message[0] if len(message) > 0 else 0x00
+        data = ''
+        try:
+            if len(message) < 17:
+                raise ValueError("Expected a command and a 16-byte UUID; got %d bytes." % len(message))
+            app_uuid = uuid.UUID(bytes=str(message[1:17]))
+            if command == 0x01:
+                data = self.dump_localstorage(app_uuid)
+                if data is None:
+                    status = 0x02
+                    data = ''
+                else:
+                    status = 0x00
+            elif command == 0x02:
+                if app_uuid == self.running_uuid:
+                    status = 0x02
+                else:
+                    self.load_localstorage(app_uuid, str(message[17:]))
+                    status = 0x00
+            else:
+                return
+        except Exception as e:
+            traceback.print_exc()
+            self.log_output("localStorage %s failed: %s: %s" % ('dump' if command == 0x01 else 'load',
+                                                                type(e).__name__, e))
+            status = 0x01
+        try:
+            ws.send(bytearray([0x0e, command, status]) + bytearray(data))
+        except WebSocketError:
+            pass
+
 
 class WebsocketLogHandler(logging.Handler):
     def __init__(self, ws_runner, *args, **kwargs):
@@ -259,6 +305,44 @@ def run_tool():
     parser.add_argument('--layout', default=None, help="Path to a firmware layout.json file on disk.")
     parser.add_argument('--debug', action='store_true', help="Very, very verbose debug spew.")
     parser.add_argument('--block-private-addresses', action='store_true', help="Disable access to private IPs.")
+    parser.add_argument('--js-pool-size', default=0, type=int,
+                        help="Number of JS runtimes to keep set up in advance for fast app launches.")
+    parser.add_argument('--js-pool-refill-delay', default=1.0, type=float,
+                        help="Seconds to wait after a launch before warming a replacement runtime (negative: never).")
+    parser.add_argument('--js-callback-budget', default=0, type=float,
+                        help="Seconds of CPU time a JS callback may use before it is terminated (default: unlimited).")
+    parser.add_argument('--js-script-budget', default=0, type=float,
+                        help="Seconds of CPU time an app's initial script evaluation may use (default: unlimited).")
+    parser.add_argument('--js-worker', action='store_true',
+                        help="Run each app's JS in its own process, keeping the watch connection responsive.")
+    parser.add_argument('--appmessage-window', default=4, type=int,
+                        help="Number of AppMessages that may await a response from the watch at once "
+                             "(0: as many as there are transaction ids).")
+    parser.add_argument('--appmessage-timeout', default=10.0, type=float,
+                        help="Seconds to wait for an AppMessage ack or nack before failing it (0: forever).")
+    parser.add_argument('--notification-rate', default=2.0, type=float,
+                        help="Simple notifications to send to the watch per second (0: unlimited).")
+    parser.add_argument('--notification-dedupe-window', default=5.0, type=float,
+                        help="Seconds during which a repeated notification with the same title and body is dropped.")
+    parser.add_argument('--localstorage-durability', default='batched', choices=LogStore.DURABILITY_MODES,
+                        help="When localStorage changes are written to disk: as each happens, in batches (on a timer "
+                             "and whenever JS is idle), or only when the app exits.")
+    parser.add_argument('--localstorage-flush-interval', default=1.0, type=float,
+                        help="Longest time, in seconds, a batched localStorage change waits to be written.")
+    parser.add_argument('--localstorage-quota', default=5242880, type=int,
+                        help="Bytes of localStorage (keys and values) each app may use (0: unlimited).")
+    parser.add_argument('--xhr-max-response-size', default=16777216, type=int,
+                        help="Largest response body, in bytes, an app's XMLHttpRequest may receive (0: unlimited).")
+    parser.add_argument('--http-cache-size', default=0, type=int,
+                        help="Bytes of apps' HTTP responses to cache, under the persist directory if given (0: no cache).")
+    parser.add_argument('--api-pool-size', default=10, type=int,
+                        help="Keep-alive connections to keep per host for pypkjs's own web service calls.")
+    parser.add_argument('--api-connect-timeout', default=5.0, type=float,
+                        help="Seconds to wait when connecting to Pebble's web services.")
+    parser.add_argument('--api-read-timeout', default=30.0, type=float,
+                        help="Seconds to wait for a response from Pebble's web services.")
+    parser.add_argument('--virtual-time', action='store_true',
+                        help="Run JS timers, performance.now and Date on a virtual clock that skips time the JS spends idle.")
     parser.add_argument('pbws', nargs='*', help="Set of pbws.")
     args = parser.parse_args(sys.argv[1:])
     logging.basicConfig()
@@ -268,5 +352,17 @@ def run_tool():
         logging.getLogger().setLevel(logging.INFO)
     runner = WebsocketRunner(args.qemu,args.pbws, args.port, token=args.token, ssl_root=args.ssl_root,
                              persist_dir=args.persist, oauth_token=args.oauth, layout_file=args.layout,
-                             block_private_addresses=args.block_private_addresses)
+                             block_private_addresses=args.block_private_addresses,
+                             js_pool_size=args.js_pool_size, js_pool_refill_delay=args.js_pool_refill_delay,
+                             js_callback_budget=args.js_callback_budget, js_script_budget=args.js_script_budget,
+                             js_worker=args.js_worker, virtual_time=args.virtual_time,
+                             appmessage_window=args.appmessage_window, appmessage_timeout=args.appmessage_timeout,
+                             api_pool_size=args.api_pool_size, api_connect_timeout=args.api_connect_timeout,
+                             api_read_timeout=args.api_read_timeout, notification_rate=args.notification_rate,
+                             notification_dedupe_window=args.notification_dedupe_window,
+                             localstorage_durability=args.localstorage_durability,
+                             localstorage_flush_interval=args.localstorage_flush_interval,
+                             localstorage_quota=args.localstorage_quota,
+                             xhr_max_response_size=args.xhr_max_response_size,
+                             http_cache_size=args.http_cache_size)
     runner.run()
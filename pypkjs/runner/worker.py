@@ -0,0 +1,572 @@
+from __future__ import absolute_import
+"""
+Hosts a JSRuntime in a child process, so that the V8 work doesn't share a gevent hub with the watch connection and the
+phone websocket.
+
+The parent side is a WorkerRuntime, which stands in for a JSRuntime as far as the Runner is concerned. The child side,
+run with `python -m pypkjs.runner.worker <fd>`, gives a real JSRuntime stand-ins for the PebbleManager, AppMessage
+service and Runner which forward over a socket to the parent. Timers and localStorage run directly in the child;
+localStorage shares the persist directory with the parent.
+"""
+
+__author__ = 'katharine'
+
+from gevent import monkey
+monkey.patch_all()
+
+import collections
+import cPickle
+import gevent
+import gevent.event
+import gevent.lock
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+
+import libpebble2.services.appmessage as appmessage_types
+import requests
+
+from pypkjs.timeline.tokens import TokenException
+
+logger = logging.getLogger("pypkjs.runner.worker")
+
+
+class ChannelError(Exception):
+    pass
+
+
+class Channel(object):
+    """
+    Length-prefixed pickles over a stream socket. Messages are (op, args) tuples, dispatched to `handler.on_<op>`.
+    `call()` sends a request and blocks the calling greenlet until the other side replies with its handler's result.
+    It raises ChannelError instead if the handler fails, or if the other end goes away first.
+    """
+    HEADER = struct.Struct('<I')
+
+    def __init__(self, sock, handler):
+        self.sock = sock
+        self.handler = handler
+        self._send_lock = gevent.lock.Semaphore()
+        self._calls = {}
+        self._next_call = 0
+        self._closed = False
+
+    def send(self, op, *args):
+        data = cPickle.dumps((op, args), cPickle.HIGHEST_PROTOCOL)
+        with self._send_lock:
+            self.sock.sendall(self.HEADER.pack(len(data)) + data)
+
+    def call(self, op, *args):
+        if self._closed:
+            raise ChannelError("Channel closed.")
+        self._next_call += 1
+        call_id = self._next_call
+        result = gevent.event.AsyncResult()
+        self._calls[call_id] = result
+        try:
+            self.send('call', call_id, op, args)
+        except socket.error as e:
+            self._calls.pop(call_id, None)
+            raise ChannelError(str(e))
+        return result.get()
+
+    def close(self):
+        self.sock.close()
+        self._fail_calls()
+
+    def _fail_calls(self):
+        # Nothing is going to answer these now.
+        self._closed = True
+        calls, self._calls = self._calls, {}
+        for result in calls.itervalues():
+            result.set_exception(ChannelError("Channel closed."))
+
+    def _recv_exactly(self, length):
+        chunks = []
+        while length > 0:
+            chunk = self.sock.recv(length)
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    def _dispatch(self, op, args):
+        if op == 'reply':
+            call_id, value = args
+            result = self._calls.pop(call_id, None)
+            if result is not None:
+                result.set(value)
+        elif op == 'fail':
+            call_id, message = args
+            result = self._calls.pop(call_id, None)
+            if result is not None:
+                result.set_exception(ChannelError(message))
+        elif op == 'call':
+            # Answering may take a while (e.g. a round trip to the watch), so don't hold up other messages for it.
+            gevent.spawn(self._answer, *args)
+        else:
+            getattr(self.handler, 'on_' + op)(*args)
+
+    def _answer(self, call_id, op, args):
+        try:
+            value = getattr(self.handler, 'on_' + op)(*args)
+        except Exception as e:
+            logger.exception("Failed to answer worker call '%s'", op)
+            self.send('fail', call_id, str(e))
+        else:
+            self.send('reply', call_id, value)
+
+    def run(self):
+        # Returns once the other end goes away, failing any calls still waiting on it.
+        try:
+            self._run()
+        finally:
+            self._fail_calls()
+
+    def _run(self):
+        while True:
+            try:
+                header = self._recv_exactly(self.HEADER.size)
+                if header is None:
+                    break
+                data = self._recv_exactly(self.HEADER.unpack(header)[0])
+                if data is None:
+                    break
+            except socket.error:
+                break
+            op, args = cPickle.loads(data)
+            try:
+                self._dispatch(op, args)
+            except Exception:
+                logger.exception("Failed to handle worker message '%s'", op)
+
+
+def _encode_appmessage(dictionary):
+    return {k: (type(v).__name__, v.value) for k, v in dictionary.iteritems()}
+
+
+def _decode_appmessage(dictionary):
+    return {k: getattr(appmessage_types, kind)(value) for k, (kind, value) in dictionary.iteritems()}
+
+
+class WorkerRuntime(object):
+    # The parent's half: to the Runner, this looks like a JSRuntime.
+    def __init__(self, runner, pbw):
+        self.runner = runner
+        self.pbw = pbw
+        self._stats = {}
+        self.channel = None
+        self.process = None
+        self._stopped = False
+        self._appmessage_handlers = []
+        self._appmessage_tids = {}  # our AppMessage transaction id -> the worker's
+
+    def run(self, src, filename="pebble-js-app.js"):
+        if self._stopped:
+            return
+        parent_sock, child_sock = socket.socketpair()
+        self.process = subprocess.Popen([sys.executable, '-m', 'pypkjs.runner.worker', str(child_sock.fileno())],
+                                        close_fds=False)
+        child_sock.close()
+        self.channel = Channel(parent_sock, self)
+        appmessage = self.runner.appmessage
+        self._appmessage_handlers = [
+            appmessage.register_handler(event, self._forward_appmessage(event))
+            for event in ("ack", "nack", "appmessage")
+        ]
+        watch = self.runner.pebble.pebble
+        watch_info = watch.watch_info
+        fw_version = watch.firmware_version
+        config = {
+            'persist_dir': self.runner.persist_dir,
+            'block_private_addresses': self.runner.block_private_addresses,
+            'callback_cpu_budget': self.runner.js_callback_budget,
+            'script_cpu_budget': self.runner.js_script_budget,
+            'oauth_token': self.runner.oauth_token,
+            'account_token': self.runner.account_token,
+            'watch_token': self.runner.watch_token,
+            'layout_file': self.runner.layout_file,
+            'appmessage_window': self.runner.appmessage_window,
+            'api': {'pool_size': self.runner.api.pool_size,
+                    'connect_timeout': self.runner.api.connect_timeout,
+                    'read_timeout': self.runner.api.read_timeout},
+            'appmessage_timeout': self.runner.appmessage_timeout,
+            'notification_rate': self.runner.notification_rate,
+            'notification_dedupe_window': self.runner.notification_dedupe_window,
+            'localstorage_durability': self.runner.localstorage_durability,
+            'localstorage_flush_interval': self.runner.localstorage_flush_interval,
+            'localstorage_quota': self.runner.localstorage_quota,
+            'xhr_max_response_size': self.runner.xhr_max_response_size,
+            'http_cache_size': self.runner.http_cache_size,
+            'virtual_time': self.runner.virtual_time,
+            'watch': {
+                'hardware_platform': watch_info.running.hardware_platform,
+                'language': watch_info.language,
+                'firmware': (fw_version.major, fw_version.minor, fw_version.patch, fw_version.suffix),
+                'platform': watch.watch_platform,
+            },
+        }
+        logger.info("Starting JS worker process %d for %s", self.process.pid, self.pbw.uuid)
+        try:
+            self.channel.send('start', config, tuple(self.pbw), src, filename)
+            self.channel.run()
+        finally:
+            for handle in self._appmessage_handlers:
+                appmessage.unregister_handler(handle)
+            self.channel.close()
+            self.process.wait()
+            logger.info("JS worker process %d exited", self.process.pid)
+
+    def _forward_appmessage(self, event):
+        def forward(tid, *args):
+            if event != "appmessage":
+                # Responses go back under the worker's id for the message, if it was one of the worker's.
+                if tid not in self._appmessage_tids:
+                    return
+                tid = self._appmessage_tids.pop(tid)
+            self.channel.send('appmessage_event', event, (tid,) + args)
+        return forward
+
+    def stop(self):
+        self._stopped = True
+        if self.channel is not None:
+            try:
+                self.channel.send('stop')
+            except socket.error:
+                pass
+
+    def do_config(self):
+        if self.channel is not None:
+            self.channel.send('do_config')
+
+    def is_configurable(self):
+        return 'configurable' in self.pbw.manifest['capabilities']
+
+    def stats(self):
+        # The worker pushes these every few seconds, so they may be a little stale.
+        return self._stats
+
+    def log_output(self, message):
+        raise NotImplemented
+
+    def open_config_page(self, url, callback):
+        raise NotImplemented
+
+    # Messages from the worker.
+    def on_log(self, message):
+        self.log_output(message)
+
+    def on_open_config_page(self, url):
+        self.open_config_page(url, lambda response: self.channel.send('config_response', response))
+
+    def on_stats(self, stats):
+        self._stats = stats
+
+    def on_terminated(self, uuid):
+        self.runner.record_js_termination(uuid)
+
+    def on_localstorage_usage(self, uuid, size):
+        self.runner.record_localstorage_usage(uuid, size)
+
+    def on_watch_model(self):
+        return self.runner.pebble.watch_model
+
+    def on_glance_is_current(self, app_uuid, digest, now):
+        return self.runner.pebble.is_glance_current(app_uuid, digest, now)
+
+    def on_record_glance(self, app_uuid, digest, expires):
+        self.runner.pebble.record_glance(app_uuid, digest, expires)
+
+    def on_send_message(self, endpoint, message):
+        self.runner.pebble.pebble._send_message(endpoint, message)
+
+    def on_send_raw(self, message):
+        self.runner.pebble.pebble.send_raw(message)
+
+    def on_appmessage_send(self, worker_tid, uuid, dictionary):
+        tid = self.runner.appmessage.send_message(uuid, _decode_appmessage(dictionary))
+        self._appmessage_tids[tid] = worker_tid
+
+    def on_timeline_token(self, oauth_token, uuid):
+        # Exceptions don't cross the channel, so failures come back as messages.
+        try:
+            return True, self.runner.timeline_tokens.get(oauth_token, uuid)
+        except (requests.RequestException, TokenException) as e:
+            return False, str(e)
+        except Exception:
+            logger.exception("Failed to get timeline token for %s", uuid)
+            return False, "Internal failure."
+
+    def on_timeline_token_invalidate(self, oauth_token, uuid):
+        self.runner.timeline_tokens.invalidate(oauth_token, uuid)
+
+    def on_blobdb_insert(self, callback_id, database, key, value):
+        self.runner.pebble.blobdb.insert(database, key, value,
+                                         callback=lambda status: self.channel.send('blobdb_result', callback_id, status))
+
+    def on_blobdb_delete(self, callback_id, database, key):
+        self.runner.pebble.blobdb.delete(database, key,
+                                         callback=lambda status: self.channel.send('blobdb_result', callback_id, status))
+
+
+# Everything below here runs in the worker.
+
+class _Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+_FirmwareVersion = collections.namedtuple('FirmwareVersion', ('major', 'minor', 'patch', 'suffix'))
+
+
+class WorkerWatch(object):
+    # Stands in for the libpebble2 PebbleConnection.
+    def __init__(self, channel, info):
+        self._channel = channel
+        self.watch_info = _Namespace(running=_Namespace(hardware_platform=info['hardware_platform']),
+                                     language=info['language'])
+        self.firmware_version = _FirmwareVersion(*info['firmware'])
+        self.watch_platform = info['platform']
+
+    @property
+    def watch_model(self):
+        return self._channel.call('watch_model')
+
+    def _send_message(self, endpoint, message):
+        self._channel.send('send_message', endpoint, message)
+
+    def send_packet(self, packet):
+        self._channel.send('send_raw', packet.serialise_packet())
+
+
+class WorkerManager(object):
+    # Stands in for the PebbleManager. The watch details are a snapshot taken at launch, so they never change.
+    watch_info_generation = 0
+
+    def __init__(self, channel, watch, blobdb):
+        self._channel = channel
+        self.pebble = watch
+        self.blobdb = blobdb
+        self._watch_model = None
+
+    @property
+    def watch_model(self):
+        if self._watch_model is None:
+            self._watch_model = self.pebble.watch_model
+        return self._watch_model
+
+    # The parent keeps track of glances, since it knows when the watch reconnects.
+    def is_glance_current(self, app_uuid, digest, now):
+        return self._channel.call('glance_is_current', app_uuid, digest, now)
+
+    def record_glance(self, app_uuid, digest, expires):
+        self._channel.send('record_glance', app_uuid, digest, expires)
+
+
+class WorkerBlobDB(object):
+    def __init__(self, channel):
+        self._channel = channel
+        self._callbacks = {}
+        self._next_callback = 0
+
+    def _register(self, callback):
+        self._next_callback += 1
+        self._callbacks[self._next_callback] = callback
+        return self._next_callback
+
+    def insert(self, database, key, value, callback=None):
+        self._channel.send('blobdb_insert', self._register(callback), database, key, value)
+
+    def delete(self, database, key, callback=None):
+        self._channel.send('blobdb_delete', self._register(callback), database, key)
+
+    def handle_result(self, callback_id, status):
+        callback = self._callbacks.pop(callback_id, None)
+        if callable(callback):
+            callback(status)
+
+
+class WorkerAppMessage(object):
+    # Stands in for the AppMessageService. Transaction ids are our own, so that sending needn't wait on the parent; it
+    # translates the watch's responses back to them.
+    def __init__(self, channel):
+        self._channel = channel
+        self._handlers = {}
+        self._next_handle = 0
+        self._next_tid = 0
+        self._sending = set()
+        self._early = {}  # responses that arrived while their message was still being sent
+
+    def register_handler(self, event, handler):
+        self._next_handle += 1
+        self._handlers[self._next_handle] = (event, handler)
+        return self._next_handle
+
+    def unregister_handler(self, handle):
+        self._handlers.pop(handle, None)
+
+    def send_message(self, target_app, dictionary):
+        tid = self._next_tid
+        self._next_tid = (self._next_tid + 1) % 256
+        self._sending.add(tid)
+        try:
+            self._channel.send('appmessage_send', tid, target_app, _encode_appmessage(dictionary))
+        finally:
+            self._sending.discard(tid)
+        early = self._early.pop(tid, None)
+        if early is not None:
+            # The caller only learns the tid when we return, so hand it the response after that.
+            gevent.spawn(self.handle_event, *early)
+        return tid
+
+    def handle_event(self, event, args):
+        if event != "appmessage" and args[0] in self._sending:
+            self._early[args[0]] = (event, args)
+            return
+        for registered_event, handler in self._handlers.values():
+            if registered_event == event:
+                handler(*args)
+
+
+class WorkerTokenCache(object):
+    # Stands in for the TimelineTokenCache, so that tokens are still shared with the parent and its other apps.
+    def __init__(self, channel):
+        self._channel = channel
+
+    def get(self, oauth_token, uuid):
+        try:
+            ok, value = self._channel.call('timeline_token', oauth_token, uuid)
+        except ChannelError as e:
+            raise TokenException(str(e))
+        if not ok:
+            raise TokenException(value)
+        return value
+
+    def invalidate(self, oauth_token, uuid):
+        self._channel.send('timeline_token_invalidate', oauth_token, uuid)
+
+
+class WorkerTimeline(object):
+    # Just enough of PebbleTimeline for serialising app glances.
+    def __init__(self, worker, layout_file):
+        from pypkjs.timeline import load_fw_map
+        self.runner = worker
+        self.fw_map = load_fw_map(layout_file)
+
+
+class Worker(object):
+    # The worker's half. It also stands in for the Runner, as seen by the JSRuntime.
+    STATS_INTERVAL = 5
+
+    def __init__(self, sock):
+        self.channel = Channel(sock, self)
+        self.runtime = None
+        self.pbw = None
+        self.blobdb = WorkerBlobDB(self.channel)
+        self.appmessage = WorkerAppMessage(self.channel)
+        self.timeline_tokens = WorkerTokenCache(self.channel)
+        self._config_callback = None
+
+    def run(self):
+        self.channel.run()
+
+    def on_start(self, config, pbw, src, filename):
+        from pypkjs.clock import Clock, VirtualClock
+        from pypkjs.javascript.code_cache import CodeCache
+        from pypkjs.javascript.http_cache import HTTPCache
+        from pypkjs.javascript.runtime import JSRuntime
+        from pypkjs.runner import Runner
+        from pypkjs.timeline.http import APISession
+        from pypkjs.timeline.urls import URLManager
+
+        self.pbw = Runner.PBW(*pbw)
+        self.oauth_token = config['oauth_token']
+        self.account_token = config['account_token']
+        self.watch_token = config['watch_token']
+        self.urls = URLManager()
+        self.api = APISession(**config['api'])
+        self.clock = VirtualClock() if config['virtual_time'] else Clock()
+        self.timeline = WorkerTimeline(self, config['layout_file'])
+        watch = WorkerWatch(self.channel, config['watch'])
+        manager = WorkerManager(self.channel, watch, self.blobdb)
+        http_cache = None
+        if config['http_cache_size']:
+            http_cache = HTTPCache(config['persist_dir'], max_size=config['http_cache_size'])
+        self.runtime = JSRuntime(manager, self.pbw, self, persist_dir=config['persist_dir'],
+                                 block_private_addresses=config['block_private_addresses'],
+                                 code_cache=CodeCache(config['persist_dir']),
+                                 callback_cpu_budget=config['callback_cpu_budget'],
+                                 script_cpu_budget=config['script_cpu_budget'], clock=self.clock,
+                                 appmessage_window=config['appmessage_window'],
+                                 appmessage_timeout=config['appmessage_timeout'],
+                                 notification_rate=config['notification_rate'],
+                                 notification_dedupe_window=config['notification_dedupe_window'],
+                                 localstorage_durability=config['localstorage_durability'],
+                                 localstorage_flush_interval=config['localstorage_flush_interval'],
+                                 localstorage_quota=config['localstorage_quota'],
+                                 xhr_max_response_size=config['xhr_max_response_size'],
+                                 http_cache=http_cache)
+        self.runtime.log_output = lambda m: self.channel.send('log', m)
+        self.runtime.open_config_page = self.open_config_page
+        gevent.spawn(self._run_runtime, src, filename)
+        gevent.spawn(self._report_stats)
+
+    def _run_runtime(self, src, filename):
+        try:
+            self.runtime.run(src, filename)
+        finally:
+            self.channel.send('stats', self.runtime.stats())
+            self.channel.close()
+
+    def _report_stats(self):
+        while True:
+            gevent.sleep(self.STATS_INTERVAL)
+            self.channel.send('stats', self.runtime.stats())
+
+    def open_config_page(self, url, callback):
+        self._config_callback = callback
+        self.channel.send('open_config_page', url)
+
+    def timeline_mapping_for_app(self, app_uuid):
+        return self.pbw.layouts.get(self.runtime.qemu.pebble.watch_platform, {})
+
+    def record_js_termination(self, uuid):
+        self.channel.send('terminated', uuid)
+
+    def record_localstorage_usage(self, uuid, size):
+        self.channel.send('localstorage_usage', str(uuid), size)
+
+    # Messages from the parent.
+    def on_stop(self):
+        self.runtime.stop()
+
+    def on_do_config(self):
+        self.runtime.do_config()
+
+    def on_config_response(self, response):
+        if self._config_callback is not None:
+            self._config_callback(response)
+            self._config_callback = None
+
+    def on_appmessage_event(self, event, args):
+        self.appmessage.handle_event(event, args)
+
+    def on_blobdb_result(self, callback_id, status):
+        self.blobdb.handle_result(callback_id, status)
+
+
+def main():
+    logging.basicConfig()
+    fd = int(sys.argv[1])
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)
+    Worker(sock).run()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
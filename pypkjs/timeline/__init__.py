@@ -18,6 +18,13 @@ from .model import TimelineItem, TimelineState, TimelineSubscription, PinTopic
 from .websync import TimelineWebSync
 
 
+def load_fw_map(layout_file=None):
+    if layout_file is None:
+        layout_file = os.path.join(os.path.dirname(__file__), 'layouts.json')
+    with open(layout_file) as f:
+        return json.load(f)
+
+
 class PebbleTimeline(object):
     def __init__(self, runner, oauth=None, persist=None, layout_file=None):
         self.runner = runner
@@ -37,16 +44,11 @@ class PebbleTimeline(object):
     @property
     def fw_map(self):
         if self._fw_map_cache is None:
-            if self._layout_file_path is not None:
-                with open(self._layout_file_path) as f:
-                    self._fw_map_cache = json.load(f)
-            else:
-                with open(os.path.join(os.path.dirname(__file__), 'layouts.json')) as f:
-                    self._fw_map_cache = json.load(f)
+            self._fw_map_cache = load_fw_map(self._layout_file_path)
         return self._fw_map_cache
 
     def perform_sync(self):
-        sync = TimelineWebSync(self.runner.urls, self.oauth)
+        sync = TimelineWebSync(self.runner.urls, self.oauth, self.runner.api)
         for type, pin in sync.update_iter():
             try:
                 self.handle_update(type, pin)
@@ -183,7 +185,8 @@ class PebbleTimeline(object):
             PinTopic.delete().where(PinTopic.topic == topic_key).execute()
 
     def _window_start(self):
-        now = datetime.datetime.now(tz=tzlocal())
+        # The running app's time, which with --virtual-time may be well ahead of the wall clock.
+        now = datetime.datetime.fromtimestamp(self.runner.clock.time(), tz=tzlocal())
         today = datetime.datetime(now.year, now.month, now.day, tzinfo=now.tzinfo)
         yesterday = today - datetime.timedelta(days=1)
         return yesterday
@@ -89,7 +89,7 @@ class ActionHandler(object):
             headers.update(action.get('headers', {}))
 
             try:
-                response = requests.request(method, url, headers=headers, data=body, allow_redirects=True, timeout=2.5)
+                response = self.timeline.runner.api.request(method, url, headers=headers, data=body, allow_redirects=True, timeout=2.5)
                 response.raise_for_status()
             except requests.RequestException as e:
                 logging.warning("HTTP request failed: %s", e.message)
@@ -0,0 +1,49 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import requests
+import requests.adapters
+
+
+class APISession(object):
+    """
+    A keep-alive connection pool for pypkjs's own calls to Pebble's web services (timeline sync, tokens, subscriptions
+    and pin actions), so that they don't each pay for a new TCP and TLS handshake. Apps' own XMLHttpRequests don't use
+    this.
+    """
+    def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=30.0):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def stats(self):
+        connections = 0
+        requests_made = 0
+        hosts = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts += 1
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+        return {
+            'hosts': hosts,
+            'connections': connections,
+            'requests': requests_made,
+            'reused': requests_made - connections,
+        }
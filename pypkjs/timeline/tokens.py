@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import errno
+import gevent.event
+import hashlib
+import json
+import logging
+import os
+import os.path
+import time
+
+logger = logging.getLogger('pypkjs.timeline.tokens')
+
+
+class TokenException(Exception):
+    pass
+
+
+class TimelineTokenCache(object):
+    """
+    Sandbox timeline tokens, shared by every app launch in the process and keyed by user and app. Concurrent requests
+    for a token that isn't cached yet all wait on a single fetch. With a persist directory, tokens survive restarts.
+    """
+    def __init__(self, urls, api, persist_dir=None, max_age=86400):
+        self.urls = urls
+        self.api = api
+        self.max_age = max_age
+        if persist_dir is not None:
+            self.path = os.path.join(persist_dir, 'timeline_tokens.json')
+        else:
+            self.path = None
+        self._tokens = {}  # key -> (token, fetched)
+        self._pending = {}  # key -> AsyncResult
+        self.hits = 0
+        self.fetches = 0
+        self._load()
+
+    @staticmethod
+    def _key(oauth_token, uuid):
+        # Don't keep the OAuth token itself lying around on disk.
+        return "%s/%s" % (hashlib.sha1(oauth_token or '').hexdigest(), uuid)
+
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                self._tokens = {k: tuple(v) for k, v in json.load(f).iteritems()}
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Couldn't read timeline tokens: %s", e)
+        except ValueError as e:
+            logger.warning("Ignoring corrupt timeline token cache: %s", e)
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self._tokens, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as e:
+            logger.warning("Couldn't write timeline tokens: %s", e)
+
+    def get(self, oauth_token, uuid):
+        key = self._key(oauth_token, uuid)
+        entry = self._tokens.get(key)
+        if entry is not None:
+            token, fetched = entry
+            if self.max_age is None or time.time() - fetched < self.max_age:
+                self.hits += 1
+                return token
+        if key in self._pending:
+            return self._pending[key].get()
+        result = self._pending[key] = gevent.event.AsyncResult()
+        try:
+            token = self._fetch(oauth_token, uuid)
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        else:
+            self._tokens[key] = (token, time.time())
+            self._save()
+            result.set(token)
+            return token
+        finally:
+            del self._pending[key]
+
+    def invalidate(self, oauth_token, uuid):
+        if self._tokens.pop(self._key(oauth_token, uuid), None) is not None:
+            self._save()
+
+    def _fetch(self, oauth_token, uuid):
+        self.fetches += 1
+        result = self.api.get(self.urls.sandbox_token % uuid, headers={'Authorization': 'Bearer %s' % oauth_token})
+        if result.status_code == 404:
+            raise TokenException("No token available; make sure the app is timeline enabled "
+                                 "and this user authorised in the developer portal.")
+        elif result.status_code == 401:
+            raise TokenException("User login rejected; make sure you are logged in to the SDK.")
+        result.raise_for_status()
+        logger.debug("get_timeline_token result: %s", result.json())
+        return result.json()['token']
+
+    def stats(self):
+        return {
+            'cached': len(self._tokens),
+            'hits': self.hits,
+            'fetches': self.fetches,
+        }
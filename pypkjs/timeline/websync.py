@@ -9,12 +9,13 @@ from .model import TimelineState
 logger = logging.getLogger('pypkjs.timeline.websync')
 
 class TimelineWebSync(object):
-    def __init__(self, urls, oauth):
+    def __init__(self, urls, oauth, api):
         self.urls = urls
         self.oauth = oauth
+        self.api = api
 
     def _make_request(self, url):
-        result = requests.get(url, headers={'Authorization': 'Bearer %s' % self.oauth})
+        result = self.api.get(url, headers={'Authorization': 'Bearer %s' % self.oauth})
         result.raise_for_status()
         return result.json()
 
@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import gevent.pool
+import itertools
+import unittest
+
+try:
+    import pypkjs.PyV8
+except ImportError:
+    v8_available = False
+else:
+    v8_available = True
+
+if v8_available:
+    from pypkjs.clock import Clock
+    from pypkjs.javascript.appmessage import AppMessagePipeline
+
+
+class FakeService(object):
+    # Hands out transaction ids the way the watch protocol does: one byte, wrapping around.
+    def __init__(self):
+        self._tids = itertools.cycle(range(256))
+        self.sent = []
+
+    def send_message(self, uuid, dictionary):
+        tid = next(self._tids)
+        self.sent.append(tid)
+        return tid
+
+
+class FakeRuntime(object):
+    def __init__(self):
+        self.clock = Clock()
+        self.group = gevent.pool.Group()
+
+    def enqueue_from(self, source, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+
+@unittest.skipUnless(v8_available, "PyV8 is not available")
+class TestAppMessagePipeline(unittest.TestCase):
+    def test_unlimited_window_never_reuses_a_live_tid(self):
+        service = FakeService()
+        pipeline = AppMessagePipeline(FakeRuntime(), service, None, window=0, timeout=0)
+        acked = []
+        for i in range(300):
+            pipeline.send({}, success=lambda e, i=i: acked.append(i))
+        self.assertEqual(len(pipeline.in_flight), AppMessagePipeline.MAX_WINDOW)
+        self.assertEqual(len(pipeline.backlog), 300 - AppMessagePipeline.MAX_WINDOW)
+        while pipeline.in_flight:
+            pipeline.handle_response(next(iter(pipeline.in_flight)), True)
+        self.assertEqual(acked, range(300))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import datetime
+import gevent
+import logging
+import time
+import unittest
+
+from pypkjs.clock import Clock, VirtualClock
+from pypkjs.timeline import PebbleTimeline
+
+
+class TestVirtualClock(unittest.TestCase):
+    def test_jumps_when_idle(self):
+        clock = VirtualClock(start=0)
+        started = time.time()
+        clock.sleep(3600)
+        self.assertEqual(clock.time(), 3600)
+        self.assertLess(time.time() - started, 1)
+
+    def test_keeps_real_time_while_runtime_busy(self):
+        idle = [False]
+        clock = VirtualClock(start=0, idle_check=lambda: idle[0])
+        sleeper = gevent.spawn(clock.sleep, 3600)
+        gevent.sleep(0.2)
+        self.assertFalse(sleeper.ready())
+        self.assertLess(clock.time(), 1)
+        self.assertGreater(clock.time(), 0)
+        idle[0] = True
+        sleeper.join(timeout=1)
+        self.assertTrue(sleeper.ready())
+        self.assertEqual(clock.time(), 3600)
+
+    def test_busy_blocks_jumps(self):
+        clock = VirtualClock(start=0)
+        with clock.busy():
+            sleeper = gevent.spawn(clock.sleep, 3600)
+            gevent.sleep(0.2)
+            self.assertFalse(sleeper.ready())
+            self.assertLess(clock.time(), 1)
+        sleeper.join(timeout=1)
+        self.assertTrue(sleeper.ready())
+
+    def test_short_deadline_passes_in_real_time(self):
+        clock = VirtualClock(start=0, idle_check=lambda: False)
+        sleeper = gevent.spawn(clock.sleep, 0.1)
+        sleeper.join(timeout=1)
+        self.assertTrue(sleeper.ready())
+        self.assertGreaterEqual(clock.time(), 0.1)
+
+
+class FakeWatch(object):
+    def register_endpoint(self, endpoint, handler):
+        pass
+
+
+class FakeRunner(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.logger = logging.getLogger("pypkjs.tests")
+        self.urls = type('URLs', (object,), {'fw_resource_map': None})()
+        self.pebble = type('Manager', (object,), {'pebble': FakeWatch()})()
+
+
+class TestTimelineWindow(unittest.TestCase):
+    def test_window_follows_runner_clock(self):
+        clock = VirtualClock()
+        timeline = PebbleTimeline(FakeRunner(clock))
+        start = timeline._window_start()
+        clock.advance(86400 * 3)
+        self.assertEqual(timeline._window_start() - start, datetime.timedelta(days=3))
+        self.assertEqual(timeline._window_end() - timeline._window_start(), datetime.timedelta(days=4))
+
+    def test_real_clock_window(self):
+        timeline = PebbleTimeline(FakeRunner(Clock()))
+        self.assertLess(timeline._window_start(), datetime.datetime.now(tz=timeline._window_start().tzinfo))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import dumbdbm
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pypkjs.PyV8
+except ImportError:
+    v8_available = False
+else:
+    v8_available = True
+
+if v8_available:
+    from pypkjs.javascript.logstore import LogStore, open_store
+
+
+class TornFile(object):
+    # Writes the first half of whatever it's given to the real log, then fails as a full disk would.
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        self.f.write(data[:len(data) // 2])
+        self.f.flush()
+        raise IOError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+@unittest.skipUnless(v8_available, "PyV8 is not available")
+class TestLogStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_flush_keeps_changes(self):
+        store = LogStore(self.path, durability=LogStore.ON_EXIT)
+        store['a'] = '1'
+        self.assertTrue(store.flush())
+        good_size = os.path.getsize(self.path)
+        store['b'] = '2'
+        store._log = TornFile(store._log)
+        self.assertFalse(store.flush())
+        self.assertTrue(store.dirty)
+        self.assertEqual(os.path.getsize(self.path), good_size)
+        self.assertTrue(store.flush())
+        self.assertFalse(store.dirty)
+        store.close()
+        self.assertEqual(sorted(LogStore(self.path).items()), [('a', '1'), ('b', '2')])
+
+    def test_close_reports_failure(self):
+        store = LogStore(self.path, durability=LogStore.ON_EXIT)
+        store['a'] = '1'
+        store._log = TornFile(store._log)
+        # Nor can the log be rewritten.
+        os.mkdir(self.path + '.tmp')
+        self.assertRaises((IOError, OSError), store.close)
+
+
+@unittest.skipUnless(v8_available, "PyV8 is not available")
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store')
+        old = dumbdbm.open(self.path, 'c')
+        old['a'] = '1'
+        old['b'] = '2'
+        old.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_migrates_dumbdbm(self):
+        store = open_store(self.path)
+        self.assertEqual(sorted(store.items()), [('a', '1'), ('b', '2')])
+        store.close()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['store.log'])
+
+    def test_finishes_interrupted_migration(self):
+        # The log made it into place, but the old database wasn't removed.
+        migrated = LogStore()
+        migrated['a'] = '1'
+        with open(self.path + '.log', 'wb') as f:
+            f.write(migrated.dump())
+        store = open_store(self.path)
+        self.assertEqual(store.items(), [('a', '1')])
+        store.close()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['store.log'])
+
+
+if __name__ == '__main__':
+    unittest.main()
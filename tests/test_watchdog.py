@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import unittest
+
+try:
+    import pypkjs.PyV8
+except ImportError:
+    v8_available = False
+else:
+    v8_available = True
+
+if v8_available:
+    from pypkjs.javascript.watchdog import Watchdog
+
+
+@unittest.skipUnless(v8_available, "PyV8 is not available")
+class TestPausedBudget(unittest.TestCase):
+    def setUp(self):
+        self.watchdog = Watchdog()
+        self.watchdog._running = True  # no thread; these tests only look at the bookkeeping
+
+    def test_other_budget_while_paused(self):
+        with self.watchdog.budget(60, 'first') as first:
+            started = first.started
+            with self.watchdog.paused():
+                self.assertIsNone(self.watchdog._budget)
+                with self.watchdog.budget(60, 'second') as second:
+                    self.assertIs(self.watchdog._budget, second)
+                self.assertIsNone(self.watchdog._budget)
+            self.assertIs(self.watchdog._budget, first)
+            self.assertGreaterEqual(first.started, started)
+        self.assertIsNone(self.watchdog._budget)
+
+    def test_interleaved_pauses(self):
+        first = self.watchdog.budget(60, 'first').__enter__()
+        first_pause = self.watchdog.paused()
+        first_pause.__enter__()
+        second = self.watchdog.budget(60, 'second').__enter__()
+        second_pause = self.watchdog.paused()
+        second_pause.__enter__()
+        # The first runtime's wait ends while the second's is still blocked.
+        first_pause.__exit__(None, None, None)
+        self.assertIs(self.watchdog._budget, first)
+        first.__exit__(None, None, None)
+        second_pause.__exit__(None, None, None)
+        self.assertIs(self.watchdog._budget, second)
+        second.__exit__(None, None, None)
+        self.assertIsNone(self.watchdog._budget)
+
+    def test_pause_without_budget(self):
+        with self.watchdog.paused():
+            pass
+        self.assertIsNone(self.watchdog._budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
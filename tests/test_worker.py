@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import gevent
+import socket
+import unittest
+
+try:
+    import pypkjs.PyV8
+except ImportError:
+    v8_available = False
+else:
+    v8_available = True
+
+if v8_available:
+    from pypkjs.runner.worker import Channel, ChannelError, WorkerAppMessage
+
+
+class Handler(object):
+    def __init__(self):
+        self.events = []
+
+    def on_echo(self, value):
+        return value
+
+    def on_wait(self):
+        gevent.sleep(60)
+
+    def on_broken(self):
+        raise ValueError("broken")
+
+    def on_appmessage_send(self, tid, uuid, dictionary):
+        self.events.append(('send', tid))
+
+
+@unittest.skipUnless(v8_available, "PyV8 is not available")
+class TestChannel(unittest.TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.local = Channel(a, Handler())
+        self.remote = Channel(b, Handler())
+        self.greenlets = [gevent.spawn(self.local.run), gevent.spawn(self.remote.run)]
+
+    def tearDown(self):
+        gevent.killall(self.greenlets)
+        for channel in (self.local, self.remote):
+            channel.sock.close()
+
+    def test_call(self):
+        self.assertEqual(self.local.call('echo', 42), 42)
+
+    def test_handler_failure(self):
+        with gevent.Timeout(5):
+            self.assertRaises(ChannelError, self.local.call, 'broken')
+
+    def test_peer_closing_fails_pending_calls(self):
+        gevent.spawn_later(0.05, self.remote.close)
+        with gevent.Timeout(5):
+            self.assertRaises(ChannelError, self.local.call, 'wait')
+        self.assertRaises(ChannelError, self.local.call, 'echo', 1)
+
+
+@unittest.skipUnless(v8_available, "PyV8 is not available")
+class TestWorkerAppMessage(unittest.TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.parent = Handler()
+        self.channel = Channel(a, Handler())
+        self.remote = Channel(b, self.parent)
+        self.greenlet = gevent.spawn(self.remote.run)
+        self.appmessage = WorkerAppMessage(self.channel)
+        self.acks = []
+        self.appmessage.register_handler("ack", lambda tid, uuid: self.acks.append(tid))
+
+    def tearDown(self):
+        self.greenlet.kill()
+        self.channel.sock.close()
+        self.remote.sock.close()
+
+    def test_send_does_not_wait(self):
+        tids = [self.appmessage.send_message('uuid', {}) for i in xrange(300)]
+        self.assertEqual(tids[:3], [0, 1, 2])
+        self.assertEqual(tids[256], 0)
+        gevent.sleep(0.05)
+        self.assertEqual(self.parent.events[:2], [('send', 0), ('send', 1)])
+
+    def test_early_response(self):
+        tids = []
+        original_send = self.channel.send
+
+        def send_and_respond(op, *args):
+            original_send(op, *args)
+            # The response arrives while send_message is still sending.
+            self.appmessage.handle_event("ack", (args[0], 'uuid'))
+            self.assertEqual(self.acks, [])
+        self.channel.send = send_and_respond
+        tids.append(self.appmessage.send_message('uuid', {}))
+        gevent.sleep(0)
+        self.assertEqual(self.acks, tids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+from __future__ import absolute_import
+__author__ = 'katharine'
+
+import gevent
+import gevent.pool
+import gevent.pywsgi
+import json
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pypkjs.PyV8
+except ImportError:
+    v8_available = False
+else:
+    v8_available = True
+
+if v8_available:
+    import requests
+    import requests.adapters
+    from pypkjs.clock import Clock
+    from pypkjs.javascript import events, xhr
+    from pypkjs.javascript.http_cache import CachingHTTPAdapter, HTTPCache
+    from pypkjs.javascript.scheduler import EventScheduler, LANE_NETWORK
+
+
+class FakeEvent(object):
+    _aborted = False
+
+
+class FakeRuntime(object):
+    xhr_max_response_size = 0
+
+    def __init__(self):
+        self.group = gevent.pool.Group()
+        self.clock = Clock()
+        self.queue = []
+
+    def enqueue_from(self, source, fn, *args, **kwargs):
+        self.queue.append((fn, args, kwargs))
+
+    def run_queue(self):
+        while self.queue:
+            fn, args, kwargs = self.queue.pop(0)
+            fn(*args, **kwargs)
+
+    def join(self, greenlet):
+        greenlet.join()
+
+    def log_output(self, message):
+        raise AssertionError(message)
+
+
+class ScheduledRuntime(FakeRuntime):
+    # Queues through a real EventScheduler, with the test itself as its consumer.
+    def __init__(self):
+        super(ScheduledRuntime, self).__init__()
+        self.queue = EventScheduler()
+        self.queue.consumer = gevent.getcurrent()
+
+    def enqueue_from(self, source, fn, *args, **kwargs):
+        self.queue.put(source, (fn, args, kwargs))
+
+    def join(self, greenlet):
+        with self.queue.waiting_on(greenlet):
+            greenlet.join()
+
+    def run_queue(self):
+        while self.queue.depth():
+            for fn, args, kwargs in self.queue.get_batch():
+                fn(*args, **kwargs)
+
+
+class Recorder(object):
+    # Stands in for a JS listener, noting the readyState each event is dispatched in.
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+
+    def call(self, target, event, *params):
+        self.log.append((self.name, target.readyState))
+
+
+class TestServer(object):
+    def __init__(self):
+        self.requests = []
+        self.server = gevent.pywsgi.WSGIServer(('127.0.0.1', 0), self.app, log=None)
+        self.server.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        self.requests.append((path, environ.get('HTTP_IF_NONE_MATCH')))
+        if path == '/json':
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps({'hello': 'world'})]
+        if path == '/bad-json':
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return ['{not json']
+        if path == '/fresh':
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('Cache-Control', 'max-age=3600'),
+                                      ('ETag', '"fresh"')])
+            return ['fresh body']
+        if path == '/bad-charset':
+            start_response('200 OK', [('Content-Type', 'text/plain; charset=not-a-charset')])
+            return ['some text']
+        if path == '/private':
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('Cache-Control', 'private, max-age=3600')])
+            return ['private body']
+        if path == '/revalidate':
+            if environ.get('HTTP_IF_NONE_MATCH') == '"v1"':
+                start_response('304 Not Modified', [('ETag', '"v1"'), ('Cache-Control', 'no-cache')])
+                return []
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('ETag', '"v1"'), ('Cache-Control', 'no-cache')])
+            return ['revalidated body']
+        start_response('404 Not Found', [])
+        return []
+
+    def stop(self):
+        self.server.stop()
+
+
+@unittest.skipUnless(v8_available, "PyV8 is not available")
+class XHRTestCase(unittest.TestCase):
+    EVENTS = ('readystatechange', 'progress', 'load', 'error', 'timeout', 'loadend')
+
+    def setUp(self):
+        self._event = events.Event
+        self._progress_event = xhr.ProgressEvent
+        events.Event = lambda runtime, *args: FakeEvent()
+        xhr.ProgressEvent = lambda runtime, *args: FakeEvent()
+        self.server = TestServer()
+        self.runtime = FakeRuntime()
+        self.session = requests.Session()
+
+    def tearDown(self):
+        events.Event = self._event
+        xhr.ProgressEvent = self._progress_event
+        self.server.stop()
+
+    def request(self, path, response_type="", headers=None):
+        log = []
+        request = xhr.XMLHttpRequest(self.runtime, self.session)
+        for name in self.EVENTS:
+            request.addEventListener(name, Recorder(log, name))
+        request.open('GET', self.server.url + path)
+        for header, value in (headers or {}).iteritems():
+            request.setRequestHeader(header, value)
+        request.responseType = response_type
+        request.send()
+        request._thread.join()
+        self.runtime.run_queue()
+        return request, log
+
+
+class TestReadyState(XHRTestCase):
+    def test_states_follow_events(self):
+        request, log = self.request('/json')
+        states = [state for name, state in log if name == 'readystatechange']
+        self.assertEqual(states[0], xhr.XMLHttpRequest.OPENED)
+        self.assertEqual(states[1], xhr.XMLHttpRequest.HEADERS_RECEIVED)
+        self.assertEqual(states.count(xhr.XMLHttpRequest.DONE), 1)
+        self.assertEqual(states[-1], xhr.XMLHttpRequest.DONE)
+        self.assertTrue(all(state == xhr.XMLHttpRequest.LOADING for state in states[2:-1]))
+        self.assertEqual(log[-2:], [('load', xhr.XMLHttpRequest.DONE), ('loadend', xhr.XMLHttpRequest.DONE)])
+
+    def test_sync_request_is_done_when_send_returns(self):
+        request = xhr.XMLHttpRequest(self.runtime, self.session)
+        request.open('GET', self.server.url + '/json', False)
+        request.send()
+        self.assertEqual(request.readyState, xhr.XMLHttpRequest.DONE)
+        self.assertEqual(request.status, 200)
+        self.assertEqual(json.loads(request.responseText), {'hello': 'world'})
+        self.runtime.run_queue()
+        self.assertEqual(request.readyState, xhr.XMLHttpRequest.DONE)
+
+    def test_json_response(self):
+        request, log = self.request('/json', response_type='json')
+        self.assertEqual(request.response, {'hello': 'world'})
+
+    def test_bad_json_response_is_null(self):
+        request, log = self.request('/bad-json', response_type='json')
+        self.assertIsNone(request.response)
+        self.assertEqual(request.status, 200)
+        self.assertEqual(log[-1], ('loadend', xhr.XMLHttpRequest.DONE))
+
+    def test_unknown_charset_falls_back(self):
+        request, log = self.request('/bad-charset')
+        self.assertEqual(request.responseText, u'some text')
+        self.assertEqual(log[-2:], [('load', xhr.XMLHttpRequest.DONE), ('loadend', xhr.XMLHttpRequest.DONE)])
+
+
+class TestBackpressure(XHRTestCase):
+    def test_sync_request_with_full_lane(self):
+        self.runtime = ScheduledRuntime()
+        while not self.runtime.queue.is_full(LANE_NETWORK):
+            self.runtime.enqueue_from('ws', lambda: None)
+        request = xhr.XMLHttpRequest(self.runtime, self.session)
+        request.open('GET', self.server.url + '/json', False)
+        with gevent.Timeout(5):
+            request.send()
+        self.assertEqual(request.readyState, xhr.XMLHttpRequest.DONE)
+        self.assertEqual(request.status, 200)
+        self.runtime.run_queue()
+
+
+class TestHTTPCache(XHRTestCase):
+    def setUp(self):
+        super(TestHTTPCache, self).setUp()
+        self.persist_dir = tempfile.mkdtemp()
+        self.cache = HTTPCache(self.persist_dir)
+        adapter = CachingHTTPAdapter(self.cache, requests.adapters.HTTPAdapter())
+        self.session.mount('http://', adapter)
+
+    def tearDown(self):
+        super(TestHTTPCache, self).tearDown()
+        shutil.rmtree(self.persist_dir)
+
+    def assertCompleted(self, request, log, body):
+        self.assertEqual(request.status, 200)
+        self.assertEqual(request.responseText, body)
+        self.assertEqual(log[-3:], [('readystatechange', xhr.XMLHttpRequest.DONE),
+                                    ('load', xhr.XMLHttpRequest.DONE),
+                                    ('loadend', xhr.XMLHttpRequest.DONE)])
+
+    def test_fresh_hit(self):
+        self.assertCompleted(*self.request('/fresh'), body='fresh body')
+        self.assertCompleted(*self.request('/fresh'), body='fresh body')
+        self.assertEqual(self.server.requests, [('/fresh', None)])
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_revalidation(self):
+        self.assertCompleted(*self.request('/revalidate'), body='revalidated body')
+        self.assertCompleted(*self.request('/revalidate'), body='revalidated body')
+        self.assertEqual(self.server.requests, [('/revalidate', None), ('/revalidate', '"v1"')])
+        self.assertEqual(self.cache.revalidated, 1)
+
+    def test_private_not_stored(self):
+        self.assertCompleted(*self.request('/private'), body='private body')
+        self.assertCompleted(*self.request('/private'), body='private body')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.cache.stored, 0)
+
+    def test_authorization_bypasses_cache(self):
+        self.request('/fresh')
+        self.assertCompleted(*self.request('/fresh', headers={'Authorization': 'Bearer token'}), body='fresh body')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.cache.hits, 0)
+        self.assertEqual(self.cache.stored, 1)
+
+    def test_persisted(self):
+        self.request('/fresh')
+        self.cache = HTTPCache(self.persist_dir)
+        self.session.mount('http://', CachingHTTPAdapter(self.cache, requests.adapters.HTTPAdapter()))
+        self.assertCompleted(*self.request('/fresh'), body='fresh body')
+        self.assertEqual(len(self.server.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()